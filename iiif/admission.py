@@ -0,0 +1,218 @@
+"""Admission control for image derivations in IIIF Image API servers.
+
+Decoding a large region of a large image can need hundreds of MB, so a
+few such requests at once can exhaust the memory of a server process
+and starve cheap tile requests. The IIIFAdmissionController keeps track
+of the estimated pixels and bytes of the derivations in progress in one
+process and makes requests that would exceed the budget wait briefly,
+or fails them so that the client can retry later.
+"""
+
+import logging
+import threading
+import time
+
+from .error import IIIFError
+
+
+class IIIFAdmissionController(object):
+    """Pixel and byte budget for derivations in progress.
+
+    A request is always admitted when no other derivation is in progress,
+    so that requests larger than the whole budget can still be served one
+    at a time. Otherwise requests that would take the totals over either
+    limit wait up to wait seconds for others to finish, and are then
+    rejected with a 503 IIIFError that has a Retry-After header.
+
+    Typical use:
+
+        admission = IIIFAdmissionController(max_pixels=100000000)
+        admission.acquire(pixels, nbytes)  # may raise IIIFError
+        try:
+            # .. derive image
+        finally:
+            admission.release(pixels, nbytes)
+
+    Thread safe.
+    """
+
+    def __init__(self, max_pixels=0, max_bytes=0, wait=1.0, retry_after=1):
+        """Initialize IIIFAdmissionController object.
+
+        Keyword arguments:
+        max_pixels -- limit on the total decoded pixels in progress, 0 for no limit
+        max_bytes -- limit on the total estimated bytes in progress, 0 for no limit
+        wait -- maximum time in seconds that a request waits to be admitted
+        retry_after -- seconds for the Retry-After header of rejections
+        """
+        self.max_pixels = max_pixels
+        self.max_bytes = max_bytes
+        self.wait = wait
+        self.retry_after = retry_after
+        self.condition = threading.Condition()
+        self.pixels = 0
+        self.bytes = 0
+        self.in_flight = 0
+        self.num_admitted = 0
+        self.num_queued = 0
+        self.num_rejected = 0
+        self.logger = logging.getLogger(__name__)
+
+    def fits(self, pixels, nbytes):
+        """True if a request for pixels and nbytes may be admitted now."""
+        return (self.in_flight == 0 or
+                ((not self.max_pixels or self.pixels + pixels <= self.max_pixels) and
+                 (not self.max_bytes or self.bytes + nbytes <= self.max_bytes)))
+
+    def acquire(self, pixels, nbytes=0):
+        """Admit request for pixels and nbytes, waiting if necessary.
+
+        Raises IIIFError with code 503 if the request cannot be admitted
+        within self.wait seconds. Each successful call must be followed by
+        a call to release() with the same arguments.
+        """
+        with self.condition:
+            if (not self.fits(pixels, nbytes)):
+                self.num_queued += 1
+                deadline = time.time() + self.wait
+                while (not self.fits(pixels, nbytes)):
+                    remaining = deadline - time.time()
+                    if (remaining <= 0):
+                        self.num_rejected += 1
+                        self.logger.info("Rejected request for %d pixels with %d pixels in progress" %
+                                         (pixels, self.pixels))
+                        raise IIIFError(code=503, parameter='unknown',
+                                        text="Server busy, too many large images in progress\n",
+                                        headers={'Retry-After': str(self.retry_after)})
+                    self.condition.wait(remaining)
+            self.pixels += pixels
+            self.bytes += nbytes
+            self.in_flight += 1
+            self.num_admitted += 1
+
+    def release(self, pixels, nbytes=0):
+        """Release a request admitted by acquire()."""
+        with self.condition:
+            self.pixels -= pixels
+            self.bytes -= nbytes
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def metrics(self):
+        """Dict of current totals, limits and counts of requests."""
+        with self.condition:
+            return {'max_pixels': self.max_pixels,
+                    'max_bytes': self.max_bytes,
+                    'pixels': self.pixels,
+                    'bytes': self.bytes,
+                    'in_flight': self.in_flight,
+                    'admitted': self.num_admitted,
+                    'queued': self.num_queued,
+                    'rejected': self.num_rejected}
+
+
+# Classes of derivation in order of priority, the first two are
+# interactive (served from reserved slots) and the others bulk
+SCHEDULER_CLASSES = ('tile', 'thumbnail', 'crop', 'full')
+SCHEDULER_INTERACTIVE_CLASSES = ('tile', 'thumbnail')
+
+
+class IIIFPriorityScheduler(object):
+    """Limit concurrent derivations, serving cheap ones first.
+
+    There are slots derivations in progress at once. Waiting requests
+    are served in order of the priority of their class (see
+    SCHEDULER_CLASSES) and then in order of arrival, except that a request
+    that has waited longer than max_wait seconds goes ahead of all that
+    arrived after it, so that large requests are delayed but never
+    starved. Bulk ('crop' and 'full') requests may use at most bulk_slots
+    slots so that some are always free for interactive requests.
+
+    Typical use:
+
+        scheduler = IIIFPriorityScheduler(slots=4)
+        scheduler.acquire('tile')
+        try:
+            # .. derive image
+        finally:
+            scheduler.release('tile')
+
+    Thread safe.
+    """
+
+    def __init__(self, slots=4, bulk_slots=None, max_wait=10.0):
+        """Initialize IIIFPriorityScheduler object.
+
+        Keyword arguments:
+        slots -- number of derivations in progress at once
+        bulk_slots -- maximum number of bulk derivations in progress at
+                      once, defaults to one fewer than slots (at least 1)
+        max_wait -- time in seconds after which a waiting request is
+                    served ahead of later requests of higher priority
+        """
+        self.slots = slots
+        self.bulk_slots = bulk_slots if (bulk_slots is not None) else max(1, slots - 1)
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.seq = 0
+        self.active = dict((cls, 0) for cls in SCHEDULER_CLASSES)
+        self.served = dict((cls, 0) for cls in SCHEDULER_CLASSES)
+        self.num_promoted = 0
+        self.logger = logging.getLogger(__name__)
+
+    def eligible(self, cls):
+        """True if there is a free slot that a request of class cls may use."""
+        active = sum(self.active.values())
+        if (active >= self.slots):
+            return False
+        if (cls not in SCHEDULER_INTERACTIVE_CLASSES):
+            bulk = active - sum(self.active[c] for c in SCHEDULER_INTERACTIVE_CLASSES)
+            return bulk < self.bulk_slots
+        return True
+
+    def next_ticket(self):
+        """Waiting ticket to serve next, or None."""
+        candidates = [t for t in self.waiting if self.eligible(t[2])]
+        if (not candidates):
+            return None
+        aged = time.time() - self.max_wait
+        overdue = [t for t in candidates if t[3] <= aged]
+        if (overdue):
+            return min(overdue, key=lambda t: t[1])
+        return min(candidates)
+
+    def acquire(self, cls):
+        """Wait for a slot for a request of class cls (one of SCHEDULER_CLASSES)."""
+        with self.condition:
+            self.seq += 1
+            ticket = (SCHEDULER_CLASSES.index(cls), self.seq, cls, time.time())
+            self.waiting.append(ticket)
+            while (self.next_ticket() is not ticket):
+                self.condition.wait()
+            self.waiting.remove(ticket)
+            if (min(self.waiting + [ticket]) is not ticket):
+                self.num_promoted += 1
+            self.active[cls] += 1
+            self.served[cls] += 1
+            # another slot may still be free
+            self.condition.notify_all()
+
+    def release(self, cls):
+        """Release slot acquired for a request of class cls."""
+        with self.condition:
+            self.active[cls] -= 1
+            self.condition.notify_all()
+
+    def metrics(self):
+        """Dict of limits and of counts of requests by class."""
+        with self.condition:
+            waiting = dict((cls, 0) for cls in SCHEDULER_CLASSES)
+            for ticket in self.waiting:
+                waiting[ticket[2]] += 1
+            return {'slots': self.slots,
+                    'bulk_slots': self.bulk_slots,
+                    'active': dict(self.active),
+                    'waiting': waiting,
+                    'served': dict(self.served),
+                    'promoted': self.num_promoted}
@@ -0,0 +1,340 @@
+"""ASGI application for IIIF Image API servers (Python 3 only).
+
+Serves the Flask application created by create_testserver_flask_app()
+or create_reference_server_flask_app() from an asyncio event loop, so
+that many concurrent keep-alive connections do not each need an OS
+thread. Image information and image requests for prefixes without
+auth are handled on the event loop with IIIFHandler, up to the point
+where an image has to be derived. Derivation runs in a thread or
+process pool and the output is streamed from disk on the event loop.
+All other requests (index pages, auth, redirects) are passed to the
+Flask application in the thread pool.
+
+Typical use, with an ASGI server such as uvicorn:
+
+    app = IIIFASGIApp(create_testserver_flask_app(cfg), executor='process')
+    uvicorn.run(app, host='localhost', port=8000)
+"""
+
+import asyncio
+import concurrent.futures
+import io
+import logging
+import os
+import sys
+import tempfile
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_range_header
+from werkzeug.routing import RequestRedirect
+
+from flask import request
+
+from iiif.error import IIIFError
+from iiif.flask_utils import IIIFHandler
+
+# Types of pool in which images may be derived
+ASGI_EXECUTORS = ('thread', 'process')
+
+
+def derive_image(klass, api_version, srcfile, iiif, pyramid=None, deadline=None):
+    """Derive image for iiif from srcfile with a new klass manipulator.
+
+    Run in a worker process by IIIFASGIApp. The output is written to a
+    new temporary file which the caller must remove.
+
+    Returns (outfile, mime_type).
+    """
+    (fd, outfile) = tempfile.mkstemp(prefix='iiif_asgi_')
+    os.close(fd)
+    manipulator = klass(api_version=api_version)
+    if (pyramid is not None):
+        manipulator.pyramid = pyramid
+    try:
+        manipulator.derive(srcfile, iiif, outfile=outfile, deadline=deadline)
+        return (outfile, manipulator.mime_type)
+    except Exception:
+        os.remove(outfile)
+        raise
+    finally:
+        manipulator.cleanup()
+
+
+def byte_range(headers, response_headers, size):
+    """Byte range to send for request headers, or None for the whole file.
+
+    Positional arguments:
+    headers -- request headers
+    response_headers -- dict of response headers including any ETag
+                        and Last-Modified validators
+    size -- size of the file in bytes
+
+    Ignores Range headers that are not valid single byte ranges, and
+    Range headers with an If-Range header that matches neither validator
+    or when the ETag is weak.
+    Returns (start, stop) or False if the range is not satisfiable.
+    """
+    if ('Range' not in headers):
+        return None
+    if_range = headers.get('If-Range')
+    if (if_range is not None and
+            (response_headers.get('ETag', '').startswith('W/') or
+             if_range.strip() not in (response_headers.get('ETag'), response_headers.get('Last-Modified')))):
+        return None
+    requested = parse_range_header(headers['Range'])
+    if (requested is None or len(requested.ranges) != 1):
+        return None
+    return requested.range_for_length(size) or False
+
+
+def wsgi_environ(scope, body=b''):
+    """WSGI environ dict for the ASGI HTTP connection scope with request body."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {'REQUEST_METHOD': scope['method'],
+               'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+               'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+               'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+               'SERVER_NAME': server[0],
+               'SERVER_PORT': str(server[1]),
+               'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'wsgi.input': io.BytesIO(body),
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': False,
+               'wsgi.run_once': False}
+    if (scope.get('client')):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for (name, value) in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if (name not in ('CONTENT_TYPE', 'CONTENT_LENGTH')):
+            name = 'HTTP_' + name
+        if (name in environ):
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+class IIIFASGIApp(object):
+    """ASGI application wrapping a Flask IIIF server application."""
+
+    def __init__(self, app, executor='thread', workers=None, chunk_size=65536):
+        """Initialize IIIFASGIApp object.
+
+        Positional arguments:
+        app -- Flask application with handlers installed by add_handler()
+
+        Keyword arguments:
+        executor -- 'thread' or 'process', the type of pool in which to
+                    derive images. In processes, images are always derived
+                    from the source image, without coalescing concurrent
+                    requests or deriving from larger cached images
+        workers -- number of threads or processes, None for the default
+        chunk_size -- number of bytes per chunk when streaming images
+        """
+        if (executor not in ASGI_EXECUTORS):
+            raise ValueError("Unknown executor %s, must be one of %s" %
+                             (executor, ', '.join(ASGI_EXECUTORS)))
+        self.app = app
+        self.chunk_size = chunk_size
+        self.threads = concurrent.futures.ThreadPoolExecutor(workers)
+        self.processes = None
+        if (executor == 'process'):
+            self.processes = concurrent.futures.ProcessPoolExecutor(workers)
+        self.logger = logging.getLogger(__name__)
+
+    async def __call__(self, scope, receive, send):
+        """ASGI application interface."""
+        if (scope['type'] == 'lifespan'):
+            await self.lifespan(receive, send)
+        elif (scope['type'] == 'http'):
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """Handle lifespan protocol, shutting down pools at the end."""
+        while True:
+            message = await receive()
+            if (message['type'] == 'lifespan.startup'):
+                await send({'type': 'lifespan.startup.complete'})
+            elif (message['type'] == 'lifespan.shutdown'):
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def shutdown(self):
+        """Shut down thread and process pools."""
+        self.threads.shutdown(wait=False)
+        if (self.processes is not None):
+            self.processes.shutdown(wait=False)
+
+    async def http(self, scope, receive, send):
+        """Handle one HTTP request."""
+        body = b''
+        more_body = True
+        while (more_body):
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        environ = wsgi_environ(scope, body)
+        try:
+            adapter = self.app.url_map.bind_to_environ(environ)
+            (endpoint, values) = adapter.match()
+        except (HTTPException, RequestRedirect):
+            endpoint = None
+        if (endpoint == 'iiif_dispatcher'):
+            match = self.app.extensions['iiif_dispatcher'].resolve(values['iiif_path'])
+            (endpoint, values) = (match[0], match[2]) if (match) else (None, None)
+        if (scope['method'] == 'GET' and endpoint in ('iiif_info_handler', 'iiif_image_handler') and
+                values.get('auth') is None and values.get('config') is not None):
+            with self.app.request_context(environ):
+                i = IIIFHandler(values['prefix'], values['identifier'],
+                                values['config'], values['klass'], None)
+                try:
+                    if (endpoint == 'iiif_info_handler'):
+                        await self.send_response(send, i.image_information_response())
+                    else:
+                        await self.image_request(scope, send, i, values['path'])
+                except IIIFError as e:
+                    await self.send_response(send, i.error_response(e))
+            return
+        loop = asyncio.get_event_loop()
+        (status, headers, data) = await loop.run_in_executor(self.threads, self.wsgi, environ)
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(n.encode('latin-1'), v.encode('latin-1')) for (n, v) in headers]})
+        await send({'type': 'http.response.body', 'body': data})
+
+    async def image_request(self, scope, send, i, path):
+        """Respond to image request path with IIIFHandler i.
+
+        Parsing, validation and cache lookup are done here, only
+        derivation is done in the pool, after waiting for a scheduler slot
+        and admission as configured for the handler (see
+        IIIFHandler.reserve()). Single byte Range requests get
+        206 Partial Content responses. Raises IIIFError on error.
+        """
+        response = i.image_request_prepare(path)
+        if (response is not None):
+            await self.send_response(send, response)
+            return
+        tmp = None
+        try:
+            result = i.cached_derivative()
+            if (result is None):
+                loop = asyncio.get_event_loop()
+                if (self.processes is None):
+                    result = await loop.run_in_executor(self.threads, i.image_request_derive)
+                else:
+                    # waiting for scheduler slot and admission may block
+                    release = await loop.run_in_executor(self.threads, i.reserve)
+                    try:
+                        result = await loop.run_in_executor(
+                            self.processes, derive_image, i.klass, i.api_version,
+                            i.source_file, i.iiif, i.manipulator.pyramid if (i.config.klass_name == 'pil') else None,
+                            i.deadline)
+                    finally:
+                        release()
+                    tmp = result[0]
+                    if (i.derivative_cache is not None):
+                        cached = await loop.run_in_executor(
+                            self.threads, i.derivative_cache.put, i.derivative_key, tmp)
+                        if (cached is not None):
+                            result = (cached, result[1])
+            (outfile, mime_type) = result
+            i.add_compliance_header()
+            headers = dict(i.headers)
+            if (mime_type):
+                headers['Content-Type'] = mime_type
+            headers['Accept-Ranges'] = 'bytes'
+            size = os.path.getsize(outfile)
+            (status, start, stop) = (200, 0, size)
+            requested = byte_range(request.headers, headers, size)
+            if (requested is False):
+                headers['Content-Range'] = 'bytes */%d' % (size)
+                (status, stop) = (416, 0)
+            elif (requested is not None):
+                (start, stop) = requested
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+                status = 206
+            headers['Content-Length'] = str(stop - start)
+            zerocopy = 'http.response.zerocopysend' in (scope.get('extensions') or {})
+            await self.send_file(send, status, headers, outfile, start, stop, zerocopy)
+        finally:
+            # coalesced requests may share the temporary output of this
+            # handler's manipulator
+            if (i.single_flight is None):
+                i.manipulator.cleanup()
+            if (tmp is not None):
+                os.remove(tmp)
+            if (i.output_done is not None):
+                # temporary file from the handler's process pool
+                i.output_done()
+
+    async def send_response(self, send, response):
+        """Send Flask response object."""
+        await send({'type': 'http.response.start', 'status': response.status_code,
+                    'headers': [(n.encode('latin-1'), v.encode('latin-1'))
+                                for (n, v) in response.headers.to_wsgi_list()]})
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+
+    async def send_file(self, send, status, headers, path, start=0, stop=None, zerocopy=False):
+        """Send response with headers dict and bytes start to stop of file path.
+
+        If zerocopy is True then the open file is passed to the server with
+        the ASGI zero copy send extension, so that the server can send it
+        with sendfile(), otherwise it is read and sent in chunks.
+        """
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(n.encode('latin-1'), v.encode('latin-1'))
+                                for (n, v) in sorted(headers.items())]})
+        with open(path, 'rb') as fh:
+            if (stop is None):
+                stop = os.fstat(fh.fileno()).st_size
+            if (zerocopy):
+                await send({'type': 'http.response.zerocopysend', 'file': fh,
+                            'offset': start, 'count': stop - start})
+                return
+            fh.seek(start)
+            remaining = stop - start
+            while True:
+                data = fh.read(min(self.chunk_size, remaining))
+                remaining -= len(data)
+                more_body = (remaining > 0 and len(data) > 0)
+                await send({'type': 'http.response.body', 'body': data,
+                            'more_body': more_body})
+                if (not more_body):
+                    break
+
+    def wsgi(self, environ):
+        """Run the Flask application for environ.
+
+        Returns (status, headers, data).
+        """
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+        body = self.app(environ, start_response)
+        try:
+            data = b''.join(body)
+        finally:
+            if (hasattr(body, 'close')):
+                body.close()
+        return (response['status'], response['headers'], data)
+
+
+def run_asgi(app, cfg):
+    """Run Flask app with IIIFASGIApp in uvicorn, as configured in cfg.
+
+    Uses cfg.app_host, cfg.app_port, cfg.asgi_executor and cfg.asgi_workers.
+    """
+    try:
+        import uvicorn
+    except ImportError:
+        logging.critical("The uvicorn package is required to run an ASGI server, aborting")
+        sys.exit(1)
+    asgi_app = IIIFASGIApp(app, executor=cfg.asgi_executor, workers=cfg.asgi_workers)
+    uvicorn.run(asgi_app, host=cfg.app_host, port=cfg.app_port,
+                log_level=('debug' if cfg.debug else 'info' if cfg.verbose else 'warning'))
@@ -0,0 +1,460 @@
+"""Caches used to avoid repeated work in IIIF Image API servers.
+
+The IIIFNegativeCache remembers requests that have already failed
+(unknown identifiers, malformed request paths) so that repeats of
+the same bad request can be answered without touching the filesystem
+or creating a manipulator.
+
+The IIIFDerivativeCache stores derived images on disk in a directory
+tree that mirrors the (canonical) request URL paths, in the same way
+as the static files written by iiif.static.
+
+The IIIFSingleFlight class coalesces concurrent requests for the same
+derivation so that only one of them does the work.
+
+The IIIFPrefetcher runs low priority background jobs, such as deriving
+tiles that a viewer is likely to request next, without holding up
+requests that are being served.
+"""
+
+import copy
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+try:  # python3
+    import queue
+except ImportError:  # pragma: no cover # python2
+    import Queue as queue
+try:
+    import fcntl
+except ImportError:  # pragma: no cover # not available on Windows
+    fcntl = None
+
+# Output formats that may be stored in the derivative cache, the
+# file extension is used to recover the MIME type on a cache hit
+FORMAT_MIME_TYPES = {
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'gif': 'image/gif',
+    'tif': 'image/tiff'
+}
+
+
+class IIIFNegativeCache(object):
+    """Bounded, TTL-based cache of IIIFError objects for failed requests.
+
+    Entries are keyed by any hashable value (typically a tuple such as
+    ('identifier', identifier) or ('path', identifier, path)) and store
+    the IIIFError that was raised for that request. Once more than size
+    entries are held the least recently added entries are discarded, and
+    entries older than ttl seconds are ignored and removed on access.
+
+    Instances are safe to share between threads handling requests.
+    """
+
+    def __init__(self, size=1000, ttl=60, timer=None):
+        """Initialize IIIFNegativeCache object.
+
+        Keyword arguments:
+        size -- maximum number of entries to hold
+        ttl -- time to live of each entry in seconds
+        timer -- function returning the current time in seconds,
+                 defaults to time.time (override for testing)
+        """
+        self.size = size
+        self.ttl = ttl
+        self.timer = timer if (timer is not None) else time.time
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Number of entries currently held (including expired ones)."""
+        return len(self._entries)
+
+    def get(self, key):
+        """Return a copy of the IIIFError cached for key, else None.
+
+        A copy is returned so that each response raises its own exception
+        object, the cached error itself is never raised.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is None):
+                return None
+            (expires, error) = entry
+            if (expires <= self.timer()):
+                del self._entries[key]
+                return None
+        return copy.copy(error)
+
+    def add(self, key, error):
+        """Add IIIFError error to the cache for key.
+
+        Does nothing if the cache has zero size.
+        """
+        if (self.size <= 0):
+            return
+        with self._lock:
+            if (key in self._entries):
+                del self._entries[key]
+            self._entries[key] = (self.timer() + self.ttl, error)
+            while (len(self._entries) > self.size):
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+
+class IIIFDerivativeCache(object):
+    """Disk cache of derived images keyed by request path.
+
+    Keys are relative paths such as '2.1_pil/starfish/full/256,/0/default.jpg'
+    and should be built from canonical requests (see
+    IIIFManipulator.canonical_request()) so that equivalent requests share
+    one entry. Files are written atomically so that concurrent readers
+    never see a partially written entry.
+    """
+
+    def __init__(self, cache_dir):
+        """Initialize IIIFDerivativeCache object.
+
+        Positional arguments:
+        cache_dir -- base directory for cached files, created when the
+                     first file is written
+        """
+        self.cache_dir = cache_dir
+        self.logger = logging.getLogger(__name__)
+
+    def path(self, key):
+        """Local file path for key, None if key is not cacheable.
+
+        Keys must have a format extension listed in FORMAT_MIME_TYPES and
+        may not include empty, '.' or '..' path segments.
+        """
+        segs = key.split('/')
+        for seg in segs:
+            if (seg in ('', '.', '..')):
+                return None
+        if (self.mime_type(key) is None):
+            return None
+        return os.path.join(self.cache_dir, *segs)
+
+    def mime_type(self, path):
+        """MIME type for cached file path or key based on extension, else None."""
+        ext = os.path.splitext(path)[1].lstrip('.')
+        return FORMAT_MIME_TYPES.get(ext)
+
+    def children(self, key):
+        """Sorted list of names of the entries in the cache directory for key.
+
+        Here key is a key prefix such as '2.1_pil/starfish/full'. Returns []
+        if there are no entries, temporary files are not included.
+        """
+        segs = key.split('/')
+        for seg in segs:
+            if (seg in ('', '.', '..')):
+                return []
+        try:
+            names = os.listdir(os.path.join(self.cache_dir, *segs))
+        except OSError:
+            return []
+        return sorted([name for name in names if not name.startswith('.')])
+
+    def get(self, key, mtime=None):
+        """Return path of cached file for key, None if not cached.
+
+        If mtime is given then entries older than mtime (e.g. the
+        modification time of the source image) are ignored.
+        """
+        path = self.path(key)
+        if (path is None):
+            return None
+        try:
+            cached_mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        if (mtime is not None and cached_mtime < mtime):
+            return None
+        return path
+
+    def put(self, key, file):
+        """Copy file into the cache for key.
+
+        The copy is written to a temporary file in the destination directory
+        and then renamed into place. Returns the cached file path, or None if
+        key is not cacheable or the copy failed.
+        """
+        path = self.path(key)
+        if (path is None):
+            return None
+        tmp = None
+        try:
+            dir = os.path.dirname(path)
+            if (not os.path.isdir(dir)):
+                try:
+                    os.makedirs(dir)
+                except OSError:
+                    # may have been created by another thread/process
+                    if (not os.path.isdir(dir)):
+                        raise
+            (fd, tmp) = tempfile.mkstemp(dir=dir, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as fh:
+                with open(file, 'rb') as src:
+                    shutil.copyfileobj(src, fh)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            self.logger.warning("Failed to write cache file %s (%s)" % (path, str(e)))
+            if (tmp is not None and os.path.exists(tmp)):
+                os.remove(tmp)
+            return None
+        return path
+
+
+class _InFlightCall(object):
+    """Record of one in-flight call for IIIFSingleFlight."""
+
+    def __init__(self):
+        """Initialize with no result and only the leader as user."""
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.users = 1
+
+
+class IIIFSingleFlight(object):
+    """Coalesce concurrent calls with the same key onto a single call.
+
+    The first caller for a key (the leader) runs the function, any
+    other callers for the same key that arrive while it is in flight
+    wait and then share the leader's result, or get a copy of the
+    exception it raised.
+
+    If lock_dir is set then the leader also takes an exclusive lock on
+    a lock file for the key so that leaders in different processes are
+    serialized. The function should then check for a result written by
+    another process (e.g. in an IIIFDerivativeCache) before doing the
+    work itself. Lock files are not used where fcntl is not available.
+    """
+
+    def __init__(self, lock_dir=None, timeout=None):
+        """Initialize IIIFSingleFlight object.
+
+        Keyword arguments:
+        lock_dir -- directory for lock files to coordinate between processes,
+                    None to coordinate only between threads
+        timeout -- maximum time in seconds that a follower will wait for the
+                   leader before running the function itself, None to wait
+                   indefinitely
+        """
+        self.lock_dir = lock_dir
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) unless a call for key is already in flight.
+
+        Returns the result of the call, or of the call in flight.
+        """
+        return self.do_shared(key, None, fn, *args, **kwargs)[0]
+
+    def do_shared(self, key, cleanup, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) as do() for a result that must be cleaned up.
+
+        Returns (result, done) where done is a function that the caller
+        must call once it has finished with the result. When all callers
+        sharing a result have called done, cleanup(result) is called (e.g.
+        to remove a temporary file). cleanup may be None.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = (call is None)
+            if (leader):
+                call = _InFlightCall()
+                self._calls[key] = call
+            else:
+                call.users += 1
+
+        def done():
+            self._release(call, cleanup)
+        if (not leader):
+            if (call.done.wait(self.timeout)):
+                if (call.error is not None):
+                    raise copy.copy(call.error)
+                return (call.result, done)
+            # Leader is taking too long, go it alone
+            done()
+            alone = _InFlightCall()
+            alone.result = fn(*args, **kwargs)
+            alone.done.set()
+            return (alone.result, lambda: self._release(alone, cleanup))
+        try:
+            if (self.lock_dir is not None and fcntl is not None):
+                with self._file_lock(key):
+                    call.result = fn(*args, **kwargs)
+            else:
+                call.result = fn(*args, **kwargs)
+            return (call.result, done)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _release(self, call, cleanup):
+        """Release one user of call, cleaning up after the last."""
+        with self._lock:
+            call.users -= 1
+            last = (call.users == 0)
+        if (last and cleanup is not None and call.done.is_set() and call.error is None):
+            cleanup(call.result)
+
+    def lock_file(self, key):
+        """Path of lock file for key."""
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.lock'
+        return os.path.join(self.lock_dir, name)
+
+    def _file_lock(self, key):
+        """Context manager holding an exclusive lock on the lock file for key."""
+        return _FileLock(self.lock_file(key))
+
+
+class _FileLock(object):
+    """Exclusive fcntl lock on a file, for use as a context manager."""
+
+    def __init__(self, path):
+        """Initialize with path of lock file."""
+        self.path = path
+        self.fh = None
+
+    def __enter__(self):
+        """Open lock file (creating directory if necessary) and lock it."""
+        dir = os.path.dirname(self.path)
+        if (not os.path.isdir(dir)):
+            try:
+                os.makedirs(dir)
+            except OSError:
+                if (not os.path.isdir(dir)):
+                    raise
+        self.fh = open(self.path, 'a')
+        fcntl.flock(self.fh.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        """Unlock and close lock file."""
+        fcntl.flock(self.fh.fileno(), fcntl.LOCK_UN)
+        self.fh.close()
+        return False
+
+
+class IIIFPrefetcher(object):
+    """Run low priority jobs in background threads.
+
+    Jobs are held in a bounded queue and run by daemon worker threads that
+    are started when the first job is scheduled. A job is dropped rather
+    than queued if the queue is full or a job with the same key is already
+    queued, and is skipped when its turn comes if more than max_active
+    foreground requests are in progress, so that background work gives way
+    to real requests under load. Errors from jobs are logged and ignored.
+
+    Typical use:
+
+        with prefetcher.foreground():
+            # .. serve request
+        prefetcher.schedule(key, fn, arg1, arg2)
+    """
+
+    def __init__(self, queue_size=100, workers=1, max_active=1):
+        """Initialize IIIFPrefetcher object.
+
+        Keyword arguments:
+        queue_size -- maximum number of jobs waiting to run
+        workers -- number of worker threads
+        max_active -- maximum number of foreground requests in progress for
+                      which queued jobs will still be run
+        """
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.workers = workers
+        self.max_active = max_active
+        self.active = 0
+        self.logger = logging.getLogger(__name__)
+        self._keys = set()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def foreground(self):
+        """Context manager to count a foreground request as in progress."""
+        return _Foreground(self)
+
+    def schedule(self, key, fn, *args):
+        """Schedule call fn(*args) as a job identified by key.
+
+        Returns True if the job was queued, False if it was dropped.
+        """
+        with self._lock:
+            if (key in self._keys):
+                return False
+            while (len(self._threads) < self.workers):
+                t = threading.Thread(target=self._run)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+            self._keys.add(key)
+        try:
+            self.queue.put_nowait((key, fn, args))
+        except queue.Full:
+            with self._lock:
+                self._keys.discard(key)
+            return False
+        return True
+
+    def join(self):
+        """Wait until all queued jobs have been run or skipped."""
+        self.queue.join()
+
+    def _run(self):
+        """Worker thread loop."""
+        while True:
+            (key, fn, args) = self.queue.get()
+            try:
+                if (self.active > self.max_active):
+                    self.logger.debug("Skipped job %s under load" % (key))
+                else:
+                    fn(*args)
+            except Exception as e:
+                self.logger.warning("Background job %s failed (%s)" % (key, str(e)))
+            finally:
+                with self._lock:
+                    self._keys.discard(key)
+                self.queue.task_done()
+
+
+class _Foreground(object):
+    """Count of in-progress foreground request for IIIFPrefetcher."""
+
+    def __init__(self, prefetcher):
+        """Initialize with IIIFPrefetcher object."""
+        self.prefetcher = prefetcher
+
+    def __enter__(self):
+        """Increment count of active requests."""
+        with self.prefetcher._lock:
+            self.prefetcher.active += 1
+        return self
+
+    def __exit__(self, *exc):
+        """Decrement count of active requests."""
+        with self.prefetcher._lock:
+            self.prefetcher.active -= 1
+        return False
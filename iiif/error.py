@@ -132,3 +132,9 @@ class IIIFZeroSizeError(IIIFError):
     """Sub-class of IIIFError to indicate request for a zero-size image."""
 
     pass
+
+
+class IIIFDeadlineError(IIIFError):
+    """Sub-class of IIIFError to indicate derivation abandoned at deadline."""
+
+    pass
@@ -6,28 +6,69 @@ requested and is thus very slow.
 Simeon Warner - 2014--2020
 """
 
-from flask import Flask, request, make_response, redirect, abort, send_file, url_for, send_from_directory
+from flask import Flask, request, make_response, redirect, abort, url_for, send_from_directory, current_app
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.wsgi import wrap_file
 
 import base64
 import configargparse
+import copy
+import hashlib
 import json
 import logging
+import mimetypes
 import os
 import os.path
 import re
 from string import Template
 import sys
+import time
+from email.utils import formatdate, parsedate_tz, mktime_tz
 try:  # python3
-    from urllib.parse import urljoin, quote as urlquote
+    from urllib.parse import urljoin, quote as urlquote, unquote as urlunquote
     from urllib.request import parse_keqv_list, parse_http_list
 except ImportError:  # pragma: no cover # python2
     from urlparse import urljoin
-    from urllib import quote as urlquote
+    from urllib import quote as urlquote, unquote as urlunquote
     from urllib2 import parse_keqv_list, parse_http_list
 
+from iiif.admission import IIIFAdmissionController, IIIFPriorityScheduler
+from iiif.cache import IIIFNegativeCache, IIIFDerivativeCache, IIIFSingleFlight, IIIFPrefetcher, FORMAT_MIME_TYPES
 from iiif.error import IIIFError
 from iiif.request import IIIFRequest, IIIFRequestPathError, IIIFRequestBaseURI
 from iiif.info import IIIFInfo
+from iiif.static import static_tile, static_tile_neighbours
+from iiif.stream import IIIFStream
+
+
+# Types of response for which Cache-Control policies may be configured:
+#   tile - image requests for a region of the image
+#   size - image requests for the full region at any size
+#   info - image information (info.json) requests
+#   degraded - image requests for degraded images on auth prefixes
+#   error - error responses
+CACHE_CONTROL_TYPES = ('tile', 'size', 'info', 'degraded', 'error')
+
+# Rank of qualities by information content, an image may be derived
+# from a cached derivative of the same or higher rank
+QUALITY_RANKS = {'bitonal': 0, 'gray': 1, 'color': 2, 'default': 2, 'native': 2}
+
+# Formats of cached derivatives that can be scaled without loss from
+# repeated compression
+LOSSLESS_FORMATS = ('png', 'tif')
+
+# Maximum number of cached tiles to assemble for one image request
+MOSAIC_MAX_TILES = 64
+
+# Bytes per decoded pixel assumed for admission control (RGBA)
+ADMISSION_BYTES_PER_PIXEL = 4
+
+# Methods routed to IIIFDispatcher, which gives 404 and 405 responses
+DISPATCHER_METHODS = ['GET', 'HEAD', 'OPTIONS', 'POST', 'PUT', 'PATCH', 'DELETE',
+                      'TRACE', 'CONNECT']
+
+# Maximum width and height of images that are scheduled as thumbnails
+SCHEDULER_THUMBNAIL_SIZE = 1024
 
 
 class Config(object):
@@ -78,9 +119,18 @@ def identifiers(config):
             config.generator_dir - directory for generator code
             config.image_dir - directory for images
 
+    If config.identifier_index is set (see warm_app()) then the list is
+    kept there and the directory is only read again after it changes.
+
     Returns:
         ids - a list of ids
     """
+    index = getattr(config, 'identifier_index', None)
+    if (index is not None):
+        mtime = os.path.getmtime(config.generator_dir if (config.klass_name == 'gen')
+                                 else config.image_dir)
+        if (index.get('mtime') == mtime):
+            return list(index['ids'])
     ids = []
     if (config.klass_name == 'gen'):
         for generator in os.listdir(config.generator_dir):
@@ -96,6 +146,8 @@ def identifiers(config):
             if (ext in ['.jpg', '.png', '.tif'] and
                     os.path.isfile(os.path.join(config.image_dir, image_file))):
                 ids.append(iid)
+    if (index is not None):
+        index.update(mtime=mtime, ids=tuple(ids))
     return ids
 
 
@@ -104,7 +156,8 @@ def prefix_index_page(config):
 
     The prefix seen by the client is obtained from config.client_prefix
     as opposed to the local server prefix in config.prefix. Also uses
-    the identifiers(config) function to get identifiers available.
+    the identifiers(config) function to get identifiers available. The
+    page is kept in config.identifier_index, if set, until they change.
 
     Arguments:
         config - configuration object in which:
@@ -115,6 +168,11 @@ def prefix_index_page(config):
             config.auth_type - string for auth type
             config.include_osd - whether OSD is included
     """
+    index = getattr(config, 'identifier_index', None)
+    ids = identifiers(config)
+    page = index.get('page') if (index is not None) else None
+    if (page is not None and page[0] == tuple(ids)):
+        return page[1]
     title = "IIIF Image API services under %s" % (config.client_prefix)
     # details of this prefix handler
     body = '<p>\n'
@@ -123,7 +181,6 @@ def prefix_index_page(config):
     body += 'manipulator = %s<br/>\n' % (config.klass_name)
     body += 'auth_type = %s\n</p>\n' % (config.auth_type)
     # table of identifiers and example requests
-    ids = identifiers(config)
     api_version = config.api_version
     default = 'native' if api_version < '2.0' else 'default'
     body += '<table border="1">\n<tr><th align="left">Image identifier</th>'
@@ -151,7 +208,10 @@ def prefix_index_page(config):
                 body += '<td><a href="%s/osd.html">OSD</a></td>' % (base)
         body += "</tr>\n"
     body += "</table<\n"
-    return html_page(title, body)
+    page = html_page(title, body)
+    if (index is not None):
+        index['page'] = (tuple(ids), page)
+    return page
 
 
 def host_port_prefix(host, port, prefix):
@@ -211,12 +271,21 @@ class IIIFHandler(object):
         self.api_version = config.api_version
         self.auth = auth
         self.degraded = False
+        self.canonical = None
+        self.source_size = None
+        self.source_file = None
+        self.derivative_key = None
+        self.output_done = None
+        derive_timeout = getattr(config, 'derive_timeout', None)
+        self.deadline = (time.time() + derive_timeout) if (derive_timeout) else None
         self.logger = logging.getLogger('IIIFHandler')
         #
         # Create objects to process request
         self.iiif = IIIFRequest(api_version=self.api_version,
                                 identifier=self.identifier)
         self.manipulator = klass(api_version=self.api_version)
+        if (self.pyramid is not None and config.klass_name == 'pil'):
+            self.manipulator.pyramid = self.pyramid
         #
         # Set up auth object with locations if not already done
         if (self.auth and not self.auth.login_uri):
@@ -248,9 +317,24 @@ class IIIFHandler(object):
                                   'application/ld+json']) or mime_type
         return mime_type
 
+    @property
+    def negative_cache(self):
+        """IIIFNegativeCache for this handler's prefix, or None if not configured."""
+        return getattr(self.config, 'negative_cache', None)
+
     @property
     def file(self):
-        """Filename property for the source image for the current identifier."""
+        """Filename property for the source image for the current identifier.
+
+        Identifiers that are not found are recorded in the negative cache
+        (if configured) so that repeated requests for them raise the same
+        error without searching the filesystem again.
+        """
+        key = ('identifier', self.identifier)
+        if (self.negative_cache is not None):
+            e = self.negative_cache.get(key)
+            if (e is not None):
+                raise e
         file = None
         if (self.config.klass_name == 'gen'):
             for ext in ['.py']:
@@ -266,14 +350,146 @@ class IIIFHandler(object):
                     return file
         # failed, show list of available identifiers as error
         available = "\n ".join(identifiers(self.config))
-        raise IIIFError(code=404, parameter="identifier",
-                        text="Image resource '" + self.identifier + "' not found. Local resources available:" + available + "\n")
+        e = IIIFError(code=404, parameter="identifier",
+                      text="Image resource '" + self.identifier + "' not found. Local resources available:" + available + "\n")
+        if (self.negative_cache is not None):
+            self.negative_cache.add(key, e)
+        raise e
+
+    @property
+    def single_flight(self):
+        """IIIFSingleFlight to coalesce derivations, or None if not configured."""
+        return getattr(self.config, 'single_flight', None)
+
+    @property
+    def derivative_cache(self):
+        """IIIFDerivativeCache for this handler, or None if not configured."""
+        return getattr(self.config, 'derivative_cache', None)
+
+    @property
+    def pyramid(self):
+        """IIIFPyramidCache of source image levels, or None if not configured."""
+        return getattr(self.config, 'pyramid', None)
+
+    @property
+    def admission(self):
+        """IIIFAdmissionController shared by all handlers, or None if not configured."""
+        return getattr(self.config, 'admission', None)
+
+    @property
+    def scheduler(self):
+        """IIIFPriorityScheduler shared by all handlers, or None if not configured."""
+        return getattr(self.config, 'scheduler', None)
+
+    @property
+    def process_pool(self):
+        """IIIFProcessPool to derive images in, or None if not configured."""
+        return getattr(self.config, 'process_pool', None)
+
+    @property
+    def prefetcher(self):
+        """IIIFPrefetcher for neighbouring tiles, or None if not configured."""
+        return getattr(self.config, 'prefetcher', None)
+
+    def cache_key(self, canonical):
+        """Key in the derivative cache for canonical IIIFRequest.
+
+        The plan_key() if config.shared_cache is set and there is one,
+        else the request_key().
+        """
+        if (getattr(self.config, 'shared_cache', False)):
+            key = self.plan_key(canonical)
+            if (key is not None):
+                return key
+        return self.request_key(canonical)
+
+    def request_key(self, canonical):
+        """Key for canonical IIIFRequest from the prefix and request URL.
+
+        Uses the real (not degraded) identifier because degraded requests
+        are distinguished by their quality.
+        """
+        request = copy.copy(canonical)
+        return self.prefix.strip('/') + '/' + request.url(identifier=self.identifier)
+
+    def plan_key(self, canonical):
+        """Key for canonical IIIFRequest that does not depend on API version.
+
+        Built from the source file (self.manipulator.srcfile, of
+        self.source_size) and the operations applied to it rather than
+        the request URL: the encoder profile of the manipulator, region,
+        size as w,h, rotation, quality (native being the same as default)
+        and format. Requests that produce the same image from different
+        prefixes, e.g. /2.1_pil/ID/full/100,/0/default.jpg and
+        /3.0_pil/ID/full/100,75/0/default.jpg, thus have the same key.
+        Keys start with 'shared/' and have the same structure below the
+        region as request keys.
+
+        Returns None if the size cannot be expressed in pixels.
+        """
+        (width, height) = self.source_size
+        size = canonical_size(canonical.region, canonical.size, width, height)
+        if (size is None or canonical.format is None):
+            return None
+        source = hashlib.sha1(os.path.realpath(self.manipulator.srcfile).encode('utf-8')).hexdigest()
+        profile = re.sub(r'[^\w\-.]', '_', self.manipulator.encoder_profile)
+        quality = 'default' if (canonical.quality == 'native') else canonical.quality
+        return '/'.join(('shared', profile, source[:16], canonical.region, '%d,%d' % size,
+                         canonical.rotation, quality + '.' + canonical.format))
+
+    def add_link_header(self, uri, rel):
+        """Add a Link header value, appending to any existing Link header."""
+        link = '<' + uri + '>;rel="' + rel + '"'
+        if ('Link' in self.headers):
+            link = self.headers['Link'] + ', ' + link
+        self.headers['Link'] = link
 
     def add_compliance_header(self):
         """Add IIIF Compliance level header to response."""
         if (self.manipulator.compliance_uri is not None):
-            self.headers['Link'] = '<' + \
-                self.manipulator.compliance_uri + '>;rel="profile"'
+            self.add_link_header(self.manipulator.compliance_uri, 'profile')
+
+    def add_cache_control_header(self, response_type):
+        """Add Cache-Control header for response_type from configured policy.
+
+        Arguments:
+            response_type - one of CACHE_CONTROL_TYPES
+
+        Responses from prefixes with auth are always private unless they
+        are for degraded requests, which are public.
+        """
+        policy = getattr(self.config, 'cache_control_policy', None) or {}
+        if (self.auth and not self.degraded):
+            cache_control = 'private, no-store'
+        else:
+            cache_control = policy.get(response_type)
+        if (cache_control):
+            self.headers['Cache-Control'] = cache_control
+        elif ('Cache-Control' in self.headers):
+            del self.headers['Cache-Control']
+
+    def add_validators(self, etag, mtime):
+        """Add ETag and Last-Modified headers to response.
+
+        Arguments:
+            etag - quoted entity tag, W/ prefixed if weak
+            mtime - modification time of source in seconds since epoch
+        """
+        self.headers['ETag'] = etag
+        self.headers['Last-Modified'] = formatdate(mtime, usegmt=True)
+
+    def not_modified(self, etag, mtime):
+        """True if conditional request headers show the client copy is current.
+
+        Follows RFC7232 in that If-Modified-Since is ignored if there is an
+        If-None-Match header.
+        """
+        if ('If-None-Match' in request.headers):
+            return etag_matches(request.headers['If-None-Match'], etag)
+        if ('If-Modified-Since' in request.headers):
+            since = parse_http_date(request.headers['If-Modified-Since'])
+            return (since is not None and int(mtime) <= since)
+        return False
 
     def make_response(self, content, code=200, headers=None):
         """Wrapper around Flask.make_response which also adds any local headers."""
@@ -292,9 +508,54 @@ class IIIFHandler(object):
             self.identifier = dr
         else:
             self.logger.info("image_information: %s" % (self.identifier))
-        # get size
-        self.manipulator.srcfile = self.file
-        self.manipulator.do_first()
+        file = self.file
+        mtime = os.path.getmtime(file)
+        mime_type = self.json_mime_type
+        # info.json with auth services is not kept as it depends on auth state
+        bodies = getattr(self.config, 'info_bodies', None) if (not self.auth) else None
+        key = (self.iiif.identifier, mime_type)
+        body = bodies.get(key) if (bodies is not None) else None
+        if (body is not None and body[0] == mtime):
+            info_json = body[1]
+        else:
+            info_json = self.image_information(file, mtime)
+            if (bodies is not None and
+                    (key in bodies or len(bodies) < self.config.info_cache_size)):
+                bodies[key] = (mtime, info_json)
+        # Entity tag from the response itself as info.json depends on
+        # configuration and auth as well as the image
+        etag = make_etag(info_json, mime_type)
+        self.add_cache_control_header('info')
+        self.add_validators(etag, mtime)
+        if (self.not_modified(etag, mtime)):
+            return self.make_response('', 304)
+        return self.make_response(info_json, headers={"Content-Type": mime_type})
+
+    def read_source_size(self, file, mtime):
+        """Set srcfile, width and height of the manipulator for source image file.
+
+        The size is taken from config.info_sizes, if set (see warm_app())
+        and not older than mtime, so that the image is not opened.
+        Otherwise the manipulator's do_first() reads it and it is added to
+        config.info_sizes.
+
+        Returns (width, height).
+        """
+        self.manipulator.srcfile = file
+        sizes = getattr(self.config, 'info_sizes', None)
+        size = sizes.get(file) if (sizes is not None) else None
+        if (size is not None and size[0] == mtime):
+            (self.manipulator.width, self.manipulator.height) = size[1:]
+        else:
+            self.manipulator.do_first()
+            if (sizes is not None and
+                    (file in sizes or len(sizes) < self.config.info_cache_size)):
+                sizes[file] = (mtime, self.manipulator.width, self.manipulator.height)
+        return (self.manipulator.width, self.manipulator.height)
+
+    def image_information(self, file, mtime):
+        """Image information for source image file as info.json string."""
+        self.read_source_size(file, mtime)
         # most of info.json comes from config, a few things specific to image
         info = {'tile_height': self.config.tile_height,
                 'tile_width': self.config.tile_width,
@@ -318,16 +579,115 @@ class IIIFHandler(object):
         i.formats = ["jpg", "png"]  # FIXME - should come from manipulator
         if (self.auth):
             self.auth.add_services(i)
-
-        return self.make_response(i.as_json(),
-                                  headers={"Content-Type": self.json_mime_type})
+        return i.as_json()
 
     def image_request_response(self, path):
         """Parse image request and create response."""
+        response = self.image_request_prepare(path)
+        if (response is not None):
+            return response
+        cached = self.cached_derivative()
+        if (cached is None and self.streamable()):
+            return self.stream_response()
+        (outfile, mime_type) = cached or self.image_request_derive()
+        self.add_compliance_header()
+        response = self.file_response(outfile, mime_type)
+        if (cached is None and self.output_done is not None):
+            response.call_on_close(self.output_done)
+        return response
+
+    def image_request_head(self, path):
+        """Parse image request and create response to HEAD request.
+
+        The headers are worked out from the request and the source image
+        size without deriving the image, and without opening the source
+        image if its size is in config.info_sizes (see
+        image_request_prepare()). Content-Length is included only if the
+        image is in the derivative cache. If the manipulator does not
+        declare its output formats then the image is derived as for a GET
+        request.
+        """
+        response = self.image_request_prepare(path)
+        if (response is not None):
+            return response
+        headers = {}
+        if (self.derivative_cache is not None):
+            cached = self.derivative_cache.get(self.derivative_key,
+                                               os.path.getmtime(self.source_file))
+            if (cached is not None):
+                headers['Content-Type'] = self.derivative_cache.mime_type(cached)
+                headers['Content-Length'] = str(os.path.getsize(cached))
+                headers['Accept-Ranges'] = 'bytes'
+        formats = self.manipulator.output_formats
+        if (not headers and formats):
+            format = self.iiif.format or formats[0]
+            if (format not in formats or format not in FORMAT_MIME_TYPES):
+                raise IIIFError(code=415, parameter='format',
+                                text="Unsupported output file format (%s), only %s are supported." %
+                                (format, ','.join(formats)))
+            headers['Content-Type'] = FORMAT_MIME_TYPES[format]
+        if (not headers):
+            (outfile, mime_type) = self.image_request_derive()
+            self.add_compliance_header()
+            return self.file_response(outfile, mime_type)
+        self.add_compliance_header()
+        headers.update(self.headers)
+        # empty iterator body so that no Content-Length is added
+        return current_app.response_class(iter(()), headers=headers)
+
+    def file_response(self, path, mime_type=None):
+        """Response with the content of file path and local headers.
+
+        The open file is passed to the WSGI server's wsgi.file_wrapper, if
+        it has one, so that the server can send it with sendfile() rather
+        than reading it through Python. Range requests get 206 Partial
+        Content responses unless there is an If-Range header that does not
+        match the ETag or Last-Modified headers, or the ETag is weak.
+        """
+        if (mime_type is None):
+            mime_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        size = os.path.getsize(path)
+        fh = open(path, 'rb')
+        response = current_app.response_class(wrap_file(request.environ, fh),
+                                              mimetype=mime_type, headers=self.headers,
+                                              direct_passthrough=True)
+        response.content_length = size
+        environ = request.environ
+        if ('If-Range' in request.headers and
+                self.headers.get('ETag', '').startswith('W/')):
+            # If-Range requires a strong validator (RFC7233), send it all
+            environ = dict(environ)
+            environ.pop('HTTP_RANGE', None)
+        try:
+            return response.make_conditional(environ, accept_ranges=True,
+                                             complete_length=size)
+        except RequestedRangeNotSatisfiable:
+            response.close()
+            return self.make_response('', 416, {'Content-Range': 'bytes */%d' % (size)})
+
+    def image_request_prepare(self, path):
+        """Parse image request and do everything short of deriving the image.
+
+        Sets the validator and cache control headers and records the
+        source file, canonical request and derivative cache key for
+        cached_derivative() and image_request_derive(). The source image
+        is only opened, to read its size, if the size is not in
+        config.info_sizes (see read_source_size()) so that servers may run
+        this part separately from derivation and conditional requests may
+        be answered without decoding the image.
+
+        Returns a response if the request is answered without an image
+        (304 Not Modified), None otherwise. Raises IIIFError on error.
+        """
         # Parse the request in path
         if (len(path) > 1024):
             raise IIIFError(code=414,
                             text="URI Too Long: Max 1024 chars, got %d\n" % len(path))
+        key = ('path', self.identifier, path)
+        if (self.negative_cache is not None):
+            e = self.negative_cache.get(key)
+            if (e is not None):
+                raise e
         try:
             self.iiif.identifier = self.identifier
             self.iiif.parse_url(path)
@@ -335,9 +695,14 @@ class IIIFHandler(object):
             # Reraise as IIIFError with code=404 because we can't tell
             # whether there was an encoded slash in the identifier or
             # whether there was a bad number of path segments.
-            raise IIIFError(code=404, text=e.text)
+            e = IIIFError(code=404, text=e.text)
+            if (self.negative_cache is not None):
+                self.negative_cache.add(key, e)
+            raise e
         except IIIFError as e:
-            # Pass through
+            # Pass through, remembering client errors
+            if (self.negative_cache is not None and e.code < 500):
+                self.negative_cache.add(key, e)
             raise e
         except Exception as e:
             # Something completely unexpected => 500
@@ -354,8 +719,8 @@ class IIIFHandler(object):
             # Parsed request OK, attempt to fulfill
             self.logger.info("image_request: %s" % (self.identifier))
         file = self.file
-        self.manipulator.srcfile = file
-        self.manipulator.do_first()
+        mtime = os.path.getmtime(file)
+        (width, height) = self.read_source_size(file, mtime)
         if (self.api_version < '2.0' and
                 self.iiif.format is None and
                 'Accept' in request.headers):
@@ -370,19 +735,488 @@ class IIIFHandler(object):
             # instead?
             if (accept in formats):
                 self.iiif.format = formats[accept]
-        (outfile, mime_type) = self.manipulator.derive(file, self.iiif)
-        # FIXME - find efficient way to serve file with headers
-        # could this be the answer: https://stackoverflow.com/questions/31554680/how-to-send-header-in-flask-send-file
-        # currently no headers are sent with the file
+        self.manipulator.request = self.iiif
+        canonical = self.manipulator.canonical_request()
+        self.canonical = canonical
+        self.source_size = (width, height)
+        if (getattr(self.config, 'canonical_link_header', False)):
+            self.add_link_header(self.server_and_prefix + '/' + canonical.url(), 'canonical')
+        key = self.cache_key(canonical)
+        # Validators depend only on the source and the normalized request so
+        # conditional requests are answered without decoding the image
+        etag = make_etag(file, repr(mtime), self.request_key(canonical),
+                         self.manipulator.encoder_profile)
+        if (self.weak_validators()):
+            etag = 'W/' + etag
+        self.add_validators(etag, mtime)
+        if (self.degraded):
+            self.add_cache_control_header('degraded')
+        elif (canonical.region == 'full'):
+            self.add_cache_control_header('size')
+        else:
+            self.add_cache_control_header('tile')
+        self.source_file = file
+        self.derivative_key = key
+        if (self.not_modified(etag, mtime)):
+            self.add_compliance_header()
+            return self.make_response('', 304)
+        return None
+
+    def weak_validators(self):
+        """True if the image may be derived from something other than the source.
+
+        When images may be derived from a cached larger image (see
+        larger_derivative()), assembled from cached tiles (see mosaic())
+        or read from a reduced resolution level of the source (see
+        build_pyramid()) the bytes sent for a request depend on what has
+        been cached or built, so the ETag is weak and If-Range is not
+        honoured.
+        """
+        klass_name = self.config.klass_name
+        if (self.pyramid is not None and klass_name == 'pil'):
+            return True
+        if (self.derivative_cache is None):
+            return False
+        return bool((getattr(self.config, 'derive_from_cache_factor', None) and
+                     klass_name != 'gen') or
+                    (getattr(self.config, 'mosaic', False) and klass_name == 'pil'))
+
+    def cached_derivative(self):
+        """Cached image for the request prepared by image_request_prepare().
+
+        Returns (outfile, mime_type) from the derivative cache, or None if
+        there is no cached image or no cache.
+        """
+        if (self.derivative_cache is None):
+            return None
+        file = self.source_file
+        cached = self.derivative_cache.get(self.derivative_key, os.path.getmtime(file))
+        if (cached is None):
+            return None
+        self.logger.info("image_request: cache hit %s" % (self.derivative_key))
+        (width, height) = self.source_size
+        self.prefetch(file, self.canonical, width, height)
+        return (cached, self.derivative_cache.mime_type(cached))
+
+    def image_request_derive(self):
+        """Derive image for the request prepared by image_request_prepare().
+
+        If a scheduler is configured then the derivation waits for a slot
+        according to its cost_class(). If admission control is configured
+        then the derivation must then be admitted, IIIFError with code 503
+        is raised if it is not.
+
+        Returns (outfile, mime_type).
+        """
+        file = self.source_file
+        key = self.derivative_key
+        (width, height) = self.source_size
+        release = self.reserve()
+        try:
+            if (self.prefetcher is not None):
+                with self.prefetcher.foreground():
+                    (outfile, mime_type) = self.coalesced_derive(file, key)
+                self.prefetch(file, self.canonical, width, height)
+            else:
+                (outfile, mime_type) = self.coalesced_derive(file, key)
+        finally:
+            release()
+        self.build_pyramid(file)
+        return (outfile, mime_type)
+
+    def reserve(self):
+        """Wait for scheduler slot and admission for the prepared request.
+
+        Raises IIIFError with code 503 if the request is not admitted.
+        Returns a function to call once the derivation is complete.
+        """
+        scheduler = self.scheduler
+        admission = self.admission
+        if (scheduler is not None):
+            cost_class = self.cost_class()
+            scheduler.acquire(cost_class)
+        try:
+            if (admission is not None):
+                (pixels, nbytes) = self.decode_estimate()
+                admission.acquire(pixels, nbytes)
+        except Exception:
+            if (scheduler is not None):
+                scheduler.release(cost_class)
+            raise
+
+        def release():
+            if (admission is not None):
+                admission.release(pixels, nbytes)
+            if (scheduler is not None):
+                scheduler.release(cost_class)
+        return release
+
+    def streamable(self):
+        """True if the prepared request should be answered by stream_response().
+
+        Streaming is configured with config.stream_min_pixels, the minimum
+        number of pixels in the output image. It is used only when the
+        manipulator supports it, for requests without a Range header, and
+        when derivatives are not cached, coalesced or derived in a process
+        pool because then the output must be a file.
+        """
+        min_pixels = getattr(self.config, 'stream_min_pixels', None)
+        if (min_pixels is None or not self.manipulator.streamable or
+                self.derivative_cache is not None or self.single_flight is not None or
+                self.process_pool is not None or 'Range' in request.headers):
+            return False
+        (width, height) = self.source_size
+        canonical = self.canonical
+        size = canonical_size(canonical.region, canonical.size, width, height)
+        return (size is None or size[0] * size[1] >= min_pixels)
+
+    def stream_response(self):
+        """Response streaming the image derived for the prepared request.
+
+        The image is derived in a separate thread with its encoder writing
+        into an IIIFStream which is the response body, so the response has
+        no Content-Length and is sent as it is encoded. Errors before the
+        encoder has written anything are raised here as usual, later
+        errors end the response early.
+        """
+        release = self.reserve()
+        stream = IIIFStream()
+
+        def derive():
+            try:
+                self.manipulator.derive(self.source_file, self.iiif, outfile=stream,
+                                        deadline=self.deadline)
+                stream.finish()
+            except Exception as e:
+                self.logger.warning("image_request: stream failed (%s)" % (str(e)))
+                stream.finish(e)
+            finally:
+                release()
+                self.manipulator.cleanup()
+                self.build_pyramid(self.source_file)
+        stream.start(derive)
+        stream.wait()
         self.add_compliance_header()
-        return self.make_response(send_file(outfile, mimetype=mime_type))
+        return current_app.response_class(stream, mimetype=self.manipulator.mime_type,
+                                          headers=self.headers, direct_passthrough=True)
+
+    def cost_class(self):
+        """Class of self.canonical for scheduling, one of SCHEDULER_CLASSES.
+
+        Requests for part of the image no larger than a tile are 'tile',
+        other requests no larger than SCHEDULER_THUMBNAIL_SIZE in both
+        dimensions are 'thumbnail', and larger requests are 'crop' or
+        'full' depending on the region.
+        """
+        (width, height) = self.source_size
+        canonical = self.canonical
+        size = canonical_size(canonical.region, canonical.size, width, height)
+        tile_size = max(getattr(self.config, 'tile_width', None) or 0,
+                        getattr(self.config, 'tile_height', None) or 0)
+        if (size is not None and canonical.region != 'full' and max(size) <= tile_size):
+            return 'tile'
+        if (size is not None and max(size) <= SCHEDULER_THUMBNAIL_SIZE):
+            return 'thumbnail'
+        if (canonical.region != 'full'):
+            return 'crop'
+        return 'full'
+
+    def decode_estimate(self):
+        """Estimated (pixels, bytes) needed to derive self.canonical.
+
+        The pixels are those of the requested region of the source image,
+        the bytes allow for both the decoded region and the output image.
+        Regions that are not in whole pixels are assumed to be the whole
+        image.
+        """
+        (width, height) = self.source_size
+        canonical = self.canonical
+        region = canonical_size(canonical.region, 'max', width, height) or (width, height)
+        size = canonical_size(canonical.region, canonical.size, width, height) or region
+        pixels = region[0] * region[1]
+        return (pixels, (pixels + size[0] * size[1]) * ADMISSION_BYTES_PER_PIXEL)
+
+    def coalesced_derive(self, file, key, iiif=None):
+        """Call self.derive(), via IIIFSingleFlight if configured.
+
+        The output of derivations for the request in a process pool is a
+        temporary file if there is no derivative cache. Then
+        self.output_done is set to a function to call once the output has
+        been sent, which removes the file when it is no longer needed by
+        this or any coalesced request.
+        """
+        temporary = (iiif is None and self.process_pool is not None and
+                     self.derivative_cache is None)
+        if (self.single_flight is None):
+            result = self.derive(file, key, iiif)
+            if (temporary):
+                self.output_done = lambda: os.remove(result[0])
+            return result
+        if (not temporary):
+            return self.single_flight.do(key, self.derive, file, key, iiif)
+        (result, self.output_done) = self.single_flight.do_shared(
+            key, lambda result: os.remove(result[0]), self.derive, file, key, iiif)
+        return result
+
+    def derive(self, file, key=None, iiif=None):
+        """Derive image for self.iiif, or iiif if given, from source file.
+
+        If there is a derivative cache then the result is stored under
+        key. Before deriving, the cache is checked again in case the
+        image has been written by another process while this request was
+        waiting for it (see IIIFSingleFlight). Requests given in iiif are
+        derived with a new manipulator and the output is kept only in
+        the cache (used for prefetching).
+
+        Returns (outfile, mime_type).
+        """
+        if (self.derivative_cache is not None):
+            cached = self.derivative_cache.get(key, os.path.getmtime(file))
+            if (cached is not None):
+                return (cached, self.derivative_cache.mime_type(cached))
+        if (iiif is not None):
+            if (self.process_pool is not None):
+                (outfile, mime_type) = self.pool_derive(file, iiif)
+                try:
+                    return (self.derivative_cache.put(key, outfile), mime_type)
+                finally:
+                    os.remove(outfile)
+            manipulator = self.klass(api_version=self.api_version)
+            try:
+                (outfile, mime_type) = manipulator.derive(file, iiif)
+                return (self.derivative_cache.put(key, outfile), mime_type)
+            finally:
+                manipulator.cleanup()
+        mosaic = None
+        source = self.larger_derivative(file)
+        if (source is None):
+            source = self.mosaic(file)
+            mosaic = source
+        try:
+            if (source is not None):
+                self.logger.info("image_request: deriving from cached %s" % (source[0]))
+            else:
+                source = (file, self.iiif)
+            if (self.process_pool is not None):
+                (outfile, mime_type) = self.pool_derive(*source, deadline=self.deadline)
+            else:
+                (outfile, mime_type) = self.manipulator.derive(*source, deadline=self.deadline)
+        finally:
+            if (mosaic is not None):
+                os.remove(mosaic[0])
+        if (self.derivative_cache is not None):
+            cached = self.derivative_cache.put(key, outfile)
+            if (self.process_pool is not None and cached is not None):
+                os.remove(outfile)
+                outfile = cached
+        return (outfile, mime_type)
+
+    def pool_derive(self, file, iiif, deadline=None):
+        """Derive image for iiif from file in self.process_pool.
+
+        The deadline is that of the request for the image, None for
+        background derivations (prefetching) which are not part of
+        any request.
+
+        Returns (outfile, mime_type) where outfile is a new temporary file.
+        """
+        pyramid = self.pyramid if (self.config.klass_name == 'pil') else None
+        return self.process_pool.derive(self.klass, self.api_version, file, iiif,
+                                        pyramid=pyramid, deadline=deadline)
+
+    def larger_derivative(self, file):
+        """Find a cached derivative from which to derive self.canonical.
+
+        Looks in the derivative cache for unrotated images of the same region
+        as self.canonical and of the same or richer quality that are at least
+        config.derive_from_cache_factor times larger in both dimensions (or
+        at least as large for lossless formats), so that the loss from
+        scaling an already compressed image is small. The smallest such image
+        is used because it is the cheapest to decode.
+
+        Returns (path, iiif) where iiif is the IIIFRequest to apply to the
+        cached image at path, or None if there is no suitable image or this
+        is not configured.
+        """
+        factor = getattr(self.config, 'derive_from_cache_factor', None)
+        canonical = self.canonical
+        if (not factor or self.derivative_cache is None or canonical is None or
+                self.config.klass_name == 'gen' or canonical.format is None or
+                canonical.quality not in QUALITY_RANKS):
+            return None
+        (width, height) = self.source_size
+        target = canonical_size(canonical.region, canonical.size, width, height)
+        if (target is None):
+            return None
+        mtime = os.path.getmtime(file)
+        own_key = self.cache_key(canonical)
+        base = own_key.rsplit('/', 3)[0]
+        best = None
+        for size_dir in self.derivative_cache.children(base):
+            size = canonical_size(canonical.region, urlunquote(size_dir), width, height)
+            if (size is None or size[0] < target[0] or size[1] < target[1]):
+                continue
+            for name in self.derivative_cache.children(base + '/' + size_dir + '/0'):
+                (quality, ext) = os.path.splitext(name)
+                min_factor = 1 if (ext.lstrip('.') in LOSSLESS_FORMATS) else factor
+                if (QUALITY_RANKS.get(quality, -1) < QUALITY_RANKS[canonical.quality] or
+                        size[0] < target[0] * min_factor or
+                        size[1] < target[1] * min_factor):
+                    continue
+                key = '/'.join((base, size_dir, '0', name))
+                path = self.derivative_cache.get(key, mtime) if (key != own_key) else None
+                if (path is not None and (best is None or size[0] * size[1] < best[0])):
+                    best = (size[0] * size[1], path)
+        if (best is None):
+            return None
+        iiif = IIIFRequest(api_version=self.api_version, identifier=self.iiif.identifier)
+        iiif.parse_url("full/%d,%d/%s/%s.%s" % (target[0], target[1], canonical.rotation,
+                                                canonical.quality, canonical.format))
+        return (best[1], iiif)
+
+    def mosaic(self, file):
+        """Assemble the region of self.canonical from cached tiles.
+
+        Uses tiles from the grid described in info.json, in the default
+        quality, at the largest scale factor that has at least the
+        resolution of the requested image. If all of the tiles covering
+        the region are in the derivative cache then they are composited,
+        cropped and resampled to the requested size in a temporary file.
+        Requires config.mosaic to be set and the PIL manipulator.
+
+        Returns (path, iiif) where iiif is the IIIFRequest to apply to the
+        temporary file at path, which the caller must remove, or None.
+        """
+        canonical = self.canonical
+        if (not getattr(self.config, 'mosaic', False) or self.derivative_cache is None or
+                canonical is None or self.config.klass_name != 'pil' or
+                canonical.format is None or canonical.region == 'full'):
+            return None
+        (width, height) = self.source_size
+        target = canonical_size(canonical.region, canonical.size, width, height)
+        grid = self.tile_grid(width, height)
+        if (target is None or grid is None):
+            return None
+        (tilesize, scale_factors) = grid
+        (x, y, rw, rh) = [int(v) for v in canonical.region.split(',')]
+        sf = 1
+        for f in sorted(scale_factors):
+            if (rw / float(f) >= target[0] and rh / float(f) >= target[1]):
+                sf = f
+        rts = tilesize * sf
+        (c0, c1) = (x // rts, (x + rw - 1) // rts)
+        (r0, r1) = (y // rts, (y + rh - 1) // rts)
+        if ((c1 - c0 + 1) * (r1 - r0 + 1) > MOSAIC_MAX_TILES):
+            return None
+        mtime = os.path.getmtime(file)
+        formats = [canonical.format] + [f for f in ('jpg', 'png') if f != canonical.format]
+        tiles = []
+        for col in range(c0, c1 + 1):
+            for row in range(r0, r1 + 1):
+                (r, s) = static_tile(col * rts, row * rts, sf, width, height, tilesize)
+                for format in formats:
+                    (key, iiif) = self.tile_request(r, s, self.iiif.default_quality,
+                                                    format, width, height)
+                    path = self.derivative_cache.get(key, mtime)
+                    if (path is not None):
+                        break
+                else:
+                    return None
+                tiles.append((path, ((col - c0) * tilesize, (row - r0) * tilesize)))
+        # composite size from the last tile in each direction
+        size = ((c1 - c0) * tilesize + s[0], (r1 - r0) * tilesize + s[1])
+        box = ((x - c0 * rts) / float(sf), (y - r0 * rts) / float(sf),
+               (x + rw - c0 * rts) / float(sf), (y + rh - r0 * rts) / float(sf))
+        self.logger.info("image_request: assembling %d tiles at scale factor %d" % (len(tiles), sf))
+        tmp = self.manipulator.mosaic(tiles, size, box, target)
+        iiif = IIIFRequest(api_version=self.api_version, identifier=self.iiif.identifier)
+        iiif.parse_url("full/%d,%d/%s/%s.%s" % (target[0], target[1], canonical.rotation,
+                                                canonical.quality, canonical.format))
+        return (tmp, iiif)
+
+    def build_pyramid(self, file):
+        """Schedule building levels of source image file if not already built."""
+        if (self.pyramid is not None and self.config.klass_name == 'pil' and
+                not self.pyramid.levels(file)):
+            self.config.pyramid_builder.schedule(file, self.pyramid.build, file)
+
+    def prefetch(self, file, canonical, width, height):
+        """Schedule derivation of tiles likely to be requested after canonical.
+
+        If canonical is a tile in the grid described in info.json for a
+        source image of width by height pixels, then the adjacent tiles and
+        the parent tile that are not already in the derivative cache are
+        scheduled for derivation with the prefetcher. Does nothing unless
+        both the prefetcher and derivative cache are configured, or for
+        degraded requests.
+        """
+        if (self.prefetcher is None or self.derivative_cache is None or
+                self.degraded or canonical.region == 'full' or
+                canonical.rotation != '0' or canonical.format is None):
+            return
+        grid = self.tile_grid(width, height)
+        # canonical size may be full or max for tiles at scale factor 1
+        size = canonical_size(canonical.region, canonical.size, width, height)
+        if (grid is None or size is None):
+            return
+        region = [int(v) for v in canonical.region.split(',')]
+        (tilesize, scale_factors) = grid
+        mtime = os.path.getmtime(file)
+        for (r, s) in static_tile_neighbours(region, size[0], width, height, tilesize, scale_factors):
+            (key, iiif) = self.tile_request(r, s, canonical.quality, canonical.format, width, height)
+            if (self.derivative_cache.get(key, mtime) is None):
+                self.prefetcher.schedule(key, self.coalesced_derive, file, key, iiif)
+
+    def tile_grid(self, width, height):
+        """Tile size and scale factors advertised in info.json.
+
+        Returns (tilesize, scale_factors) for a source image of width by
+        height pixels, or None if the configuration does not describe a
+        grid of square tiles.
+        """
+        tilesize = getattr(self.config, 'tile_width', None)
+        if (not tilesize or tilesize != getattr(self.config, 'tile_height', None)):
+            return None
+        try:
+            if ('auto' in self.config.scale_factors):
+                manipulator = self.klass(api_version=self.api_version)
+                (manipulator.width, manipulator.height) = (width, height)
+                scale_factors = manipulator.scale_factors(tilesize)
+            else:
+                scale_factors = [int(sf) for sf in self.config.scale_factors]
+        except ValueError:
+            return None
+        return (tilesize, scale_factors)
+
+    def tile_request(self, region, size, quality, format, width, height):
+        """Request for one tile of a source image of width by height pixels.
+
+        Arguments:
+            region - [rx,ry,rw,rh] region of tile
+            size - [sw,sh] size of tile
+            quality, format - quality and format of tile
+
+        Returns (key, iiif) where key is the derivative cache key and iiif
+        is the parsed IIIFRequest for the tile.
+        """
+        iiif = IIIFRequest(api_version=self.api_version, identifier=self.iiif.identifier)
+        iiif.parse_url("%d,%d,%d,%d/%d,%d/0/%s.%s" % (region[0], region[1], region[2], region[3],
+                                                      size[0], size[1], quality, format))
+        manipulator = self.klass(api_version=self.api_version)
+        manipulator.request = iiif
+        return (self.cache_key(manipulator.canonical_request(width, height)), iiif)
 
     def error_response(self, e):
         """Make response for an IIIFError e.
 
-        Also add compliance header.
+        Also add compliance and cache control headers. Any validators
+        set for the image are removed because they do not describe the
+        error.
         """
+        for header in ('ETag', 'Last-Modified'):
+            self.headers.pop(header, None)
         self.add_compliance_header()
+        self.add_cache_control_header('error')
         return self.make_response(*e.image_server_response(self.api_version))
 
 
@@ -423,6 +1257,8 @@ def iiif_image_handler(prefix=None, identifier=None,
             logging.debug("Authorized for image %s" % identifier)
         i = IIIFHandler(prefix, identifier, config, klass, auth)
         try:
+            if (request.method == 'HEAD'):
+                return i.image_request_head(path)
             return i.image_request_response(path)
         except IIIFError as e:
             return i.error_response(e)
@@ -444,6 +1280,157 @@ def degraded_request(identifier):
     return False
 
 
+class IIIFDispatcher(object):
+    """Route table from URL path prefixes to IIIF handlers.
+
+    add_handler() adds each handler to the IIIFDispatcher of the app,
+    which is the view for a single URL rule, instead of adding URL rules
+    for each handler. The handler for a request is found with a table
+    lookup of the prefix of the path and the rest of the path is then
+    parsed, so routing does not get slower as more handlers are added.
+    The URL space and responses are the same as with separate rules:
+
+      PREFIX -- prefix_index_page
+      PREFIX/ -- redirect to PREFIX
+      PREFIX/ID/info.json -- iiif_info_handler, options_handler for OPTIONS
+      PREFIX/ID/osd.html -- osd_page_handler if config.include_osd
+      PREFIX/ID/PATH -- iiif_image_handler, GET and HEAD only
+      PREFIX/ID, PREFIX/ID/ -- redirect to PREFIX/ID/info.json
+      PREFIX/login etc. -- auth handlers, at the client prefix
+
+    Paths with repeated slashes are redirected to the path with single
+    slashes if that has a handler. Other URL rules of the app take
+    precedence.
+    """
+
+    def __init__(self):
+        """Initialize IIIFDispatcher object with no handlers."""
+        self.handlers = {}
+        self.depths = []
+
+    def add(self, prefix, params=None, routes=None):
+        """Add handler at prefix.
+
+        Positional arguments:
+        prefix -- path prefix of the handler, may include slashes
+
+        Keyword arguments:
+        params -- dict of arguments for the views, config, klass, auth
+                  and prefix (as for URL rule defaults)
+        routes -- dict of views by NAME, called with params for
+                  PREFIX/NAME, instead of the IIIF handler views
+
+        Returns False, without changing the table, if prefix already has
+        an IIIF handler or any of the routes.
+        """
+        prefix = prefix.strip('/')
+        handler = self.handlers.setdefault(prefix, {'params': None, 'routes': {}})
+        if (routes is None):
+            if (handler['params'] is not None):
+                return False
+            handler['params'] = params
+        else:
+            if (set(routes) & set(handler['routes'])):
+                return False
+            for (name, view) in routes.items():
+                handler['routes'][name] = (view, params)
+        depth = len(prefix.split('/'))
+        if (depth not in self.depths):
+            # longest prefixes first
+            self.depths = sorted(self.depths + [depth], reverse=True)
+        return True
+
+    def resolve(self, path):
+        """Find view for path.
+
+        Positional arguments:
+        path -- URL path without the leading slash
+
+        Returns (endpoint, view, values) where view(**values) responds to
+        a GET request and endpoint is the name of the view, or None if
+        there is no IIIF handler for path.
+        """
+        parts = path.split('/')
+        for depth in self.depths:
+            if (len(parts) < depth):
+                continue
+            handler = self.handlers.get('/'.join(parts[:depth]))
+            if (handler is not None):
+                break
+        else:
+            return None
+        rest = parts[depth:]
+        params = handler['params']
+        if (len(rest) == 1 and rest[0] in handler['routes']):
+            (view, values) = handler['routes'][rest[0]]
+            return (view.__name__, view, dict(values or {}))
+        if (params is None):
+            return None
+        if (rest == []):
+            return ('prefix_index_page', prefix_index_page, {'config': params['config']})
+        if (rest == ['']):
+            return ('redirect', path_redirect, {'location': '/' + '/'.join(parts[:depth]),
+                                                'keep_query': True})
+        identifier = rest[0]
+        if (identifier == ''):
+            return None
+        values = dict(params, identifier=identifier)
+        if (rest[1:] in ([], [''])):
+            client_base = urljoin('/', params['prefix'] + '/')
+            return ('redirect', path_redirect, {'location': client_base + identifier + '/info.json'})
+        if (rest[1:] == ['info.json']):
+            return ('iiif_info_handler', iiif_info_handler, values)
+        if (rest[1:] == ['osd.html'] and params['config'].include_osd):
+            return ('osd_page_handler', osd_page_handler, values)
+        values['path'] = '/'.join(rest[1:])
+        return ('iiif_image_handler', iiif_image_handler, values)
+
+    def __call__(self, iiif_path):
+        """Flask view, respond to request for iiif_path with any method."""
+        path = re.sub('/+', '/', iiif_path)
+        match = self.resolve(path)
+        if (match is None):
+            abort(404)
+        (endpoint, view, values) = match
+        methods = ['GET', 'HEAD'] if (endpoint == 'iiif_image_handler') else ['GET', 'HEAD', 'OPTIONS']
+        if (request.method not in methods):
+            abort(405, valid_methods=methods)
+        if (path != iiif_path):
+            return path_redirect('/' + path, keep_query=True)
+        if (request.method == 'OPTIONS' and endpoint != 'redirect'):
+            if (endpoint == 'iiif_info_handler'):
+                return options_handler(**values)
+            response = current_app.response_class()
+            response.allow.update(methods)
+            return response
+        return view(**values)
+
+
+def path_redirect(location, keep_query=False):
+    """Handler to redirect to location, a path on this server.
+
+    The query string of the request is added if keep_query is True.
+    """
+    url = request.url_root + urlquote(location.lstrip('/'), safe="/:@!$&'()*+,;=")
+    if (keep_query and request.query_string):
+        url += '?' + request.query_string.decode('latin-1')
+    return redirect(url, 308)
+
+
+def admission_metrics_handler(admission=None):
+    """Handler for JSON metrics of the admission controller."""
+    return make_response(json.dumps(admission.metrics(), sort_keys=True), 200,
+                         {'Content-Type': 'application/json',
+                          'Cache-Control': 'no-store'})
+
+
+def scheduler_metrics_handler(scheduler=None):
+    """Handler for JSON metrics of the derivation scheduler."""
+    return make_response(json.dumps(scheduler.metrics(), sort_keys=True), 200,
+                         {'Content-Type': 'application/json',
+                          'Cache-Control': 'no-store'})
+
+
 def options_handler(**args):
     """Handler to respond to OPTIONS preflight CORS requests."""
     headers = {'Access-Control-Allow-Origin': '*',
@@ -518,6 +1505,72 @@ def parse_authorization_header(value):
         return
 
 
+def make_etag(*components):
+    """Strong entity tag (including quotes) from string components."""
+    h = hashlib.sha1()
+    for component in components:
+        h.update(component.encode('utf-8'))
+        h.update(b'\0')
+    return '"' + h.hexdigest() + '"'
+
+
+def canonical_size(region, size, width, height):
+    """Size of the image for canonical region and size strings.
+
+    Arguments:
+        region - canonical region string, 'full' or 'x,y,w,h'
+        size - canonical size string for any API version
+        width, height - size of the source image
+
+    Returns (w, h), or None if the size cannot be determined from the
+    strings alone (e.g. a region that is not in whole pixels).
+    """
+    if (region == 'full'):
+        (rw, rh) = (width, height)
+    else:
+        try:
+            (x, y, rw, rh) = [int(v) for v in region.split(',')]
+        except ValueError:
+            return None
+    size = size.lstrip('^')
+    if (size in ('full', 'max')):
+        return (rw, rh)
+    try:
+        (sw, sh) = size.split(',')
+        sw = int(sw)
+        sh = int(sh) if (sh != '') else int(rh * sw / float(rw) + 0.5)
+    except ValueError:
+        return None
+    return (sw, sh)
+
+
+def etag_matches(if_none_match, etag):
+    """True if etag matches any entity tag in an If-None-Match header.
+
+    Uses the weak comparison specified for If-None-Match in RFC7232,
+    so a W/ prefix is ignored.
+    """
+    if (if_none_match.strip() == '*'):
+        return True
+    if (etag.startswith('W/')):
+        etag = etag[2:]
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if (tag.startswith('W/')):
+            tag = tag[2:]
+        if (tag == etag):
+            return True
+    return False
+
+
+def parse_http_date(value):
+    """Parse HTTP date value to seconds since epoch, None on failure."""
+    try:
+        return mktime_tz(parsedate_tz(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
 def do_conneg(accept, supported):
     """Parse accept header and look for preferred type in supported list.
 
@@ -539,21 +1592,48 @@ def do_conneg(accept, supported):
 ######################################################################
 
 
-def setup_auth_paths(app, auth, prefix, params):
-    """Add URL rules for auth paths."""
-    base = urljoin('/', prefix + '/')  # Must end in slash
-    app.add_url_rule(base + 'login', prefix + 'login_handler',
-                     auth.login_handler, defaults=params)
-    app.add_url_rule(base + 'logout', prefix + 'logout_handler',
-                     auth.logout_handler, defaults=params)
+def auth_routes(auth):
+    """Dict of auth path names to auth handlers for IIIFDispatcher."""
+    routes = {'login': auth.login_handler,
+              'logout': auth.logout_handler,
+              'token': auth.access_token_handler}
     if (auth.client_id_handler):
-        app.add_url_rule(base + 'client', prefix + 'client_id_handler',
-                         auth.client_id_handler, defaults=params)
-    app.add_url_rule(base + 'token', prefix + 'access_token_handler',
-                     auth.access_token_handler, defaults=params)
+        routes['client'] = auth.client_id_handler
     if (auth.home_handler):
-        app.add_url_rule(base + 'home', prefix + 'home_handler',
-                         auth.home_handler, defaults=params)
+        routes['home'] = auth.home_handler
+    return routes
+
+
+def cache_control_policy(options, prefixes=()):
+    """Build dict of Cache-Control values for a handler from option strings.
+
+    Each option string has the form TYPE[@PREFIX]=DIRECTIVES where TYPE
+    is one of CACHE_CONTROL_TYPES, PREFIX optionally restricts the option
+    to one prefix, and DIRECTIVES is a comma separated Cache-Control value
+    such as 'public, max-age=86400, immutable'. Options for a specific
+    prefix apply if PREFIX is in prefixes (typically the local and client
+    prefixes of the handler), and take precedence over general ones.
+
+    Raises ValueError for a badly formed option string.
+    """
+    general = {}
+    specific = {}
+    for option in (options or []):
+        try:
+            (target, directives) = option.split('=', 1)
+        except ValueError:
+            raise ValueError("Bad cache control option '%s', must be TYPE[@PREFIX]=DIRECTIVES" % (option))
+        (response_type, at, option_prefix) = target.strip().partition('@')
+        if (response_type not in CACHE_CONTROL_TYPES):
+            raise ValueError("Bad cache control type '%s', must be one of %s" %
+                             (response_type, ', '.join(CACHE_CONTROL_TYPES)))
+        value = ', '.join([d.strip() for d in directives.split(',') if d.strip()])
+        if (not at):
+            general[response_type] = value
+        elif (option_prefix.strip('/') in [p.strip('/') for p in prefixes if p]):
+            specific[response_type] = value
+    general.update(specific)
+    return general
 
 
 def make_prefix(api_version, manipulator, auth_type):
@@ -606,6 +1686,118 @@ def add_shared_configs(p, base_dir=''):
           help="Set access cookie lifetime for authenticated access in seconds")
     p.add('--access-token-lifetime', type=int, default=10,
           help="Set access token lifetime for authenticated access in seconds")
+    p.add('--negative-cache-size', type=int, default=1000,
+          help="Maximum number of unknown identifiers and bad request paths "
+               "to remember per prefix (0 to disable)")
+    p.add('--negative-cache-ttl', type=int, default=60,
+          help="Time in seconds to remember unknown identifiers and bad "
+               "request paths")
+    p.add('--cache-dir', default=None,
+          help="Directory in which to cache derived images, keyed by the "
+               "canonical form of each request (default no cache)")
+    p.add('--shared-cache', action='store_true',
+          help="Key the --cache-dir cache by the operations applied to the "
+               "source image instead of the request, so that prefixes for "
+               "different API versions share cached images that are the same")
+    p.add('--canonical-link-header', action='store_true',
+          help="Add Link header with rel=\"canonical\" to image responses")
+    p.add('--coalesce-requests', action='store_true',
+          help="Have concurrent requests for the same image wait for and "
+               "share one derivation")
+    p.add('--coalesce-lock-dir', default=None,
+          help="Directory for lock files used to coalesce requests between "
+               "server processes (requires --coalesce-requests and --cache-dir)")
+    p.add('--derive-from-cache-factor', type=float, default=None,
+          help="Derive images from a cached image of the same region that is "
+               "at least this many times larger (e.g. 2), instead of from the "
+               "source image. Cached png and tif images need only be as large "
+               "(requires --cache-dir, default never)")
+    p.add('--mosaic', action='store_true',
+          help="Assemble region requests from cached tiles when all of the "
+               "tiles covering the region are cached (requires --cache-dir "
+               "and the pil manipulator)")
+    p.add('--pyramid-dir', default=None,
+          help="Directory in which to build reduced resolution levels of JPEG "
+               "and PNG source images, in the background after the first "
+               "request for each image, for use by the pil manipulator "
+               "(default no levels)")
+    p.add('--prefetch', action='store_true',
+          help="After each tile request, derive the adjacent and parent tiles "
+               "into the derivative cache in the background (requires --cache-dir)")
+    p.add('--prefetch-queue-size', type=int, default=100,
+          help="Maximum number of tiles waiting to be prefetched per prefix, "
+               "further tiles are not prefetched")
+    p.add('--cache-control', action='append', default=[],
+          help="Cache-Control header for one type of response in the form "
+               "TYPE[@PREFIX]=DIRECTIVES, e.g. 'tile=public, max-age=31536000, immutable'. "
+               "TYPE is one of %s and the optional PREFIX limits the setting "
+               "to one prefix. May be repeated. Prefixes with auth always "
+               "use 'private, no-store' except for degraded images" % (', '.join(CACHE_CONTROL_TYPES)))
+    p.add('--max-decode-pixels', type=int, default=0,
+          help="Limit on the total pixels of source image regions being "
+               "decoded at once in each server process, further requests wait "
+               "up to --admission-wait seconds and then get a 503 response. "
+               "Metrics are at /admission.json (default 0, no limit)")
+    p.add('--max-decode-mb', type=int, default=0,
+          help="Limit on the total estimated memory in MB of images being "
+               "derived at once in each server process (default 0, no limit)")
+    p.add('--admission-wait', type=float, default=1.0,
+          help="Time in seconds that a request waits to be admitted when "
+               "over the --max-decode-pixels or --max-decode-mb limit")
+    p.add('--retry-after', type=int, default=1,
+          help="Retry-After time in seconds for 503 responses when over the "
+               "--max-decode-pixels or --max-decode-mb limit")
+    p.add('--derive-slots', type=int, default=0,
+          help="Number of images derived at once in each server process, "
+               "with waiting tile and thumbnail requests served before larger "
+               "ones. Metrics are at /scheduler.json (default 0, no limit)")
+    p.add('--derive-bulk-slots', type=int, default=None,
+          help="Maximum number of --derive-slots used by large crop and "
+               "full-size requests (default one fewer than --derive-slots)")
+    p.add('--derive-max-wait', type=float, default=10.0,
+          help="Time in seconds after which a waiting large request is "
+               "served ahead of later tile and thumbnail requests")
+    p.add('--derive-timeout', type=float, default=None,
+          help="Time in seconds from the start of an image request after "
+               "which its derivation is abandoned with a 503 response, checked "
+               "between the stages of derivation (default no limit)")
+    p.add('--derive-processes', type=int, default=0,
+          help="Derive images in a pool of this many worker processes "
+               "(requires python 3, default 0, derive in the request thread)")
+    p.add('--derive-process-prefixes', default='',
+          help="Comma separated prefixes or manipulator names (e.g. gen) of "
+               "the handlers that use --derive-processes (default all)")
+    p.add('--stream-min-pixels', type=int, default=None,
+          help="Stream image responses with at least this many pixels while "
+               "they are encoded, without Content-Length, instead of writing "
+               "them to a file first (not used with --cache-dir or "
+               "--coalesce-requests, default no streaming)")
+    p.add('--info-cache-size', type=int, default=1000,
+          help="Number of image sizes and info.json responses kept in memory "
+               "by each handler, also keeps the list of identifiers. Up to "
+               "this many info.json responses are made before the server "
+               "accepts requests (0 to read images and directories for "
+               "every request)")
+    p.add('--asgi', action='store_true',
+          help="Run as an ASGI application in uvicorn, deriving images in a "
+               "pool of threads or processes (requires uvicorn)")
+    p.add('--asgi-executor', default='thread', choices=('thread', 'process'),
+          help="Type of pool in which to derive images with --asgi")
+    p.add('--asgi-workers', type=int, default=None,
+          help="Number of threads or processes in which to derive images "
+               "with --asgi (default depends on number of CPUs)")
+    p.add('--prefork', type=int, default=0,
+          help="Run as a pre-fork server with this many worker processes "
+               "sharing the application created once (default 0, single "
+               "process development server)")
+    p.add('--max-requests', type=int, default=0,
+          help="Replace each --prefork worker, or restart the single process "
+               "server once requests in progress finish, after this many "
+               "requests. Also replaces --derive-processes workers after this "
+               "many derivations each (default 0, never)")
+    p.add('--max-rss', type=int, default=0,
+          help="As --max-requests but when the resident memory of a worker "
+               "or server process exceeds this many MB (default 0, never)")
     p.add('--config', is_config_file=True, default=None,
           help='Read config from given file path')
     p.add('--debug', action='store_true',
@@ -619,7 +1811,9 @@ def add_shared_configs(p, base_dir=''):
 def add_handler(app, config):
     """Add a single handler to the app.
 
-    Adds one IIIF Image API handler to app, with config from config.
+    Adds one IIIF Image API handler to app, with config from config, to
+    the IIIFDispatcher in app.extensions['iiif_dispatcher'] which is set
+    up with the URL rule for all handlers when the first is added.
 
     Arguments:
         app - Flask app
@@ -634,6 +1828,43 @@ def add_handler(app, config):
             config.access_cookie_lifetime - number of seconds
             config.access_token_lifetime - number of seconds
             config.auth_type - Auth type string or 'none'
+            config.negative_cache_size - optional number of failed requests to
+                remember, sets up config.negative_cache if non-zero
+            config.negative_cache_ttl - optional lifetime of negative cache entries
+            config.cache_dir - optional directory for derived images, sets up
+                config.derivative_cache if set
+            config.shared_cache - optional, True to share derivative cache
+                entries with other handlers (see IIIFHandler.plan_key())
+            config.coalesce_requests - optional, True to set up config.single_flight
+            config.coalesce_lock_dir - optional lock file directory for config.single_flight
+            config.derive_from_cache_factor - optional minimum size ratio of cached
+                image to derive from instead of the source image
+            config.mosaic - optional, True to assemble images from cached tiles
+            config.pyramid_dir - optional directory for levels of source images,
+                sets up config.pyramid and config.pyramid_builder if set
+            config.prefetch - optional, True to set up config.prefetcher
+            config.prefetch_queue_size - optional queue size for config.prefetcher
+            config.max_decode_pixels, config.max_decode_mb - optional limits,
+                sets config.admission to an IIIFAdmissionController shared by
+                all handlers of app if either is non-zero
+            config.admission_wait, config.retry_after - optional settings for
+                config.admission
+            config.derive_slots - optional, sets config.scheduler to an
+                IIIFPriorityScheduler shared by all handlers of app if non-zero
+            config.derive_bulk_slots, config.derive_max_wait - optional settings
+                for config.scheduler
+            config.derive_processes - optional, sets config.process_pool to an
+                IIIFProcessPool shared by all handlers that use it, with workers
+                recycled according to config.max_requests and config.max_rss (MB)
+            config.derive_process_prefixes - optional comma separated prefixes
+                and manipulator names of the handlers that use the pool, all
+                handlers if not set
+            config.cache_control - optional list of TYPE[@PREFIX]=DIRECTIVES strings,
+                sets config.cache_control_policy for this prefix
+            config.info_cache_size - optional, sets up config.identifier_index,
+                config.info_sizes and config.info_bodies if non-zero
+
+    Each config is recorded in app.extensions['iiif_configs'] for warm_app().
 
     Returns True on success, nothing otherwise.
     """
@@ -677,36 +1908,123 @@ def add_handler(app, config):
     else:
         logging.error("Unknown manipulator type %s, ignoring" % (config.klass_name))
         return
+    negative_cache_size = getattr(config, 'negative_cache_size', 0)
+    if (negative_cache_size):
+        config.negative_cache = IIIFNegativeCache(
+            size=negative_cache_size,
+            ttl=getattr(config, 'negative_cache_ttl', 60))
+    if (getattr(config, 'cache_dir', None)):
+        config.derivative_cache = IIIFDerivativeCache(config.cache_dir)
+    if (getattr(config, 'coalesce_requests', False)):
+        config.single_flight = IIIFSingleFlight(
+            lock_dir=getattr(config, 'coalesce_lock_dir', None))
+    if (getattr(config, 'pyramid_dir', None)):
+        from iiif.pyramid import IIIFPyramidCache
+        config.pyramid = IIIFPyramidCache(config.pyramid_dir)
+        config.pyramid_builder = IIIFPrefetcher()
+    if (getattr(config, 'max_decode_pixels', 0) or getattr(config, 'max_decode_mb', 0)):
+        if ('iiif_admission' not in app.extensions):
+            app.extensions['iiif_admission'] = IIIFAdmissionController(
+                max_pixels=getattr(config, 'max_decode_pixels', 0),
+                max_bytes=getattr(config, 'max_decode_mb', 0) * 1024 * 1024,
+                wait=getattr(config, 'admission_wait', 1.0),
+                retry_after=getattr(config, 'retry_after', 1))
+            app.add_url_rule('/admission.json', 'admission_metrics_handler',
+                             admission_metrics_handler,
+                             defaults={'admission': app.extensions['iiif_admission']})
+        config.admission = app.extensions['iiif_admission']
+    if (getattr(config, 'derive_slots', 0)):
+        if ('iiif_scheduler' not in app.extensions):
+            app.extensions['iiif_scheduler'] = IIIFPriorityScheduler(
+                slots=config.derive_slots,
+                bulk_slots=getattr(config, 'derive_bulk_slots', None),
+                max_wait=getattr(config, 'derive_max_wait', 10.0))
+            app.add_url_rule('/scheduler.json', 'scheduler_metrics_handler',
+                             scheduler_metrics_handler,
+                             defaults={'scheduler': app.extensions['iiif_scheduler']})
+        config.scheduler = app.extensions['iiif_scheduler']
+    if (getattr(config, 'derive_processes', 0)):
+        selected = split_comma_argument(getattr(config, 'derive_process_prefixes', None) or '')
+        if (not selected or
+                set(selected) & set([config.prefix, getattr(config, 'client_prefix', None), config.klass_name])):
+            if ('iiif_process_pool' not in app.extensions):
+                from iiif.pool import IIIFProcessPool
+                app.extensions['iiif_process_pool'] = IIIFProcessPool(
+                    workers=config.derive_processes,
+                    max_tasks=getattr(config, 'max_requests', 0),
+                    max_rss=getattr(config, 'max_rss', 0) * 1024 * 1024)
+            config.process_pool = app.extensions['iiif_process_pool']
+    if (getattr(config, 'info_cache_size', 0)):
+        config.identifier_index = {}
+        config.info_sizes = {}
+        config.info_bodies = {}
+    if (getattr(config, 'prefetch', False)):
+        config.prefetcher = IIIFPrefetcher(
+            queue_size=getattr(config, 'prefetch_queue_size', 100))
+    try:
+        config.cache_control_policy = cache_control_policy(
+            getattr(config, 'cache_control', None),
+            (config.prefix, getattr(config, 'client_prefix', None)))
+    except ValueError as e:
+        logging.error("%s, ignoring" % (str(e)))
+        return
     base = urljoin('/', config.prefix + '/')  # ensure has trailing slash
     client_base = urljoin('/', config.client_prefix + '/')  # ensure has trailing slash
     logging.warning("Installing %s IIIFManipulator at %s v%s %s" %
                     (config.klass_name, base, config.api_version, config.auth_type))
     params = dict(config=config, klass=klass, auth=auth, prefix=config.client_prefix)
-    app.add_url_rule(base.rstrip('/'), 'prefix_index_page',
-                     prefix_index_page, defaults={'config': config})
-    app.add_url_rule(base, 'prefix_index_page',
-                     prefix_index_page, defaults={'config': config})
-    app.add_url_rule(base + '<string(minlength=1):identifier>/info.json',
-                     'options_handler', options_handler, methods=['OPTIONS'])
-    app.add_url_rule(base + '<string(minlength=1):identifier>/info.json',
-                     'iiif_info_handler', iiif_info_handler, methods=['GET'], defaults=params)
-    if (config.include_osd):
-        app.add_url_rule(base + '<string(minlength=1):identifier>/osd.html',
-                         'osd_page_handler', osd_page_handler, methods=['GET'], defaults=params)
-    app.add_url_rule(base + '<string(minlength=1):identifier>/<path:path>',
-                     'iiif_image_handler', iiif_image_handler, methods=['GET'], defaults=params)
+    if ('iiif_dispatcher' not in app.extensions):
+        app.extensions['iiif_dispatcher'] = IIIFDispatcher()
+        app.add_url_rule('/<path:iiif_path>', 'iiif_dispatcher', app.extensions['iiif_dispatcher'],
+                         methods=DISPATCHER_METHODS, provide_automatic_options=False)
+    dispatcher = app.extensions['iiif_dispatcher']
+    if (not dispatcher.add(config.prefix, params=params)):
+        logging.warning("Handler already installed at %s, ignoring" % (base))
     if (auth):
-        setup_auth_paths(app, auth, config.client_prefix, params)
-    # redirects to info.json must come after auth
-    app.add_url_rule(base + '<string(minlength=1):identifier>',
-                     'iiif_info_handler',
-                     redirect_to=client_base + '<identifier>/info.json')
-    app.add_url_rule(base + '<string(minlength=1):identifier>/',
-                     'iiif_info_handler',
-                     redirect_to=client_base + '<identifier>/info.json')
+        dispatcher.add(config.client_prefix, routes=auth_routes(auth), params=params)
+    app.extensions.setdefault('iiif_configs', []).append(config)
     return True
 
 
+def warm_app(app):
+    """Warm up app with handlers from add_handler() before it accepts requests.
+
+    Manipulator and auth classes are imported by add_handler(). Loads all
+    PIL image plugins and then requests the top-level and prefix index
+    pages and, for handlers without auth, the info.json of up to
+    config.info_cache_size identifiers, which fills the identifier index,
+    image sizes and info.json responses kept for each handler. Starts no
+    threads or processes and so may be called before forking workers.
+
+    Returns the number of requests made.
+    """
+    from PIL import Image
+    Image.init()
+    paths = ['/']
+    for config in app.extensions.get('iiif_configs', []):
+        base = urljoin('/', config.prefix + '/')
+        paths.append(base.rstrip('/'))
+        if (getattr(config, 'info_bodies', None) is None or
+                (config.auth_type is not None and config.auth_type != 'none')):
+            continue
+        try:
+            ids = sorted(identifiers(config))[:config.info_cache_size]
+        except OSError as e:
+            logging.warning("Cannot read identifiers for %s (%s)" % (base, str(e)))
+            continue
+        for identifier in ids:
+            paths.append(base + urlquote(identifier, safe='') + '/info.json')
+    client = app.test_client()
+    errors = 0
+    for path in paths:
+        response = client.get(path)
+        if (response.status_code >= 500):
+            errors += 1
+        response.close()
+    logging.warning("Warmed up with %d requests, %d errors" % (len(paths), errors))
+    return len(paths)
+
+
 def serve_static(filename=None, prefix='', basedir=None):
     """Handler for static files: server filename in basedir/prefix.
 
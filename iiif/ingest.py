@@ -0,0 +1,216 @@
+"""Conversion of master images to tiled multi-resolution TIFF.
+
+Converts JPEG, PNG and TIFF masters into TIFF files with one tiled page
+per resolution level, laid out to match the tile size and scale factors
+advertised in info.json by the IIIF Image API servers, so that tiles can
+be read without decoding the whole master. Writing tiled TIFF requires
+the tifffile package (and numpy), which are not otherwise needed.
+"""
+
+import logging
+import multiprocessing
+import os
+import os.path
+import tempfile
+
+from PIL import Image
+try:
+    import numpy
+    import tifffile
+except ImportError:  # pragma: no cover # optional dependency
+    tifffile = None
+
+from .manipulator import IIIFManipulator
+
+# Extensions of master images that will be converted
+INGEST_SOURCE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+
+
+class IIIFIngestError(Exception):
+    """Error class for errors to be reported to user."""
+
+    pass
+
+
+def ingest_scale_factors(width, height, tile_width, tile_height=None):
+    """Scale factors of levels to write for image of width by height.
+
+    These are the scale factors that the servers advertise in info.json
+    when configured with 'auto' scale factors.
+    """
+    m = IIIFManipulator()
+    m.width = width
+    m.height = height
+    return m.scale_factors(tile_width, tile_height)
+
+
+class IIIFIngest(object):
+    """Convert master images to tiled multi-resolution TIFF.
+
+    Typical use:
+
+        ing = IIIFIngest(dst='/data/tiff', tile_width=512)
+        (num_converted, num_skipped, num_failed) = ing.ingest('/data/masters')
+
+    Output files have the same path relative to dst as the masters have
+    relative to the source directory, with the extension .tif, so that
+    identifiers are unchanged when serving from dst. Outputs newer than
+    their masters are skipped, and outputs are written to a temporary
+    file that is renamed into place so that a partial file is never
+    served and an interrupted run can simply be restarted.
+    """
+
+    def __init__(self, dst, tile_width=512, tile_height=None, workers=None,
+                 compression='zlib', max_image_pixels=0, dryrun=False):
+        """Initialize IIIFIngest object.
+
+        Positional arguments:
+        dst -- destination directory
+
+        Keyword arguments:
+        tile_width -- tile width in pixels
+        tile_height -- tile height in pixels, same as tile_width if not set
+        workers -- number of processes, defaults to number of CPUs
+        compression -- tifffile compression for tiles
+        max_image_pixels -- if non-zero, limit on master image size
+        dryrun -- True to not write anything
+        """
+        self.dst = dst
+        self.tile_width = tile_width
+        self.tile_height = tile_height if (tile_height is not None) else tile_width
+        self.workers = workers
+        self.compression = compression
+        self.max_image_pixels = max_image_pixels
+        self.dryrun = dryrun
+        self.logger = logging.getLogger(__name__)
+
+    def __getstate__(self):
+        """State for pickling to worker processes, without logger."""
+        state = dict(self.__dict__)
+        del state['logger']
+        return state
+
+    def __setstate__(self, state):
+        """Restore from pickled state."""
+        self.__dict__.update(state)
+        self.logger = logging.getLogger(__name__)
+
+    def output_path(self, src, src_dir=None):
+        """Output file path for master src in directory src_dir."""
+        if (src_dir is None):
+            rel = os.path.basename(src)
+        else:
+            rel = os.path.relpath(src, src_dir)
+        return os.path.join(self.dst, os.path.splitext(rel)[0] + '.tif')
+
+    def up_to_date(self, src, dst):
+        """True if output dst exists and is not older than master src."""
+        try:
+            return os.path.getmtime(dst) >= os.path.getmtime(src)
+        except OSError:
+            return False
+
+    def sources(self, src_dir):
+        """Generator for master image files in src_dir and subdirectories."""
+        for (dirpath, dirnames, filenames) in os.walk(src_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if (not filename.startswith('.') and
+                        os.path.splitext(filename)[1].lower() in INGEST_SOURCE_EXTENSIONS):
+                    yield os.path.join(dirpath, filename)
+
+    def convert(self, src, dst):
+        """Convert master src to tiled multi-resolution TIFF dst.
+
+        The first page of dst is the full resolution image and is followed
+        by one reduced resolution page for each further scale factor.
+        Returns the list of scale factors written.
+        """
+        if (tifffile is None):
+            raise IIIFIngestError("Writing tiled TIFF requires the tifffile package")
+        if (self.max_image_pixels):
+            Image.MAX_IMAGE_PIXELS = self.max_image_pixels
+        image = Image.open(src)
+        if (image.mode not in ('L', 'RGB')):
+            image = image.convert('RGB')
+        (width, height) = image.size
+        scale_factors = ingest_scale_factors(width, height, self.tile_width, self.tile_height)
+        if (self.dryrun):
+            return scale_factors
+        dir = os.path.dirname(dst)
+        if (not os.path.isdir(dir)):
+            try:
+                os.makedirs(dir)
+            except OSError:
+                # may have been created by another process
+                if (not os.path.isdir(dir)):
+                    raise
+        (fd, tmp) = tempfile.mkstemp(dir=dir, prefix='.tmp', suffix='.tif')
+        os.close(fd)
+        try:
+            with tifffile.TiffWriter(tmp) as tw:
+                level_sf = 1
+                for sf in scale_factors:
+                    # reduce from previous level, scale factors are powers of 2
+                    size = ((width + sf - 1) // sf, (height + sf - 1) // sf)
+                    if (sf != level_sf):
+                        image = image.resize(size, Image.BOX)
+                        level_sf = sf
+                    tw.write(numpy.asarray(image),
+                             tile=(self.tile_height, self.tile_width),
+                             compression=self.compression,
+                             photometric=('minisblack' if image.mode == 'L' else 'rgb'),
+                             subfiletype=(0 if sf == 1 else 1))
+            os.rename(tmp, dst)
+        except Exception:
+            if (os.path.exists(tmp)):
+                os.remove(tmp)
+            raise
+        return scale_factors
+
+    def ingest(self, src_dir):
+        """Convert all masters in src_dir that do not have up-to-date outputs.
+
+        Masters are converted in parallel in a pool of processes, errors
+        converting one master are logged and do not stop the others.
+
+        Returns (num_converted, num_skipped, num_failed).
+        """
+        if (tifffile is None):
+            raise IIIFIngestError("Writing tiled TIFF requires the tifffile package")
+        num_skipped = 0
+        jobs = []
+        for src in self.sources(src_dir):
+            dst = self.output_path(src, src_dir)
+            if (self.up_to_date(src, dst)):
+                num_skipped += 1
+            else:
+                jobs.append((self, src, dst))
+        num_converted = 0
+        num_failed = 0
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            for (src, error) in pool.imap_unordered(_convert, jobs):
+                if (error is None):
+                    num_converted += 1
+                else:
+                    num_failed += 1
+                    self.logger.warning("Failed to convert %s (%s)" % (src, error))
+        finally:
+            pool.close()
+            pool.join()
+        self.logger.warning("Converted %d, skipped %d up-to-date, %d failed" %
+                            (num_converted, num_skipped, num_failed))
+        return (num_converted, num_skipped, num_failed)
+
+
+def _convert(job):
+    # Worker process function for IIIFIngest.ingest(), returns
+    # (src, error) where error is None on success
+    (ingest, src, dst) = job
+    try:
+        scale_factors = ingest.convert(src, dst)
+        ingest.logger.info("%s -> %s (scale factors %s)" % (src, dst, scale_factors))
+        return (src, None)
+    except Exception as e:
+        return (src, str(e))
@@ -11,8 +11,9 @@ import os.path
 import re
 import shutil
 import subprocess
+import time
 
-from .error import IIIFError, IIIFZeroSizeError
+from .error import IIIFError, IIIFZeroSizeError, IIIFDeadlineError
 from .request import IIIFRequest
 
 
@@ -23,6 +24,11 @@ class IIIFManipulator(object):
     determine the HTTP response.
     """
 
+    # True if derive() accepts a file object as outfile
+    streamable = False
+    # Output formats supported with the default first, None if not known
+    output_formats = None
+
     def __init__(self, api_version='2.1'):
         """Initialize Manipulator object.
 
@@ -43,6 +49,7 @@ class IIIFManipulator(object):
         self.srcfile = None
         self.request = None
         self.outfile = None
+        self.deadline = None
         self.logger = logging.getLogger(__name__)
 
     @property
@@ -69,7 +76,18 @@ class IIIFManipulator(object):
             return
         return(uri_pattern % self.compliance_level)
 
-    def derive(self, srcfile=None, request=None, outfile=None):
+    @property
+    def encoder_profile(self):
+        """String identifying how this manipulator encodes output images.
+
+        Used in entity tags so that a change of manipulator (or version
+        of a library it uses) gives different tags even if the request
+        and source image are unchanged. Sub-classes that use an external
+        library should include its version.
+        """
+        return self.__class__.__name__
+
+    def derive(self, srcfile=None, request=None, outfile=None, deadline=None):
         """Do sequence of manipulations for IIIF to derive output image.
 
         Named argments:
@@ -77,7 +95,12 @@ class IIIFManipulator(object):
         request -- IIIFRequest object with parsed parameters
         outfile -- output image file. If set the the output file will be
                    written to that file, otherwise a new temporary file
-                   will be created and outfile set to its location.
+                   will be created and outfile set to its location. May
+                   be a writable file object if self.streamable is True
+        deadline -- time (seconds since epoch) after which the derivation
+                    is abandoned by raising IIIFDeadlineError. The deadline
+                    is checked before each stage, sub-classes may also
+                    check it within stages with check_deadline()
 
         See order in spec: http://www-sul.stanford.edu/iiif/image-api/#order
 
@@ -102,25 +125,42 @@ class IIIFManipulator(object):
             self.request = request
         if (outfile is not None):
             self.outfile = outfile
-        if (self.outfile is not None):
+        if (deadline is not None):
+            self.deadline = deadline
+        if (self.outfile is not None and not hasattr(self.outfile, 'write')):
             # create path to output dir if necessary
             dir = os.path.dirname(self.outfile)
             if (not os.path.exists(dir)):
                 os.makedirs(dir)
         #
+        self.check_deadline('first')
         self.do_first()
+        self.check_deadline('region')
         (x, y, w, h) = self.region_to_apply()
         self.do_region(x, y, w, h)
+        self.check_deadline('size')
         (w, h) = self.size_to_apply()
         self.do_size(w, h)
+        self.check_deadline('rotation')
         (mirror, rot) = self.rotation_to_apply(no_mirror=True)
         self.do_rotation(mirror, rot)
+        self.check_deadline('quality')
         (quality) = self.quality_to_apply()
         self.do_quality(quality)
+        self.check_deadline('format')
         self.do_format(self.request.format)
         self.do_last()
         return(self.outfile, self.mime_type)
 
+    def check_deadline(self, stage):
+        """Raise IIIFDeadlineError if self.deadline has passed.
+
+        stage is the name of the stage of derivation for the error text.
+        """
+        if (self.deadline is not None and time.time() > self.deadline):
+            raise IIIFDeadlineError(code=503, parameter='unknown',
+                                    text="Derivation abandoned before %s, deadline passed" % (stage))
+
     def do_first(self):
         """Simplest possible manipulator that can only handle no modification.
 
@@ -343,6 +383,64 @@ class IIIFManipulator(object):
                 return('default')
         return(self.request.quality)
 
+    def canonical_request(self, width=None, height=None):
+        """Return IIIFRequest for the canonical form of self.request.
+
+        Syntactically different requests that will result in the same
+        image (e.g. full, pct:100 and an explicit x,y,w,h covering the whole
+        image, rotation 0 and 360, default and explicit quality) are mapped
+        to the same canonical request, following the canonical URI syntax
+        of the API version in use. The source image size is taken from
+        self.width and self.height (as set by do_first()) unless width and
+        height are given.
+
+        The region is left as requested if it cannot be expressed exactly
+        in whole pixels (e.g. square regions with an odd offset). Will raise
+        the same IIIFError as derive() for requests that are not satisfiable
+        given the image size.
+
+        Typical use:
+
+            m.do_first()
+            path = m.canonical_request().url()
+        """
+        (src_width, src_height) = (getattr(self, 'width', -1), getattr(self, 'height', -1))
+        if (width is not None):
+            self.width = width
+            self.height = height
+        try:
+            (x, y, w, h) = self.region_to_apply()
+            if (x is None):
+                region = 'full'
+            elif (int(x) == x and int(y) == y and int(w) == w and int(h) == h):
+                region = "%d,%d,%d,%d" % (x, y, w, h)
+                (self.width, self.height) = (w, h)
+            else:
+                region = self.request.region
+                (self.width, self.height) = (w, h)
+            (sw, sh) = self.size_to_apply()
+            if (sw is None):
+                size = 'max' if (self.api_version >= '3.0') else 'full'
+            elif (self.api_version >= '3.0'):
+                size = "%d,%d" % (sw, sh)
+                if (sw > self.width or sh > self.height):
+                    size = '^' + size
+            elif (sh == int(self.height * sw / self.width + 0.5)):
+                size = "%d," % (sw)
+            else:
+                size = "%d,%d" % (sw, sh)
+        finally:
+            (self.width, self.height) = (src_width, src_height)
+        (mirror, rot) = self.rotation_to_apply()
+        rotation = ("%d" % rot) if (rot == int(rot)) else repr(rot)
+        if (mirror):
+            rotation = '!' + rotation
+        return IIIFRequest(api_version=self.api_version,
+                           identifier=self.request.identifier,
+                           region=region, size=size, rotation=rotation,
+                           quality=self.quality_to_apply(),
+                           format=self.request.format)
+
     def cleanup(self):
         """Null implementation of clean up after derive call and use of output.
 
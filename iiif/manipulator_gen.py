@@ -83,6 +83,7 @@ class IIIFManipulatorGen(IIIFManipulatorPIL):
         # Now we have region and size, generate the image
         image = Image.new("RGB", (self.sw, self.sh), self.gen.background_color)
         for y in range(0, self.sh):
+            self.check_deadline('size')
             for x in range(0, self.sw):
                 ix = int((x * self.rw) // self.sw + self.rx)
                 iy = int((y * self.rh) // self.sh + self.ry)
@@ -22,11 +22,20 @@ class IIIFManipulatorPIL(IIIFManipulator):
 
     All exceptions are raised as IIIFError objects which directly
     determine the HTTP response.
+
+    If pyramid is set to an IIIFPyramidCache then regions are read from
+    the smallest reduced resolution level of the source image that has
+    enough resolution for the requested size, if levels have been built.
+
+    The output may be written to a file object given as outfile to
+    derive(), so that it can be streamed while it is encoded.
     """
 
     tmpdir = '/tmp'
     filecmd = None
     pnmdir = None
+    streamable = True
+    output_formats = ('jpg', 'png', 'webp')
 
     def __init__(self, **kwargs):
         """Initialize IIIFManipulatorPIL object.
@@ -38,6 +47,13 @@ class IIIFManipulatorPIL(IIIFManipulator):
         self.compliance_level = 2
         self.image = None
         self.outtmp = None
+        self.pyramid = None
+
+    @property
+    def encoder_profile(self):
+        """Manipulator class name and PIL version."""
+        return "%s PIL/%s" % (self.__class__.__name__,
+                              getattr(Image, '__version__', 'unknown'))
 
     def set_max_image_pixels(self, pixels):
         """Set PIL limit on pixel size of images to load if non-zero.
@@ -56,6 +72,35 @@ class IIIFManipulatorPIL(IIIFManipulator):
             Image.warnings.simplefilter(
                 'error', Image.DecompressionBombWarning)
 
+    def mosaic(self, tiles, size, box, out_size):
+        """Composite tile images and write part of the result to a PNG file.
+
+        Arguments:
+        tiles -- list of (file, (x, y)) for tile image files and their offsets
+                 in the composite image
+        size -- (w, h) size of the composite image
+        box -- (left, upper, right, lower) box within the composite image
+               to use, may be fractional
+        out_size -- (w, h) size to resample box to
+
+        Returns the name of a temporary file that the caller must remove.
+        """
+        images = []
+        try:
+            for (file, offset) in tiles:
+                images.append((Image.open(file), offset))
+        except Exception as e:
+            raise IIIFError(text=("Failed to read tile (PIL: %s)" % (str(e))))
+        mode = 'L' if all(im.mode == 'L' for (im, offset) in images) else 'RGB'
+        image = Image.new(mode, size)
+        for (im, offset) in images:
+            image.paste(im.convert(mode), offset)
+        image = image.resize(out_size, box=box)
+        (fd, tmp) = tempfile.mkstemp(suffix='.png', dir=self.tmpdir)
+        os.close(fd)
+        image.save(tmp, 'PNG', compress_level=1)
+        return tmp
+
     def do_first(self):
         """Create PIL object from input image file.
 
@@ -77,9 +122,58 @@ class IIIFManipulatorPIL(IIIFManipulator):
             raise IIIFError(text=("Failed to read image (PIL: %s)" % (str(e))))
         (self.width, self.height) = self.image.size
 
+    def pyramid_level(self, w, h):
+        """Best reduced resolution level to read region of w by h pixels from.
+
+        Returns (factor, path) for the level with the largest factor that
+        has at least the resolution needed for the requested size, or None
+        if no level is suitable or there is no pyramid.
+        """
+        if (self.pyramid is None):
+            return None
+        (width, height) = (self.width, self.height)
+        try:
+            (self.width, self.height) = (w, h)
+            (sw, sh) = self.size_to_apply()
+        finally:
+            (self.width, self.height) = (width, height)
+        if (sw is None):
+            return None
+        for (factor, path) in self.pyramid.levels(self.srcfile):
+            if (w / float(factor) >= sw and h / float(factor) >= sh):
+                return (factor, path)
+        return None
+
     def do_region(self, x, y, w, h):
-        """Apply region selection."""
-        if (x is None):
+        """Apply region selection.
+
+        Will read the region from a reduced resolution level of the
+        source image if one is suitable (see pyramid_level()). The region
+        is then at lower resolution than w by h, but self.width and
+        self.height are set as if it were not since do_size() will scale
+        it anyway.
+        """
+        level = self.pyramid_level(self.width if (x is None) else w,
+                                   self.height if (x is None) else h)
+        if (level is not None):
+            (factor, path) = level
+            try:
+                image = Image.open(path)
+            except Exception as e:
+                self.logger.warning("Failed to read level %s (%s)" % (path, str(e)))
+                level = None
+        if (level is not None):
+            self.logger.debug("region: reading level with factor %d" % (factor))
+            self.image = image
+            if (x is not None):
+                (lw, lh) = image.size
+                self.image = image.crop((int(x / float(factor) + 0.5),
+                                         int(y / float(factor) + 0.5),
+                                         min(lw, int((x + w) / float(factor) + 0.5)),
+                                         min(lh, int((y + h) / float(factor) + 0.5))))
+                self.width = w
+                self.height = h
+        elif (x is None):
             self.logger.debug("region: full (nop)")
         else:
             self.logger.debug("region: (%d,%d,%d,%d)" % (x, y, w, h))
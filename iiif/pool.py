@@ -0,0 +1,201 @@
+"""Process pool for image derivations in IIIF Image API servers.
+
+Manipulators such as IIIFManipulatorGen do most of their work in Python
+and so hold the GIL, which means that threads handling requests cannot
+use more than one core between them. IIIFProcessPool runs derivations in
+a pool of worker processes instead. The parsed request is passed to a
+worker which returns the encoded image, via shared memory for large
+images where multiprocessing.shared_memory is available (Python 3.8+).
+The worker processes may be replaced after a number of derivations or
+when their memory use grows too large.
+
+Requires Python 3.
+"""
+
+import concurrent.futures
+import importlib
+import io
+import logging
+import os
+import tempfile
+import threading
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # pragma: no cover # python < 3.8
+    resource_tracker = None
+    shared_memory = None
+
+# Encoded images at least this large are returned through shared memory
+POOL_SHM_THRESHOLD = 1024 * 1024
+
+# Modules imported by each worker process as it starts
+POOL_MODULES = ('iiif.manipulator_pil', 'iiif.manipulator_gen')
+
+
+def pool_init(modules):
+    """Import modules and PIL plugins in a new worker process."""
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logging.getLogger(__name__).warning("Failed to import %s in worker (%s)" % (module, str(e)))
+    from PIL import Image
+    Image.init()
+
+
+def pool_derive(klass, api_version, srcfile, iiif, pyramid=None, deadline=None,
+                shm_threshold=POOL_SHM_THRESHOLD):
+    """Derive image for iiif from srcfile in a worker process.
+
+    Streamable manipulators encode into memory, others write a temporary
+    file that is read back and removed.
+
+    Returns (kind, data, size, mime_type, rss) where rss is the resident
+    set size of the worker afterwards. If kind is 'shm' then data is the
+    name of a new shared memory block which the caller must unlink, else
+    kind is 'bytes' and data is the image.
+    """
+    from iiif.prefork import rss
+    manipulator = klass(api_version=api_version)
+    if (pyramid is not None):
+        manipulator.pyramid = pyramid
+    try:
+        if (manipulator.streamable):
+            buf = io.BytesIO()
+            manipulator.derive(srcfile, iiif, outfile=buf, deadline=deadline)
+            data = buf.getvalue()
+        else:
+            (fd, outfile) = tempfile.mkstemp(prefix='iiif_pool_')
+            os.close(fd)
+            try:
+                manipulator.derive(srcfile, iiif, outfile=outfile, deadline=deadline)
+                with open(outfile, 'rb') as fh:
+                    data = fh.read()
+            finally:
+                os.remove(outfile)
+    finally:
+        manipulator.cleanup()
+    if (shared_memory is None or len(data) < shm_threshold):
+        return ('bytes', data, len(data), manipulator.mime_type, rss())
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    try:
+        shm.buf[:len(data)] = data
+    finally:
+        shm.close()
+    return ('shm', shm.name, len(data), manipulator.mime_type, rss())
+
+
+class IIIFProcessPool(object):
+    """Pool of worker processes deriving images.
+
+    Typical use:
+
+        pool = IIIFProcessPool(workers=4)
+        (outfile, mime_type) = pool.derive(IIIFManipulatorGen, '2.1', srcfile, iiif)
+        # .. serve and then remove outfile
+
+    All worker processes are replaced by new ones after max_tasks
+    derivations per worker, or after a derivation that leaves a worker
+    larger than max_rss bytes. The old workers finish the derivations in
+    progress before they exit.
+
+    Thread safe, derive() blocks the calling thread until the image is
+    ready.
+    """
+
+    def __init__(self, workers=None, modules=POOL_MODULES, shm_threshold=POOL_SHM_THRESHOLD,
+                 max_tasks=0, max_rss=0):
+        """Initialize IIIFProcessPool object.
+
+        Keyword arguments:
+        workers -- number of worker processes, None for one per CPU
+        modules -- modules to import in each worker as it starts
+        shm_threshold -- images at least this many bytes are returned
+                         through shared memory rather than pickled
+        max_tasks -- if non-zero, replace workers after this many
+                     derivations each
+        max_rss -- if non-zero, replace workers when one has a resident
+                   set size larger than this many bytes
+        """
+        self.workers = workers
+        self.modules = modules
+        self.shm_threshold = shm_threshold
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.lock = threading.Lock()
+        self.num_tasks = 0
+        self.num_recycled = 0
+        if (resource_tracker is not None):
+            # started before the workers so that they share it
+            resource_tracker.ensure_running()
+        self.executor = self.new_executor()
+        self.logger = logging.getLogger(__name__)
+
+    def new_executor(self):
+        """New ProcessPoolExecutor with self.workers processes."""
+        try:
+            return concurrent.futures.ProcessPoolExecutor(
+                self.workers, initializer=pool_init, initargs=(self.modules,))
+        except TypeError:  # pragma: no cover # python < 3.7
+            return concurrent.futures.ProcessPoolExecutor(self.workers)
+
+    def recycle(self, worker_rss):
+        """Count a derivation, replace the workers if a limit is reached."""
+        with self.lock:
+            self.num_tasks += 1
+            limit = self.max_tasks * (self.workers or os.cpu_count() or 1)
+            if (not ((self.max_tasks and self.num_tasks >= limit) or
+                     (self.max_rss and worker_rss > self.max_rss))):
+                return
+            self.logger.info("Replacing pool workers after %d derivations, resident size %d bytes" %
+                             (self.num_tasks, worker_rss))
+            old = self.executor
+            self.executor = self.new_executor()
+            self.num_tasks = 0
+            self.num_recycled += 1
+        # let the old workers finish any derivations in progress
+        threading.Thread(target=old.shutdown, kwargs={'wait': True}).start()
+
+    def derive(self, klass, api_version, srcfile, iiif, pyramid=None, deadline=None):
+        """Derive image for iiif from srcfile in a worker process.
+
+        Positional arguments:
+        klass -- IIIFManipulator sub-class
+        api_version -- API version for the manipulator
+        srcfile -- source image file
+        iiif -- IIIFRequest object with parsed parameters
+
+        Keyword arguments:
+        pyramid -- IIIFPyramidCache for IIIFManipulatorPIL sub-classes
+        deadline -- time after which the derivation is abandoned
+
+        Exceptions in the worker, including IIIFError, are raised here.
+        Returns (outfile, mime_type) where outfile is a new temporary file
+        which the caller must remove.
+        """
+        with self.lock:
+            # not while the executor is being replaced
+            future = self.executor.submit(pool_derive, klass, api_version, srcfile, iiif,
+                                          pyramid, deadline, self.shm_threshold)
+        result = future.result()
+        self.recycle(result[4])
+        (fd, outfile) = tempfile.mkstemp(prefix='iiif_pool_')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                if (result[0] == 'shm'):
+                    shm = shared_memory.SharedMemory(name=result[1])
+                    try:
+                        fh.write(shm.buf[:result[2]])
+                    finally:
+                        shm.close()
+                        shm.unlink()
+                else:
+                    fh.write(result[1])
+        except Exception:
+            os.remove(outfile)
+            raise
+        return (outfile, result[3])
+
+    def shutdown(self):
+        """Shut down the worker processes once derivations in progress finish."""
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,389 @@
+"""Pre-fork multi-process server for IIIF Image API Flask applications.
+
+The application is created and warmed once in the master process, which
+then forks worker processes that share its memory copy-on-write and
+accept connections on one listening socket. Workers are replaced when
+they exit, so a worker can be recycled after a number of requests or
+when its memory use grows too large. Signals to the master process:
+
+  SIGHUP - gracefully replace all workers (e.g. after changes to images)
+  SIGTERM, SIGINT - gracefully stop workers and exit
+
+Requires os.fork() and so is not available on Windows.
+
+Also provides IIIFRecyclingServer, a single process threaded server that
+recycles itself in the same way by waiting for requests in progress and
+then re-executing the program with the listening socket kept open.
+"""
+
+import errno
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from PIL import Image
+from werkzeug.serving import BaseWSGIServer, ThreadedWSGIServer
+
+# Environment variable passing the listening socket to a recycled server
+RECYCLE_FD_ENV = 'IIIF_SERVER_FD'
+
+
+def rss():
+    """Resident set size of this process in bytes, 0 if not known."""
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:  # pragma: no cover # windows
+        return 0
+    # peak rather than current size, in bytes on macOS and kB elsewhere
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if (sys.platform == 'darwin') else maxrss * 1024
+
+
+def warm():
+    """Do work that would otherwise be repeated in each worker process.
+
+    Loads all PIL image plugins and, where supported, moves objects
+    created so far out of reach of the garbage collector so that it does
+    not touch (and so copy) the pages shared with the master process.
+    """
+    Image.init()
+    gc.collect()
+    if (hasattr(gc, 'freeze')):
+        gc.freeze()
+
+
+class _WorkerWSGIServer(BaseWSGIServer):
+    """Single-threaded WSGI server on a non-blocking shared listening socket."""
+
+    def get_request(self):
+        """Accept connection, raises OSError if another worker got it first."""
+        (conn, addr) = self.socket.accept()
+        conn.setblocking(True)
+        return (conn, addr)
+
+
+class IIIFPreforkServer(object):
+    """Pre-fork server for a WSGI application.
+
+    Typical use:
+
+        server = IIIFPreforkServer(app, port=8000, workers=4, max_requests=1000)
+        server.serve_forever()
+    """
+
+    def __init__(self, app, host='localhost', port=8000, workers=2,
+                 max_requests=0, max_rss=0, timeout=1.0):
+        """Initialize IIIFPreforkServer object.
+
+        Positional arguments:
+        app -- WSGI application
+
+        Keyword arguments:
+        host, port -- address to listen on, port 0 picks a free port
+        workers -- number of worker processes
+        max_requests -- if non-zero, recycle each worker after this many requests
+        max_rss -- if non-zero, recycle a worker after a request that leaves
+                   its resident set size larger than this many bytes
+        timeout -- seconds between checks for signals in idle workers
+        """
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.timeout = timeout
+        self.socket = None
+        self.pids = set()
+        self.running = False
+        self.stopping = False
+        self.num_requests = 0
+        self.logger = logging.getLogger(__name__)
+
+    def bind(self):
+        """Create the listening socket, sets self.port."""
+        family = socket.AF_INET6 if (':' in self.host) else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(128)
+        # all workers wait for connections, the ones that lose the race
+        # to accept must not block
+        sock.setblocking(False)
+        self.socket = sock
+        self.port = sock.getsockname()[1]
+
+    def serve_forever(self):
+        """Warm up, fork workers and replace them as they exit.
+
+        Returns after SIGTERM or SIGINT once all workers have exited.
+        """
+        if (self.socket is None):
+            self.bind()
+        warm()
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        self.logger.warning("Pre-fork server on http://%s:%d/ with %d workers" %
+                            (self.host, self.port, self.workers))
+        for n in range(self.workers):
+            self.spawn()
+        while (self.pids):
+            try:
+                (pid, status) = os.wait()
+            except OSError as e:
+                if (e.errno == errno.EINTR):
+                    continue
+                break
+            self.pids.discard(pid)
+            if (self.running):
+                self.logger.info("Worker %d exited (status %d), starting new worker" % (pid, status))
+                self.spawn()
+        self.socket.close()
+
+    def stop(self, signum=None, frame=None):
+        """Stop accepting new work, ask workers to finish and exit."""
+        self.running = False
+        self.kill_workers()
+
+    def reload(self, signum=None, frame=None):
+        """Ask workers to finish and exit, they are replaced as they exit."""
+        self.logger.warning("Replacing workers")
+        self.kill_workers()
+
+    def kill_workers(self):
+        """Send SIGTERM to all workers."""
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                # already exited
+                pass
+
+    def spawn(self):
+        """Fork a worker process."""
+        pid = os.fork()
+        if (pid != 0):
+            self.pids.add(pid)
+            return
+        code = 0
+        try:
+            self.pids = set()
+            self.worker()
+        except Exception as e:
+            self.logger.error("Worker %d failed (%s)" % (os.getpid(), str(e)))
+            code = 1
+        finally:
+            os._exit(code)
+
+    def worker(self):
+        """Worker process loop, serve requests until stopped or recycled."""
+        self.stopping = False
+        self.num_requests = 0
+        signal.signal(signal.SIGTERM, self.stop_worker)
+        signal.signal(signal.SIGINT, self.stop_worker)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        server = _WorkerWSGIServer(self.host, self.port, self.count_requests,
+                                   fd=self.socket.fileno())
+        server.timeout = self.timeout
+        while (not self.stopping):
+            server.handle_request()
+            if (self.max_requests and self.num_requests >= self.max_requests):
+                self.logger.info("Recycling worker %d after %d requests" %
+                                 (os.getpid(), self.num_requests))
+                break
+            if (self.max_rss and self.num_requests > 0 and rss() > self.max_rss):
+                self.logger.info("Recycling worker %d with resident size %d bytes" %
+                                 (os.getpid(), rss()))
+                break
+
+    def stop_worker(self, signum=None, frame=None):
+        """Stop worker once any request being handled is complete."""
+        self.stopping = True
+
+    def count_requests(self, environ, start_response):
+        """WSGI application counting requests, wrapping self.app."""
+        self.num_requests += 1
+        return self.app(environ, start_response)
+
+
+class _RecyclingWSGIServer(ThreadedWSGIServer):
+    """Threaded WSGI server reporting connections to an IIIFRecyclingServer."""
+
+    def __init__(self, owner, *args, **kwargs):
+        """Initialize with owner IIIFRecyclingServer, other arguments as for ThreadedWSGIServer."""
+        self.owner = owner
+        super(_RecyclingWSGIServer, self).__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        """Count connection and start thread to handle it."""
+        self.owner.connection_opened()
+        try:
+            super(_RecyclingWSGIServer, self).process_request(request, client_address)
+        except Exception:
+            self.owner.connection_closed()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        """Handle connection in thread, counting it as closed when done."""
+        try:
+            super(_RecyclingWSGIServer, self).process_request_thread(request, client_address)
+        finally:
+            self.owner.connection_closed()
+
+
+class IIIFRecyclingServer(object):
+    """Threaded single process server that recycles itself.
+
+    After max_requests requests, or once its resident set size exceeds
+    max_rss bytes, the server stops accepting connections, answers the
+    requests in progress with Connection: close, waits up to drain_timeout
+    seconds for their connections to close and then re-executes the
+    program (argv) with the listening socket inherited by the new process
+    so that no connections are refused meanwhile.
+
+    Typical use:
+
+        server = IIIFRecyclingServer(app, port=8000, max_requests=10000)
+        server.serve_forever()
+    """
+
+    def __init__(self, app, host='localhost', port=8000, max_requests=0, max_rss=0,
+                 drain_timeout=10.0, timeout=1.0, argv=None):
+        """Initialize IIIFRecyclingServer object.
+
+        Positional arguments:
+        app -- WSGI application
+
+        Keyword arguments:
+        host, port -- address to listen on, port 0 picks a free port
+        max_requests -- if non-zero, recycle after this many requests
+        max_rss -- if non-zero, recycle once the resident set size is
+                   larger than this many bytes
+        drain_timeout -- maximum seconds to wait for connections to close
+        timeout -- seconds between checks for recycling while idle
+        argv -- program and arguments to execute, default this program
+        """
+        self.app = app
+        self.host = host
+        self.port = port
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.drain_timeout = drain_timeout
+        self.timeout = timeout
+        self.argv = argv if (argv is not None) else [sys.executable] + sys.argv
+        self.server = None
+        self.condition = threading.Condition()
+        self.connections = 0
+        self.num_requests = 0
+        self.recycling = False
+        self.logger = logging.getLogger(__name__)
+
+    def bind(self):
+        """Create the server, on the socket inherited from the previous process if any."""
+        fd = os.environ.pop(RECYCLE_FD_ENV, None)
+        if (fd is not None):
+            fd = int(fd)
+        self.server = _RecyclingWSGIServer(self, self.host, self.port, self.count_requests, fd=fd)
+        if (fd is not None):
+            # the server has its own duplicate
+            os.close(fd)
+        self.server.timeout = self.timeout
+        self.port = self.server.socket.getsockname()[1]
+
+    def serve_forever(self):
+        """Serve requests until it is time to recycle, then restart()."""
+        if (self.server is None):
+            self.bind()
+        warm()
+        self.logger.warning("Server on http://%s:%d/ (pid %d)" % (self.host, self.port, os.getpid()))
+        while (not self.recycling):
+            self.server.handle_request()
+        self.drain()
+        self.restart()
+
+    def drain(self):
+        """Wait up to drain_timeout seconds for open connections to close."""
+        deadline = time.time() + self.drain_timeout
+        with self.condition:
+            while (self.connections > 0):
+                remaining = deadline - time.time()
+                if (remaining <= 0):
+                    self.logger.warning("Recycling with %d connections still open" % (self.connections))
+                    break
+                self.condition.wait(remaining)
+
+    def restart(self):
+        """Execute self.argv in this process, passing the listening socket."""
+        self.logger.warning("Recycling server after %d requests with resident size %d bytes" %
+                            (self.num_requests, rss()))
+        fd = self.server.fileno()
+        os.set_inheritable(fd, True)
+        env = dict(os.environ)
+        env[RECYCLE_FD_ENV] = str(fd)
+        os.execve(self.argv[0], self.argv, env)
+
+    def connection_opened(self):
+        """Count a new connection."""
+        with self.condition:
+            self.connections += 1
+
+    def connection_closed(self):
+        """Count a closed connection."""
+        with self.condition:
+            self.connections -= 1
+            self.condition.notify_all()
+
+    def count_requests(self, environ, start_response):
+        """WSGI application counting requests and checking limits, wrapping self.app."""
+        with self.condition:
+            self.num_requests += 1
+            if ((self.max_requests and self.num_requests >= self.max_requests) or
+                    (self.max_rss and rss() > self.max_rss)):
+                self.recycling = True
+
+        def start(status, headers, exc_info=None):
+            if (self.recycling):
+                headers = [h for h in headers if h[0].lower() != 'connection']
+                headers.append(('Connection', 'close'))
+            return start_response(status, headers, exc_info)
+        return self.app(environ, start)
+
+
+def run_recycling(app, cfg):
+    """Run Flask app in IIIFRecyclingServer as configured in cfg.
+
+    Uses cfg.app_host, cfg.app_port, cfg.max_requests and cfg.max_rss
+    (in MB).
+    """
+    server = IIIFRecyclingServer(app, host=cfg.app_host, port=cfg.app_port,
+                                 max_requests=cfg.max_requests,
+                                 max_rss=cfg.max_rss * 1024 * 1024)
+    server.serve_forever()
+
+
+def run_prefork(app, cfg):
+    """Run Flask app in IIIFPreforkServer as configured in cfg.
+
+    Uses cfg.app_host, cfg.app_port, cfg.prefork (number of workers),
+    cfg.max_requests and cfg.max_rss (in MB).
+    """
+    if (not hasattr(os, 'fork')):
+        logging.critical("Pre-fork server is not supported on this platform, aborting")
+        sys.exit(1)
+    server = IIIFPreforkServer(app, host=cfg.app_host, port=cfg.app_port,
+                               workers=cfg.prefork,
+                               max_requests=cfg.max_requests,
+                               max_rss=cfg.max_rss * 1024 * 1024)
+    server.serve_forever()
@@ -0,0 +1,138 @@
+"""Reduced resolution levels of source images for IIIF Image API servers.
+
+Requests for small images of large sources spend most of their time
+decoding the full resolution source. The IIIFPyramidCache stores
+versions of plain JPEG and PNG sources reduced by successive factors
+of two, in a format that is fast to decode, so that IIIFManipulatorPIL
+can read the smallest level with enough resolution for each request.
+"""
+
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+
+from PIL import Image
+
+# Source formats for which levels are built, other formats (e.g. tiled
+# pyramidal TIFF) are assumed to have their own reduced resolutions
+PYRAMID_SOURCE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+class IIIFPyramidCache(object):
+    """Disk cache of reduced resolution levels of source images.
+
+    The levels for each source image are held in a directory named for
+    the source path and modification time, so that levels for modified
+    sources are never used. The level with factor f is the source image
+    reduced in size by f, stored as an uncompressed PPM (color) or PGM
+    (grayscale) file. Levels are built down to the first level with both
+    dimensions smaller than min_size.
+
+    Typical use:
+
+        p = IIIFPyramidCache('/tmp/pyramids')
+        p.build('image.jpg')  # slow, e.g. in background
+        for (factor, path) in p.levels('image.jpg'):
+            # .. largest factor first
+    """
+
+    def __init__(self, cache_dir, min_size=256):
+        """Initialize IIIFPyramidCache object.
+
+        Positional arguments:
+        cache_dir -- base directory for level files
+
+        Keyword arguments:
+        min_size -- size in pixels below which no further levels are built
+        """
+        self.cache_dir = cache_dir
+        self.min_size = min_size
+        self.logger = logging.getLogger(__name__)
+
+    def source_dir(self, srcfile):
+        """Directory for levels of all versions of srcfile."""
+        name = hashlib.sha1(os.path.abspath(srcfile).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, name)
+
+    def levels_dir(self, srcfile):
+        """Directory for levels of the current version of srcfile."""
+        return os.path.join(self.source_dir(srcfile),
+                            repr(os.path.getmtime(srcfile)))
+
+    def levels(self, srcfile):
+        """List of (factor, path) for the levels of srcfile.
+
+        The list is in order of decreasing factor, and is empty if levels
+        have not been built for the current version of srcfile.
+        """
+        try:
+            dir = self.levels_dir(srcfile)
+            names = os.listdir(dir)
+        except OSError:
+            return []
+        levels = []
+        for name in names:
+            (factor, ext) = os.path.splitext(name)
+            if (factor.isdigit()):
+                levels.append((int(factor), os.path.join(dir, name)))
+        return sorted(levels, reverse=True)
+
+    def build(self, srcfile):
+        """Build levels for srcfile unless they are already built.
+
+        Levels are written to a temporary directory that is then renamed
+        into place, so that levels are never seen partially built. Levels
+        for earlier versions of srcfile are removed. Only JPEG and PNG
+        grayscale and color images are handled.
+
+        Returns the number of levels built.
+        """
+        if (os.path.splitext(srcfile)[1].lower() not in PYRAMID_SOURCE_EXTENSIONS or
+                self.levels(srcfile)):
+            return 0
+        dir = self.levels_dir(srcfile)
+        source_dir = os.path.dirname(dir)
+        if (not os.path.isdir(source_dir)):
+            try:
+                os.makedirs(source_dir)
+            except OSError:
+                # may have been created by another thread/process
+                if (not os.path.isdir(source_dir)):
+                    raise
+        tmp = tempfile.mkdtemp(dir=source_dir, prefix='.tmp')
+        try:
+            image = Image.open(srcfile)
+            if (image.mode not in ('L', 'RGB')):
+                self.logger.info("Not building levels for %s image %s" % (image.mode, srcfile))
+                return 0
+            factor = 1
+            while (max(image.size) >= 2 * self.min_size):
+                factor *= 2
+                size = ((image.size[0] + 1) // 2, (image.size[1] + 1) // 2)
+                image = image.resize(size, Image.BOX)
+                image.save(os.path.join(tmp, '%d.%s' % (factor, 'pgm' if image.mode == 'L' else 'ppm')),
+                           'PPM')
+            num = len(os.listdir(tmp))
+            if (num == 0):
+                return 0
+            os.rename(tmp, dir)
+            tmp = None
+        except OSError as e:
+            # another process may have built the same levels
+            if (self.levels(srcfile)):
+                return 0
+            self.logger.warning("Failed to build levels for %s (%s)" % (srcfile, str(e)))
+            return 0
+        finally:
+            if (tmp is not None):
+                shutil.rmtree(tmp, ignore_errors=True)
+        # remove levels for earlier versions of the source
+        for name in os.listdir(source_dir):
+            path = os.path.join(source_dir, name)
+            if (path != dir and not name.startswith('.')):
+                shutil.rmtree(path, ignore_errors=True)
+        self.logger.info("Built %d levels for %s" % (num, srcfile))
+        return num
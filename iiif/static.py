@@ -54,6 +54,67 @@ def static_partial_tile_sizes(width, height, tilesize, scale_factors):
                 yield([rx, ry, rw, rh], [sw, sh])
 
 
+def static_tile_neighbours(region, sw, width, height, tilesize, scale_factors):
+    """List of tiles a panning or zooming viewer is likely to request next.
+
+    Positional arguments:
+    region -- [rx,ry,rw,rh] region of the current tile
+    sw -- width of the current tile
+    width -- width of full size image
+    height -- height of full size image
+    tilesize -- width and height of tiles
+    scale_factors -- iterable of scale factors, typically [1,2,4..]
+
+    Returns a list of ([rx,ry,rw,rh],[sw,sh]) for the adjacent tiles at the
+    same scale factor and the parent tile at the next larger scale factor
+    (unless that would be a full-region image), in the same form as
+    static_partial_tile_sizes(). Returns [] if region and sw do not describe
+    a tile in the grid.
+    """
+    (rx, ry, rw, rh) = region
+    scale_factors = sorted(scale_factors)
+    for sf in scale_factors:
+        rts = tilesize * sf
+        if (rx % rts == 0 and ry % rts == 0 and rx < width and ry < height and
+                rw == min(rts, width - rx) and rh == min(rts, height - ry) and
+                sw == (rw + sf - 1) // sf):
+            break
+    else:
+        return []
+    tiles = []
+    for (dx, dy) in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+        nx = rx + dx * rts
+        ny = ry + dy * rts
+        if (nx >= 0 and nx < width and ny >= 0 and ny < height):
+            tiles.append(static_tile(nx, ny, sf, width, height, tilesize))
+    larger = [f for f in scale_factors if f > sf]
+    if (larger):
+        psf = larger[0]
+        prts = tilesize * psf
+        if (prts < width or prts < height):
+            tiles.append(static_tile((rx // prts) * prts, (ry // prts) * prts,
+                                     psf, width, height, tilesize))
+    return tiles
+
+
+def static_tile(rx, ry, sf, width, height, tilesize):
+    """Region and size of one tile.
+
+    Positional arguments:
+    rx, ry -- offset of tile in full size image, multiples of tilesize * sf
+    sf -- scale factor
+    width -- width of full size image
+    height -- height of full size image
+    tilesize -- width and height of tiles
+
+    Returns ([rx,ry,rw,rh],[sw,sh]) as for static_partial_tile_sizes().
+    """
+    rts = tilesize * sf
+    rw = min(rts, width - rx)
+    rh = min(rts, height - ry)
+    return([rx, ry, rw, rh], [(rw + sf - 1) // sf, (rh + sf - 1) // sf])
+
+
 def static_full_sizes(width, height, tilesize):
     """Generator for scaled-down full image sizes.
 
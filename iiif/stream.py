@@ -0,0 +1,149 @@
+"""Streaming of derived images into HTTP responses.
+
+Encoders normally write the whole output image to a file before the
+first byte of the response is sent. IIIFStream is a write-only file-like
+object that an encoder running in one thread writes into while the
+response iterator in another thread yields the data in chunks. The
+client receives the start of a large image while the rest is still
+being encoded, and because the queue between the threads is bounded the
+whole output is never held in memory.
+"""
+
+import threading
+try:  # python3
+    import queue
+except ImportError:  # pragma: no cover # python2
+    import Queue as queue
+
+# Size of the chunks passed from the encoder to the response
+STREAM_CHUNK_SIZE = 65536
+
+
+class IIIFStream(object):
+    """Bounded pipe from an encoder thread to a response iterator.
+
+    Typical use:
+
+        stream = IIIFStream()
+        def encode():
+            try:
+                image.save(stream, format='jpeg')
+                stream.finish()
+            except Exception as e:
+                stream.finish(e)
+        stream.start(encode)
+        stream.wait()  # raises exception if encoding failed at once
+        return Response(stream)
+
+    The writer blocks when queue_size chunks are waiting to be read. If
+    the reader stops early (close() is called, e.g. because the client
+    went away) then further writes raise IOError so that the encoder
+    gives up.
+    """
+
+    def __init__(self, chunk_size=STREAM_CHUNK_SIZE, queue_size=4, poll=0.1):
+        """Initialize IIIFStream object.
+
+        Keyword arguments:
+        chunk_size -- writes are collected into chunks of at least this size
+        queue_size -- maximum number of chunks waiting to be read
+        poll -- seconds between checks that the reader is still there
+                while the writer is blocked
+        """
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(queue_size)
+        self.poll = poll
+        self.buffer = []
+        self.buffered = 0
+        self.finished = False
+        self.closed = False
+        self.first = None
+        self.peeked = False
+        self.thread = None
+
+    def write(self, data):
+        """Write data, called by the encoder."""
+        self.buffer.append(bytes(data))
+        self.buffered += len(data)
+        if (self.buffered >= self.chunk_size):
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        """Pass any buffered data to the reader."""
+        if (self.buffered > 0):
+            data = b''.join(self.buffer)
+            self.buffer = []
+            self.buffered = 0
+            self.put(data)
+
+    def put(self, item):
+        """Put item in queue, waiting while it is full."""
+        while True:
+            if (self.closed):
+                raise IOError("Stream closed by reader")
+            try:
+                self.queue.put(item, timeout=self.poll)
+                return
+            except queue.Full:
+                pass
+
+    def finish(self, error=None):
+        """Signal end of data, or that writing failed with exception error."""
+        if (self.finished):
+            return
+        self.finished = True
+        try:
+            if (error is None):
+                self.flush()
+            self.put(error)
+        except IOError:
+            # reader has gone
+            pass
+
+    def start(self, target, *args):
+        """Run target(*args) as the writer in a new daemon thread.
+
+        The target must call finish() when done.
+        """
+        self.thread = threading.Thread(target=target, args=args)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self):
+        """Next item from the writer, raises the exception if writing failed."""
+        if (self.peeked):
+            (item, self.first, self.peeked) = (self.first, None, False)
+        else:
+            item = self.queue.get()
+        if (isinstance(item, Exception)):
+            raise item
+        return item
+
+    def wait(self):
+        """Wait for the first data or the end of writing.
+
+        Raises the exception passed to finish() if writing failed before
+        any data was written, so that the error can still be reported in
+        the response status.
+        """
+        if (not self.peeked):
+            self.first = self.queue.get()
+            self.peeked = True
+        if (isinstance(self.first, Exception)):
+            self.get()
+
+    def __iter__(self):
+        """Iterate over chunks of data, for the response body."""
+        try:
+            while True:
+                data = self.get()
+                if (data is None):
+                    return
+                yield data
+        finally:
+            self.closed = True
+
+    def close(self):
+        """Stop reading, the writer gets IOError on its next write."""
+        self.closed = True
@@ -0,0 +1,188 @@
+"""Cache warming for IIIF Image API servers.
+
+Computes the tile and size requests that a tiling viewer such as
+OpenSeadragon will make for an image, based on its Image Information
+(info.json), and requests them from a server so that the server's
+derivative cache is populated before real traffic arrives.
+"""
+
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+try:  # python3
+    from urllib.request import urlopen
+except ImportError:  # pragma: no cover # python2
+    from urllib2 import urlopen
+
+from .manipulator import IIIFManipulator
+from .request import IIIFRequest
+from .static import static_partial_tile_sizes, static_full_sizes
+
+
+def warm_requests(width, height, tile_width, scale_factors=None,
+                  api_version='2.1', format='jpg', levels=None):
+    """Generator for request paths that a viewer will use for an image.
+
+    Positional arguments:
+    width -- width of full size image
+    height -- height of full size image
+    tile_width -- width and height of tiles
+
+    Keyword arguments:
+    scale_factors -- list of tile scale factors, calculated as for info.json
+                     with 'auto' scale factors if not given
+    api_version -- IIIF Image API version to generate paths for
+    format -- image format
+    levels -- if set, include tiles only for this number of zoom levels
+              starting from the lowest zoom (largest scale factor). The
+              scaled full-region images are always included
+
+    Yields request paths without identifier, e.g. 'full/90,/0/default.jpg',
+    starting with the smallest full-region sizes and then tiles from the
+    largest scale factor down, so that low-zoom images are warmed first.
+    """
+    if (scale_factors is None):
+        m = IIIFManipulator(api_version=api_version)
+        m.width = width
+        m.height = height
+        scale_factors = m.scale_factors(tile_width)
+    scale_factors = sorted(scale_factors, reverse=True)
+    if (levels is not None):
+        scale_factors = scale_factors[:levels]
+    r = IIIFRequest(identifier='', api_version=api_version)
+    for (sw, sh) in reversed(list(static_full_sizes(width, height, tile_width))):
+        yield _path(r, 'full', sw, sh, api_version, format)
+    for sf in scale_factors:
+        for (region, size) in static_partial_tile_sizes(width, height, tile_width, [sf]):
+            yield _path(r, "%d,%d,%d,%d" % tuple(region),
+                        size[0], size[1], api_version, format)
+
+
+def _path(r, region, sw, sh, api_version, format):
+    # Path for one request in the form used by OpenSeadragon, which
+    # is the canonical form for the API version. The request r has
+    # empty baseurl and identifier so the URL is '/' then the path
+    if (api_version >= '3.0'):
+        size = "%d,%d" % (sw, sh)
+    else:
+        size = "%d," % (sw)
+    r.format = format
+    return r.url(region=region, size=size, rotation='0', quality=r.default_quality)[1:]
+
+
+class IIIFCacheWarmer(object):
+    """Warm the cache of a IIIF Image API server.
+
+    Typical use:
+
+        w = IIIFCacheWarmer('http://localhost:8000/2.1_pil', workers=8)
+        w.warm('starfish')
+    """
+
+    def __init__(self, base_url, workers=4, levels=None, format='jpg',
+                 dryrun=False, timeout=60):
+        """Initialize IIIFCacheWarmer object.
+
+        Positional arguments:
+        base_url -- server and prefix to request images from
+
+        Keyword arguments:
+        workers -- number of requests to make in parallel
+        levels -- limit number of tile zoom levels warmed (see warm_requests)
+        format -- image format to request
+        dryrun -- True to log requests but not make them
+        timeout -- timeout for each request in seconds
+        """
+        self.base_url = base_url.rstrip('/')
+        self.workers = workers
+        self.levels = levels
+        self.format = format
+        self.dryrun = dryrun
+        self.timeout = timeout
+        self.logger = logging.getLogger(__name__)
+
+    def get(self, url):
+        """GET url and return the response body."""
+        fh = urlopen(url, timeout=self.timeout)
+        try:
+            return fh.read()
+        finally:
+            fh.close()
+
+    def info(self, identifier):
+        """Get Image Information for identifier as a dict."""
+        r = IIIFRequest(identifier=identifier, baseurl=self.base_url + '/')
+        body = self.get(r.url(info=True))
+        return json.loads(body.decode('utf-8'))
+
+    def urls(self, identifier):
+        """List of URLs a viewer will request for identifier."""
+        info = self.info(identifier)
+        api_version = info_api_version(info)
+        tile_width = None
+        scale_factors = None
+        if ('tiles' in info and info['tiles']):
+            tile_width = info['tiles'][0]['width']
+            scale_factors = info['tiles'][0].get('scaleFactors')
+        elif ('tile_width' in info):  # 1.x
+            tile_width = info['tile_width']
+            scale_factors = info.get('scale_factors')
+        if (not tile_width):
+            tile_width = 512
+        r = IIIFRequest(identifier=identifier, baseurl=self.base_url + '/')
+        base = r.url(info=True)[:-len('info.json')]
+        return [base + path for path in
+                warm_requests(info['width'], info['height'], tile_width,
+                              scale_factors=scale_factors, api_version=api_version,
+                              format=self.format, levels=self.levels)]
+
+    def warm_url(self, url):
+        """Request url, return (url, error) where error is None on success."""
+        if (self.dryrun):
+            self.logger.info("would get %s" % (url))
+            return (url, None)
+        try:
+            self.get(url)
+            self.logger.info("got %s" % (url))
+            return (url, None)
+        except Exception as e:
+            self.logger.warning("failed to get %s (%s)" % (url, str(e)))
+            return (url, str(e))
+
+    def warm(self, identifier):
+        """Warm cache for identifier.
+
+        Returns (num_ok, num_failed) counts of requests.
+        """
+        urls = self.urls(identifier)
+        num_failed = 0
+        pool = ThreadPool(self.workers)
+        try:
+            for (url, error) in pool.imap_unordered(self.warm_url, urls):
+                if (error is not None):
+                    num_failed += 1
+        finally:
+            pool.close()
+            pool.join()
+        self.logger.warning("%s: %d requests, %d failed" %
+                            (identifier, len(urls), num_failed))
+        return (len(urls) - num_failed, num_failed)
+
+
+def info_api_version(info):
+    """IIIF Image API version of Image Information in info dict.
+
+    Looks at the @context or profile values, defaults to 2.1.
+    """
+    context = info.get('@context', '')
+    if (isinstance(context, list)):
+        context = ' '.join(context)
+    if ('image/3' in context):
+        return '3.0'
+    elif ('image/2' in context):
+        return '2.1'
+    elif ('1.1' in context):
+        return '1.1'
+    elif ('image-api' in context):
+        return '1.0'
+    return '2.1'
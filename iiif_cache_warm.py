@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""iiif_cache_warm: Warm the derivative cache of a IIIF Image API server.
+
+Requests the info.json for each image and then all of the tiles and
+scaled full-region images that a tiling viewer would request, so that
+they are in the server's derivative cache (see --cache-dir option of
+iiif_testserver.py) before real traffic arrives.
+"""
+
+import logging
+import optparse
+import sys
+import os.path
+
+from iiif import __version__
+from iiif.flask_utils import Config, identifiers
+from iiif.warm import IIIFCacheWarmer
+
+
+def main():
+    """Parse arguments, instantiate IIIFCacheWarmer, run."""
+    if (sys.version_info < (2, 7)):
+        sys.exit("This program requires python version 2.7 or later")
+
+    # Options and arguments
+    p = optparse.OptionParser(description='IIIF Image API server cache warmer',
+                              usage='usage: %prog [options] [identifier [identifier2..]] (-h for help)',
+                              version='%prog ' + __version__)
+
+    p.add_option('--base-url', '-b', action='store', default='http://localhost:8000/2.1_pil',
+                 help="Base URL of server including prefix, identifiers are appended to "
+                      "this [default '%default']")
+    p.add_option('--image-dir', '-d', action='store', default=None,
+                 help="Warm all images in this directory, identifiers are the file "
+                      "names without extension as used by iiif_testserver.py")
+    p.add_option('--levels', '-l', action='store', type='int', default=None,
+                 help="Warm tiles for only this number of zoom levels starting from the "
+                      "lowest zoom level, scaled full-region images are always warmed "
+                      "[default all levels]")
+    p.add_option('--workers', '-w', action='store', type='int', default=4,
+                 help="Number of requests to make in parallel [default %default]")
+    p.add_option('--format', '-f', action='store', default='jpg',
+                 help="Image format to request [default %default]")
+    p.add_option('--timeout', action='store', type='float', default=60,
+                 help="Timeout for each request in seconds [default %default]")
+    p.add_option('--dryrun', '-n', action='store_true',
+                 help="Get info.json but do not request images, say what would be done")
+    p.add_option('--quiet', '-q', action='store_true',
+                 help="Quite (no output unless there is a warning/error)")
+    p.add_option('--verbose', '-v', action='store_true',
+                 help="Verbose")
+
+    (opt, ids) = p.parse_args()
+
+    level = logging.DEBUG if (opt.verbose) else \
+        logging.WARNING if (opt.quiet) else logging.INFO
+    logging.basicConfig(format='%(name)s: %(message)s',
+                        level=level)
+    logger = logging.getLogger(os.path.basename(__file__))
+
+    if (opt.image_dir):
+        config = Config(opt)
+        config.klass_name = 'pil'
+        ids.extend(sorted(identifiers(config)))
+    if (len(ids) == 0):
+        logger.warning("No identifiers specified, nothing to do, bye! (-h for help)")
+        return
+    warmer = IIIFCacheWarmer(opt.base_url, workers=opt.workers, levels=opt.levels,
+                             format=opt.format, dryrun=opt.dryrun, timeout=opt.timeout)
+    num_failed = 0
+    for identifier in ids:
+        try:
+            (ok, failed) = warmer.warm(identifier)
+            num_failed += failed
+        except Exception as e:
+            # catch errors getting info.json and report nicely...
+            logger.error("Error warming %s: %s" % (identifier, str(e)))
+            num_failed += 1
+    if (num_failed > 0):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
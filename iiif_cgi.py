@@ -3,10 +3,19 @@
 
 Relies upon IIIFManupulator object to do the image
 manipulations requested.
+
+Run without arguments as a CGI script. With --scgi ADDRESS it instead
+runs as a persistent SCGI worker listening on ADDRESS (host:port or the
+path of a Unix socket) so that the interpreter, imports and manipulator
+setup are reused across requests. SCGI responses have the same format as
+CGI output, the web server passes requests with e.g. nginx scgi_pass or
+Apache mod_proxy_scgi.
 """
 
-import http.server
+import io
+import optparse
 import re
+import socketserver
 import sys
 import os
 import os.path
@@ -26,19 +35,23 @@ SHELL_SETUP = ''
 
 
 class CGI_responder(object):
-    """Simple helper class for CGI response."""
+    """Simple helper class for CGI response written to binary file self.wfile."""
 
     def send_response(self, code, text=''):
         """Write HTTP status code and optional explanation."""
-        print("Status: %s %s\r" % (str(code), text))
+        self.write_line("Status: %s %s" % (str(code), text))
 
     def send_header(self, header, value):
         """Write HTTP header."""
-        print("%s: %s\r" % (header, value))
+        self.write_line("%s: %s" % (header, value))
 
     def end_headers(self):
         """End HTTP headers with blank line."""
-        print("\r")
+        self.write_line("")
+
+    def write_line(self, line):
+        """Write header line with CRLF line ending."""
+        self.wfile.write((line + "\r\n").encode('latin-1'))
 
 
 class IIIFRequestHandler(CGI_responder):
@@ -47,19 +60,22 @@ class IIIFRequestHandler(CGI_responder):
     Minimal implementation of HTTP request handler to do IIIF GET.
     """
 
-    manipulator_class = None
+    def __init__(self, environ=None, wfile=None):
+        """Initialize IIIFRequestHandler object.
 
-    def __init__(self):
-        """Initialize IIIFRequestHandler object."""
+        Keyword arguments:
+        environ -- CGI environment of the request, default os.environ
+        wfile -- binary file to write the response to, default stdout
+        """
         self.debug = True
         self.compliance_uri = None
-        # Cannot use super() because BaseHTTPServer.BaseHTTPRequestHandler
-        # is not new style class
-        # super(IIIFRequestHandler, self).__init__(request, client_address, server)
-        # BaseHTTPServer.BaseHTTPRequestHandler.__init__(self, request, client_address, server)
-        self.path = (os.environ['PATH_INFO'] if (
-            'PATH_INFO' in os.environ) else '/bogus')
-        self.wfile = sys.stdout
+        if (environ is None):
+            environ = os.environ
+        self.path = (environ['PATH_INFO'] if (
+            'PATH_INFO' in environ) else '/bogus')
+        self.manipulator_class = manipulator_class(
+            environ['SCRIPT_NAME'] if ('SCRIPT_NAME' in environ) else '/iiif_dummy.cgi')
+        self.wfile = wfile if (wfile is not None) else sys.stdout.buffer
 
     def error_response(self, code, content=''):
         """Construct and send error response."""
@@ -67,7 +83,7 @@ class IIIFRequestHandler(CGI_responder):
         self.send_header('Content-Type', 'text/xml')
         self.add_compliance_header()
         self.end_headers()
-        self.wfile.write(content)
+        self.wfile.write(content.encode('utf-8'))
 
     def add_compliance_header(self):
         """Add IIIF compliance level header."""
@@ -98,6 +114,7 @@ class IIIFRequestHandler(CGI_responder):
                 if (not buffer):
                     break
                 self.wfile.write(buffer)
+            of.close()
             # Now cleanup
             self.manipulator.cleanup()
         except IIIFError as e:
@@ -120,15 +137,15 @@ class IIIFRequestHandler(CGI_responder):
                             text="URI Too Long: Max 1024 chars, got %d\n" % len(self.path))
         try:
             # self.path has leading / then identifier/params...
-            self.path = self.path.lstrip('/')
-            sys.stderr.write("path = %s" % (self.path))
+            self.path = '/' + self.path.lstrip('/')
+            sys.stderr.write("path = %s\n" % (self.path))
             iiif.parse_url(self.path)
         except Exception as e:
             # Something completely unexpected => 500
             raise IIIFError(code=500,
                             text="Internal Server Error: unexpected exception parsing request (" + str(e) + ")")
         # Now we have a full iiif request
-        if (re.match('[\w\.\-]+$', iiif.identifier)):
+        if (re.match(r'[\w\.\-]+$', iiif.identifier)):
             file = os.path.join(TESTIMAGE_DIR, iiif.identifier)
             if (not os.path.isfile(file)):
                 images_available = ""
@@ -141,7 +158,7 @@ class IIIFRequestHandler(CGI_responder):
             raise IIIFError(code=404, parameter="identifier",
                             text="Image resource '" + iiif.identifier + "' not found. Only local test images and http: URIs for images are supported.\n")
         # Now know image is OK
-        manipulator = IIIFRequestHandler.manipulator_class()
+        manipulator = self.manipulator_class()
         # Stash manipulator object so we can cleanup after reading file
         self.manipulator = manipulator
         self.compliance_uri = manipulator.compliance_uri
@@ -155,28 +172,133 @@ class IIIFRequestHandler(CGI_responder):
             i.identifier = self.iiif.identifier
             i.width = manipulator.width
             i.height = manipulator.height
-            import io
-            return(io.StringIO(i.as_json()), "application/json")
+            return(io.BytesIO(i.as_json().encode('utf-8')), "application/json")
         else:
             (outfile, mime_type) = manipulator.derive(file, iiif)
-            return(open(outfile, 'r'), mime_type)
-
-myname = (os.environ['SCRIPT_NAME'] if (
-    'SCRIPT_NAME' in os.environ) else '/iiif_dummy.cgi')
-
-if (re.match(myname, '/iiif_dummy') is not None):
-    from iiif.manipulator_dummy import IIIFManipulatorDummy
-    IIIFRequestHandler.manipulator_class = IIIFManipulatorDummy
-elif (re.match(myname, '/iiif_netpbm') is not None):
-    from iiif.manipulator_netpbm import IIIFManipulatorNetpbm
-    IIIFManipulatorNetpbm.find_binaries(tmpdir=TMP_DIR,
-                                        shellsetup=SHELL_SETUP,
-                                        pnmdir=PNM_DIR)
-    IIIFRequestHandler.manipulator_class = IIIFManipulatorNetpbm
-else:
-    # Assume PIL requested (normal path '/iiif_pil'
-    from iiif.manipulator_pil import IIIFManipulatorPIL
-    IIIFRequestHandler.manipulator_class = IIIFManipulatorPIL
-
-rh = IIIFRequestHandler()
-rh.do_GET()
+            return(open(outfile, 'rb'), mime_type)
+
+
+# Manipulator classes already imported and set up, by name
+MANIPULATOR_CLASSES = {}
+
+
+def manipulator_class(script_name):
+    """Manipulator class for requests to script_name.
+
+    Each class is imported and set up once so that a persistent worker
+    pays the cost only for the first request.
+    """
+    if (re.match('/iiif_dummy', script_name) is not None):
+        name = 'dummy'
+    elif (re.match('/iiif_netpbm', script_name) is not None):
+        name = 'netpbm'
+    else:
+        # Assume PIL requested (normal path '/iiif_pil'
+        name = 'pil'
+    if (name not in MANIPULATOR_CLASSES):
+        if (name == 'dummy'):
+            from iiif.manipulator import IIIFManipulator
+            MANIPULATOR_CLASSES[name] = IIIFManipulator
+        elif (name == 'netpbm'):
+            from iiif.manipulator_netpbm import IIIFManipulatorNetpbm
+            IIIFManipulatorNetpbm.find_binaries(tmpdir=TMP_DIR,
+                                                shellsetup=SHELL_SETUP,
+                                                pnmdir=PNM_DIR)
+            MANIPULATOR_CLASSES[name] = IIIFManipulatorNetpbm
+        else:
+            from iiif.manipulator_pil import IIIFManipulatorPIL
+            MANIPULATOR_CLASSES[name] = IIIFManipulatorPIL
+    return MANIPULATOR_CLASSES[name]
+
+
+def read_scgi_environ(rfile):
+    """Read SCGI request headers from rfile and return environ dict.
+
+    The headers are a netstring of NUL separated names and values, see
+    https://python.ca/scgi/protocol.txt. Raises ValueError if badly formed.
+    """
+    length = b''
+    while True:
+        c = rfile.read(1)
+        if (c == b':' and length):
+            break
+        if (not c.isdigit() or len(length) > 10):
+            raise ValueError("bad netstring length")
+        length += c
+    data = rfile.read(int(length) + 1)
+    if (len(data) != int(length) + 1 or data[-1:] != b','):
+        raise ValueError("bad netstring")
+    items = data[:-1].split(b'\0')
+    if (items[-1:] == [b'']):
+        # each name and value is followed by NUL
+        items.pop()
+    if (len(items) % 2 != 0):
+        raise ValueError("odd number of header names and values")
+    return dict((k.decode('latin-1'), v.decode('latin-1'))
+                for (k, v) in zip(items[0::2], items[1::2]))
+
+
+class SCGIRequestHandler(socketserver.StreamRequestHandler):
+    """Handle one SCGI connection with IIIFRequestHandler."""
+
+    def handle(self):
+        """Read request environ and write CGI format response."""
+        try:
+            environ = read_scgi_environ(self.rfile)
+        except ValueError as e:
+            sys.stderr.write("Bad SCGI request: %s\n" % (str(e)))
+            return
+        IIIFRequestHandler(environ=environ, wfile=self.wfile).do_GET()
+
+
+class SCGIServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Threaded SCGI server on a TCP socket."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if (hasattr(socketserver, 'UnixStreamServer')):
+    class UnixSCGIServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        """Threaded SCGI server on a Unix socket."""
+
+        daemon_threads = True
+
+
+def scgi_server(address):
+    """SCGI server for address, host:port or the path of a Unix socket."""
+    m = re.match(r'(.*):(\d+)$', address)
+    if (m):
+        return SCGIServer((m.group(1) or 'localhost', int(m.group(2))), SCGIRequestHandler)
+    if (os.path.exists(address)):
+        os.remove(address)
+    return UnixSCGIServer(address, SCGIRequestHandler)
+
+
+def main():
+    """Handle one CGI request, or run as an SCGI worker with --scgi."""
+    p = optparse.OptionParser(description='IIIF Image API CGI script and SCGI worker',
+                              usage='usage: %prog [--scgi ADDRESS]')
+    p.add_option('--scgi', action='store', default=None,
+                 help="Run as a persistent SCGI worker listening on ADDRESS, "
+                      "host:port or the path of a Unix socket")
+    (opt, args) = p.parse_args()
+    if (opt.scgi is None):
+        rh = IIIFRequestHandler()
+        rh.do_GET()
+        sys.stdout.flush()
+        return
+    # Import and set up manipulator before the first request
+    manipulator_class(os.environ['SCRIPT_NAME'] if ('SCRIPT_NAME' in os.environ) else '/iiif_pil')
+    server = scgi_server(opt.scgi)
+    sys.stderr.write("SCGI worker listening on %s\n" % (opt.scgi))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""iiif_ingest: Convert master images to tiled multi-resolution TIFF.
+
+Writes one TIFF file for each JPEG, PNG or TIFF master, with tiles and
+resolution levels matching those advertised in info.json by
+iiif_testserver.py and iiif_reference_server.py. Requires the tifffile
+package.
+"""
+
+import logging
+import optparse
+import sys
+import os.path
+
+from iiif import __version__
+from iiif.ingest import IIIFIngest
+
+
+def main():
+    """Parse arguments, instantiate IIIFIngest, run."""
+    if (sys.version_info < (2, 7)):
+        sys.exit("This program requires python version 2.7 or later")
+
+    # Options and arguments
+    p = optparse.OptionParser(description='IIIF Image API master image ingest',
+                              usage='usage: %prog [options] dir_or_file [[dir_or_file2..]] (-h for help)',
+                              version='%prog ' + __version__)
+
+    p.add_option('--dst', '-d', action='store', default='/tmp',
+                 help="Destination directory for TIFF files [default '%default']")
+    p.add_option('--tile-width', action='store', type='int', default=512,
+                 help="Tile width, should match the server --tile-width [default %default]")
+    p.add_option('--tile-height', action='store', type='int', default=512,
+                 help="Tile height, should match the server --tile-height [default %default]")
+    p.add_option('--workers', '-w', action='store', type='int', default=None,
+                 help="Number of processes to convert images in parallel "
+                      "[default number of CPUs]")
+    p.add_option('--compression', action='store', default='zlib',
+                 help="Compression for tiles, any supported by tifffile [default %default]")
+    p.add_option('--max-image-pixels', action='store', type='int', default=0,
+                 help="Set the maximum number of pixels in an image. A non-zero value "
+                      "will set a hard limit on the image size")
+    p.add_option('--dryrun', '-n', action='store_true',
+                 help="Do not write anything, say what would be done")
+    p.add_option('--quiet', '-q', action='store_true',
+                 help="Quite (no output unless there is a warning/error)")
+    p.add_option('--verbose', '-v', action='store_true',
+                 help="Verbose")
+
+    (opt, sources) = p.parse_args()
+
+    level = logging.DEBUG if (opt.verbose) else \
+        logging.WARNING if (opt.quiet) else logging.INFO
+    logging.basicConfig(format='%(name)s: %(message)s',
+                        level=level)
+    logger = logging.getLogger(os.path.basename(__file__))
+
+    if (len(sources) == 0):
+        logger.warning("No sources specified, nothing to do, bye! (-h for help)")
+        return
+    ingest = IIIFIngest(dst=opt.dst, tile_width=opt.tile_width,
+                        tile_height=opt.tile_height, workers=opt.workers,
+                        compression=opt.compression,
+                        max_image_pixels=opt.max_image_pixels,
+                        dryrun=opt.dryrun)
+    num_failed = 0
+    for source in sources:
+        try:
+            if (os.path.isdir(source)):
+                num_failed += ingest.ingest(source)[2]
+            elif (os.path.isfile(source)):
+                dst = ingest.output_path(source)
+                if (ingest.up_to_date(source, dst)):
+                    logger.info("Skipping up-to-date %s" % (dst))
+                else:
+                    scale_factors = ingest.convert(source, dst)
+                    logger.info("%s -> %s (scale factors %s)" % (source, dst, scale_factors))
+            else:
+                logger.warning("Ignoring source '%s': neither file nor directory" % (source))
+        except Exception as e:
+            # report and go on to the next source, as ingest() does for
+            # each master in a directory
+            logger.error("Error converting %s: %s" % (source, str(e)))
+            num_failed += 1
+    if (num_failed > 0):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
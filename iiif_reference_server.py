@@ -15,7 +15,7 @@ import os
 import os.path
 import sys
 
-from iiif.flask_utils import Config, write_pid_file, add_handler, make_prefix, ReverseProxied, setup_app, split_comma_argument, add_shared_configs
+from iiif.flask_utils import Config, write_pid_file, add_handler, make_prefix, ReverseProxied, setup_app, split_comma_argument, add_shared_configs, warm_app
 
 
 def get_config(base_dir=''):
@@ -82,4 +82,15 @@ if __name__ == '__main__':
     cfg = get_config()
     app = create_reference_server_flask_app(cfg)
     setup_app(app, cfg)
-    app.run(host=cfg.app_host, port=cfg.app_port)
+    warm_app(app)
+    if (cfg.asgi):
+        from iiif.asgi import run_asgi
+        run_asgi(app, cfg)
+    elif (cfg.prefork):
+        from iiif.prefork import run_prefork
+        run_prefork(app, cfg)
+    elif (cfg.max_requests or cfg.max_rss):
+        from iiif.prefork import run_recycling
+        run_recycling(app, cfg)
+    else:
+        app.run(host=cfg.app_host, port=cfg.app_port)
@@ -16,7 +16,7 @@ import os
 import os.path
 import sys
 
-from iiif.flask_utils import Config, write_pid_file, add_handler, make_prefix, top_level_index_page, serve_static, ReverseProxied, setup_app, split_comma_argument, add_shared_configs
+from iiif.flask_utils import Config, write_pid_file, add_handler, make_prefix, top_level_index_page, serve_static, ReverseProxied, setup_app, split_comma_argument, add_shared_configs, warm_app
 
 
 def get_config(base_dir=''):
@@ -133,4 +133,15 @@ if __name__ == '__main__':
     write_pid_file()
     cfg = get_config()
     app = setup_app(create_testserver_flask_app(cfg), cfg)
-    app.run(host=cfg.app_host, port=cfg.app_port)
+    warm_app(app)
+    if (cfg.asgi):
+        from iiif.asgi import run_asgi
+        run_asgi(app, cfg)
+    elif (cfg.prefork):
+        from iiif.prefork import run_prefork
+        run_prefork(app, cfg)
+    elif (cfg.max_requests or cfg.max_rss):
+        from iiif.prefork import run_recycling
+        run_recycling(app, cfg)
+    else:
+        app.run(host=cfg.app_host, port=cfg.app_port)
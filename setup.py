@@ -56,7 +56,7 @@ setup(
                            'third_party/openseadragon100/images/*',
                            'third_party/openseadragon200/*.js',
                            'third_party/openseadragon200/images/*']},
-    scripts=['iiif_static.py', 'iiif_testserver.py'],
+    scripts=['iiif_static.py', 'iiif_testserver.py', 'iiif_cache_warm.py', 'iiif_ingest.py'],
     classifiers=["Development Status :: 5 - Production/Stable",
                  "Intended Audience :: Developers",
                  "License :: OSI Approved :: "
@@ -0,0 +1,132 @@
+"""Test code for iiif/admission.py."""
+import threading
+import time
+import unittest
+
+from iiif.admission import IIIFAdmissionController, IIIFPriorityScheduler
+from iiif.error import IIIFError
+
+
+class TestAll(unittest.TestCase):
+    """Tests for IIIFAdmissionController and IIIFPriorityScheduler."""
+
+    def start_waiters(self, scheduler, classes, order):
+        """Start threads acquiring a slot for each of classes in turn.
+
+        Each thread appends its class to order once it has a slot, then
+        releases the slot.
+        """
+        threads = []
+        for cls in classes:
+            def waiter(cls=cls):
+                scheduler.acquire(cls)
+                order.append(cls)
+                scheduler.release(cls)
+            t = threading.Thread(target=waiter)
+            t.start()
+            threads.append(t)
+            # wait until queued so that arrival order is fixed
+            while (len(scheduler.waiting) < len(threads)):
+                time.sleep(0.001)
+        return threads
+
+    def test01_acquire_release(self):
+        """Test acquire and release within limits."""
+        a = IIIFAdmissionController(max_pixels=100, max_bytes=1000, wait=0.01)
+        a.acquire(60, 100)
+        a.acquire(40, 100)
+        self.assertEqual(a.metrics(), {'max_pixels': 100, 'max_bytes': 1000,
+                                       'pixels': 100, 'bytes': 200, 'in_flight': 2,
+                                       'admitted': 2, 'queued': 0, 'rejected': 0})
+        a.release(60, 100)
+        a.release(40, 100)
+        self.assertEqual(a.metrics()['pixels'], 0)
+        self.assertEqual(a.metrics()['in_flight'], 0)
+        # larger than budget is admitted alone
+        a.acquire(1000, 10000)
+        a.release(1000, 10000)
+        # no limits
+        a = IIIFAdmissionController()
+        a.acquire(10 ** 12, 10 ** 12)
+        a.acquire(10 ** 12, 10 ** 12)
+        self.assertEqual(a.metrics()['in_flight'], 2)
+
+    def test02_reject(self):
+        """Test rejection after wait."""
+        a = IIIFAdmissionController(max_pixels=100, max_bytes=1000, wait=0.01, retry_after=3)
+        a.acquire(60)
+        try:
+            a.acquire(50)
+            self.fail("not rejected")
+        except IIIFError as e:
+            self.assertEqual(e.code, 503)
+            self.assertEqual(dict(e.headers), {'Retry-After': '3'})
+        self.assertRaises(IIIFError, a.acquire, 1, 1001)
+        self.assertEqual(a.metrics()['queued'], 2)
+        self.assertEqual(a.metrics()['rejected'], 2)
+        self.assertEqual(a.metrics()['in_flight'], 1)
+
+    def test03_queue(self):
+        """Test request admitted after waiting for another to finish."""
+        a = IIIFAdmissionController(max_pixels=100, wait=5)
+        a.acquire(60)
+        admitted = []
+
+        def waiter():
+            a.acquire(50)
+            admitted.append(time.time())
+        t = threading.Thread(target=waiter)
+        t.start()
+        time.sleep(0.05)
+        self.assertEqual(admitted, [])
+        a.release(60)
+        t.join(5)
+        self.assertEqual(len(admitted), 1)
+        self.assertEqual(a.metrics()['pixels'], 50)
+        self.assertEqual(a.metrics()['queued'], 1)
+        self.assertEqual(a.metrics()['rejected'], 0)
+
+    def test11_priority(self):
+        """Test waiting requests served in order of priority."""
+        s = IIIFPriorityScheduler(slots=1, max_wait=60)
+        s.acquire('full')
+        order = []
+        threads = self.start_waiters(s, ['full', 'crop', 'thumbnail', 'tile', 'tile'], order)
+        m = s.metrics()
+        self.assertEqual(m['active'], {'tile': 0, 'thumbnail': 0, 'crop': 0, 'full': 1})
+        self.assertEqual(m['waiting'], {'tile': 2, 'thumbnail': 1, 'crop': 1, 'full': 1})
+        s.release('full')
+        for t in threads:
+            t.join(5)
+        self.assertEqual(order, ['tile', 'tile', 'thumbnail', 'crop', 'full'])
+        self.assertEqual(s.metrics()['served'], {'tile': 2, 'thumbnail': 1, 'crop': 1, 'full': 2})
+
+    def test12_starvation(self):
+        """Test waiting requests served in order of arrival after max_wait."""
+        s = IIIFPriorityScheduler(slots=1, max_wait=0)
+        s.acquire('tile')
+        order = []
+        threads = self.start_waiters(s, ['full', 'tile', 'crop'], order)
+        s.release('tile')
+        for t in threads:
+            t.join(5)
+        self.assertEqual(order, ['full', 'tile', 'crop'])
+        self.assertEqual(s.metrics()['promoted'], 1)
+
+    def test13_bulk_slots(self):
+        """Test slots reserved for interactive requests."""
+        s = IIIFPriorityScheduler(slots=3)
+        self.assertEqual(s.bulk_slots, 2)
+        s.acquire('full')
+        s.acquire('crop')
+        order = []
+        threads = self.start_waiters(s, ['full'], order)
+        # tile not held up by waiting full request
+        s.acquire('tile')
+        self.assertEqual(order, [])
+        s.release('tile')
+        s.release('crop')
+        threads[0].join(5)
+        self.assertEqual(order, ['full'])
+        s.release('full')
+        self.assertEqual(sum(s.metrics()['active'].values()), 0)
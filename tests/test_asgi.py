@@ -0,0 +1,257 @@
+"""Test code for iiif/asgi.py."""
+import asyncio
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import flask
+from PIL import Image
+
+from iiif.asgi import IIIFASGIApp, byte_range, derive_image, wsgi_environ
+from iiif.flask_utils import Config, add_handler
+from iiif.manipulator_pil import IIIFManipulatorPIL
+from iiif.request import IIIFRequest
+
+
+def make_app(**kwargs):
+    """Make Flask app with one pil and one auth handler."""
+    app = flask.Flask('test_asgi')
+    c = Config()
+    c.host = 'localhost'
+    c.port = 8000
+    c.image_dir = 'testimages'
+    c.tile_width = 512
+    c.tile_height = 512
+    c.scale_factors = ['auto']
+    c.include_osd = False
+    c.api_version = '2.1'
+    c.klass_name = 'pil'
+    c.access_cookie_lifetime = 10
+    c.access_token_lifetime = 10
+    for (k, v) in kwargs.items():
+        setattr(c, k, v)
+    for auth_type in ('none', 'basic'):
+        c2 = Config(c)
+        c2.auth_type = auth_type
+        c2.prefix = 'p_' + auth_type
+        c2.client_prefix = c2.prefix
+        add_handler(app, c2)
+    return app
+
+
+def call(app, path, method='GET', headers=None):
+    """Call ASGI app for path, return (status, headers, body, messages)."""
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': b'', 'http_version': '1.1', 'scheme': 'http',
+             'server': ('localhost', 8000), 'client': ('127.0.0.1', 1234),
+             'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                         for (k, v) in (headers or {}).items()]}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+    asyncio.run(app(scope, receive, send))
+    start = messages[0]
+    body = b''.join([m.get('body', b'') for m in messages[1:]])
+    return (start['status'],
+            dict([(k.decode('latin-1').lower(), v.decode('latin-1')) for (k, v) in start['headers']]),
+            body, messages)
+
+
+class TestAll(unittest.TestCase):
+    """Tests for IIIFASGIApp."""
+
+    def setUp(self):
+        """Make temporary directory."""
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove temporary directory."""
+        shutil.rmtree(self.tmp)
+
+    def test01_wsgi_environ(self):
+        """Test wsgi_environ."""
+        scope = {'type': 'http', 'method': 'GET', 'path': '/a/b c',
+                 'query_string': b'x=1', 'root_path': '',
+                 'headers': [(b'accept', b'a'), (b'accept', b'b'),
+                             (b'content-type', b'text/plain')]}
+        environ = wsgi_environ(scope, b'body')
+        self.assertEqual(environ['PATH_INFO'], '/a/b c')
+        self.assertEqual(environ['QUERY_STRING'], 'x=1')
+        self.assertEqual(environ['HTTP_ACCEPT'], 'a,b')
+        self.assertEqual(environ['CONTENT_TYPE'], 'text/plain')
+        self.assertEqual(environ['SERVER_NAME'], 'localhost')
+        self.assertEqual(environ['wsgi.input'].read(), b'body')
+
+    def test02_info_and_image(self):
+        """Test info.json and image requests handled on event loop."""
+        app = IIIFASGIApp(make_app(), chunk_size=1000)
+        try:
+            (status, headers, body, messages) = call(app, '/p_none/starfish/info.json')
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body.decode('utf-8'))['width'], 3000)
+            (status, headers, body, messages) = call(app, '/p_none/starfish/full/100,/0/default.png')
+            self.assertEqual(status, 200)
+            self.assertEqual(headers['content-type'], 'image/png')
+            self.assertEqual(int(headers['content-length']), len(body))
+            self.assertIn('etag', headers)
+            self.assertIn('link', headers)
+            self.assertGreater(len(messages), 2)
+            self.assertFalse(messages[-1]['more_body'])
+            self.assertEqual(Image.open(io.BytesIO(body)).size, (100, 133))
+            # conditional request
+            (status, headers2, body, messages) = call(app, '/p_none/starfish/full/100,/0/default.png',
+                                                      headers={'If-None-Match': headers['etag']})
+            self.assertEqual(status, 304)
+            self.assertEqual(body, b'')
+            # errors
+            (status, headers, body, messages) = call(app, '/p_none/starfish/full/100,/0/default.xyz')
+            self.assertEqual(status, 415)
+            (status, headers, body, messages) = call(app, '/p_none/nope/info.json')
+            self.assertEqual(status, 404)
+        finally:
+            app.shutdown()
+
+    def test03_wsgi_fallback(self):
+        """Test requests passed to the Flask application."""
+        app = IIIFASGIApp(make_app())
+        try:
+            (status, headers, body, messages) = call(app, '/p_none')
+            self.assertEqual(status, 200)
+            self.assertIn(b'IIIF Image API services under p_none', body)
+            (status, headers, body, messages) = call(app, '/p_none/starfish')
+            self.assertIn(status, (301, 302, 308))
+            (status, headers, body, messages) = call(app, '/p_basic/starfish/info.json')
+            self.assertEqual(status, 302)
+            self.assertIn('starfish-deg/info.json', headers['location'])
+            (status, headers, body, messages) = call(app, '/nowhere')
+            self.assertEqual(status, 404)
+        finally:
+            app.shutdown()
+
+    def test04_process_pool(self):
+        """Test deriving in process pool, with derivative cache."""
+        app = IIIFASGIApp(make_app(cache_dir=self.tmp), executor='process', workers=1)
+        try:
+            (status, headers, body, messages) = call(app, '/p_none/starfish/full/50,/0/gray.jpg')
+            self.assertEqual(status, 200)
+            self.assertEqual(headers['content-type'], 'image/jpeg')
+            im = Image.open(io.BytesIO(body))
+            self.assertEqual(im.size, (50, 67))
+            self.assertEqual(im.mode, 'L')
+            self.assertTrue(os.path.isfile(os.path.join(self.tmp, 'p_none/starfish/full/50,/0/gray.jpg')))
+            # same again from cache
+            (status, headers, body2, messages) = call(app, '/p_none/starfish/full/50,/0/gray.jpg')
+            self.assertEqual(body2, body)
+        finally:
+            app.shutdown()
+        self.assertRaises(ValueError, IIIFASGIApp, make_app(), executor='fork')
+        # admission control and scheduler apply to derivations in processes
+        app = IIIFASGIApp(make_app(max_decode_pixels=100, admission_wait=0, derive_slots=2),
+                          executor='process', workers=1)
+        try:
+            # busy with another large image
+            app.app.extensions['iiif_admission'].acquire(100)
+            (status, headers, body, messages) = call(app, '/p_none/starfish/full/50,/0/gray.jpg')
+            self.assertEqual(status, 503)
+            app.app.extensions['iiif_admission'].release(100)
+            (status, headers, body, messages) = call(app, '/p_none/starfish/full/50,/0/gray.jpg')
+            self.assertEqual(status, 200)
+            admission = app.app.extensions['iiif_admission'].metrics()
+            self.assertEqual((admission['admitted'], admission['rejected'], admission['in_flight']), (2, 1, 0))
+            scheduler = app.app.extensions['iiif_scheduler'].metrics()
+            self.assertEqual(scheduler['served']['thumbnail'], 2)
+            self.assertEqual(scheduler['active']['thumbnail'], 0)
+        finally:
+            app.shutdown()
+
+    def test05_derive_image(self):
+        """Test derive_image."""
+        r = IIIFRequest(api_version='2.1', identifier='starfish')
+        r.parse_url('full/10,10/0/default.png')
+        (outfile, mime_type) = derive_image(IIIFManipulatorPIL, '2.1', 'testimages/starfish.jpg', r)
+        try:
+            self.assertEqual(mime_type, 'image/png')
+            self.assertEqual(Image.open(outfile).size, (10, 10))
+        finally:
+            os.remove(outfile)
+
+    def test06_range(self):
+        """Test Range requests."""
+        app = IIIFASGIApp(make_app(), chunk_size=100)
+        path = '/p_none/starfish/full/100,/0/default.png'
+        try:
+            (status, headers, full, messages) = call(app, path)
+            self.assertEqual(headers['accept-ranges'], 'bytes')
+            (status, headers, body, messages) = call(app, path, headers={'Range': 'bytes=10-309'})
+            self.assertEqual(status, 206)
+            self.assertEqual(headers['content-range'], 'bytes 10-309/%d' % len(full))
+            self.assertEqual(headers['content-length'], '300')
+            self.assertEqual(body, full[10:310])
+            (status, headers, body, messages) = call(app, path, headers={'Range': 'bytes=-5'})
+            self.assertEqual(body, full[-5:])
+            # unsatisfiable
+            (status, headers, body, messages) = call(app, path, headers={'Range': 'bytes=%d-' % len(full)})
+            self.assertEqual(status, 416)
+            self.assertEqual(headers['content-range'], 'bytes */%d' % len(full))
+            self.assertEqual(body, b'')
+            # If-Range not matching, multiple ranges
+            for h in ({'Range': 'bytes=0-9', 'If-Range': '"other"'},
+                      {'Range': 'bytes=0-9,20-29'}):
+                (status, headers, body, messages) = call(app, path, headers=h)
+                self.assertEqual(status, 200)
+                self.assertEqual(body, full)
+        finally:
+            app.shutdown()
+        # If-Range is ignored with a weak ETag
+        headers = {'Range': 'bytes=0-9', 'If-Range': '"abc"'}
+        self.assertEqual(byte_range(headers, {'ETag': '"abc"'}, 100), (0, 10))
+        headers['If-Range'] = 'W/"abc"'
+        self.assertEqual(byte_range(headers, {'ETag': 'W/"abc"'}, 100), None)
+
+    def test07_zerocopysend(self):
+        """Test use of zero copy send extension."""
+        app = IIIFASGIApp(make_app())
+        path = '/p_none/starfish/full/100,/0/default.png'
+        try:
+            scope = {'type': 'http', 'method': 'GET', 'path': path,
+                     'query_string': b'', 'http_version': '1.1', 'scheme': 'http',
+                     'server': ('localhost', 8000), 'headers': [(b'range', b'bytes=1-4')],
+                     'extensions': {'http.response.zerocopysend': {}}}
+            messages = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                if ('file' in message):
+                    message['file'] = message['file'].name
+                messages.append(message)
+            asyncio.run(app(scope, receive, send))
+            self.assertEqual(messages[0]['status'], 206)
+            self.assertEqual(messages[1]['type'], 'http.response.zerocopysend')
+            self.assertEqual(messages[1]['offset'], 1)
+            self.assertEqual(messages[1]['count'], 4)
+        finally:
+            app.shutdown()
+
+    def test08_process_pool_coalesced(self):
+        """Test handler process pool output removed with coalesced requests."""
+        app = IIIFASGIApp(make_app(derive_processes=1, coalesce_requests=True))
+        old_tempdir = tempfile.tempdir
+        tempfile.tempdir = self.tmp
+        try:
+            for n in range(2):
+                (status, headers, body, messages) = call(app, '/p_none/starfish/full/50,/0/gray.jpg')
+                self.assertEqual(status, 200)
+            self.assertEqual(os.listdir(self.tmp), [])
+        finally:
+            tempfile.tempdir = old_tempdir
+            app.shutdown()
+            app.app.extensions['iiif_process_pool'].shutdown()
@@ -0,0 +1,306 @@
+"""Test code for iiif.cache."""
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+import mock
+
+from iiif.cache import IIIFNegativeCache, IIIFDerivativeCache, IIIFSingleFlight, IIIFPrefetcher
+from iiif.error import IIIFError
+
+
+class FakeTimer(object):
+    """Settable replacement for time.time."""
+
+    def __init__(self):
+        """Start at time 1000."""
+        self.now = 1000.0
+
+    def __call__(self):
+        """Return current fake time."""
+        return self.now
+
+
+class TestAll(unittest.TestCase):
+    """Tests."""
+
+    def test01_negative_cache_get_add(self):
+        """Test IIIFNegativeCache.get() and .add()."""
+        nc = IIIFNegativeCache(size=10, ttl=60)
+        self.assertEqual(nc.get('a'), None)
+        e = IIIFError(code=404, parameter='identifier', text='not found')
+        nc.add('a', e)
+        self.assertEqual(len(nc), 1)
+        e2 = nc.get('a')
+        self.assertTrue(isinstance(e2, IIIFError))
+        self.assertIsNot(e2, e)
+        self.assertEqual(e2.code, 404)
+        self.assertEqual(e2.parameter, 'identifier')
+        self.assertEqual(e2.text, 'not found')
+        nc.clear()
+        self.assertEqual(len(nc), 0)
+        self.assertEqual(nc.get('a'), None)
+
+    def test02_negative_cache_ttl(self):
+        """Test expiry of IIIFNegativeCache entries."""
+        timer = FakeTimer()
+        nc = IIIFNegativeCache(size=10, ttl=60, timer=timer)
+        nc.add(('path', 'i', 'p'), IIIFError(code=400))
+        timer.now += 59
+        self.assertEqual(nc.get(('path', 'i', 'p')).code, 400)
+        timer.now += 1
+        self.assertEqual(nc.get(('path', 'i', 'p')), None)
+        self.assertEqual(len(nc), 0)
+
+    def test03_negative_cache_size(self):
+        """Test bound on IIIFNegativeCache size."""
+        nc = IIIFNegativeCache(size=3, ttl=60)
+        for k in 'abcd':
+            nc.add(k, IIIFError(code=404, text=k))
+        self.assertEqual(len(nc), 3)
+        self.assertEqual(nc.get('a'), None)
+        self.assertEqual(nc.get('d').text, 'd')
+        # re-adding moves to end
+        nc.add('b', IIIFError(code=404, text='b2'))
+        nc.add('e', IIIFError(code=404, text='e'))
+        self.assertEqual(nc.get('c'), None)
+        self.assertEqual(nc.get('b').text, 'b2')
+        # zero size does nothing
+        nc = IIIFNegativeCache(size=0)
+        nc.add('a', IIIFError())
+        self.assertEqual(len(nc), 0)
+
+    def test10_derivative_cache_path(self):
+        """Test IIIFDerivativeCache.path() and .mime_type()."""
+        dc = IIIFDerivativeCache('/tmp/cache')
+        self.assertEqual(dc.path('p/id/full/full/0/default.jpg'),
+                         '/tmp/cache/p/id/full/full/0/default.jpg')
+        self.assertEqual(dc.path('p/id/full/full/0/default'), None)
+        self.assertEqual(dc.path('p/../full/full/0/default.jpg'), None)
+        self.assertEqual(dc.path('p//full/full/0/default.jpg'), None)
+        self.assertEqual(dc.mime_type('a/b.png'), 'image/png')
+        self.assertEqual(dc.mime_type('a/b.jpg'), 'image/jpeg')
+        self.assertEqual(dc.mime_type('a/b.xyz'), None)
+
+    def test11_derivative_cache_get_put(self):
+        """Test IIIFDerivativeCache.get() and .put()."""
+        tmp = tempfile.mkdtemp()
+        try:
+            dc = IIIFDerivativeCache(os.path.join(tmp, 'cache'))
+            key = 'p/id/full/full/0/default.jpg'
+            self.assertEqual(dc.get(key), None)
+            src = os.path.join(tmp, 'src.jpg')
+            with open(src, 'wb') as fh:
+                fh.write(b'JPEG')
+            path = dc.put(key, src)
+            self.assertEqual(path, os.path.join(tmp, 'cache', key))
+            self.assertEqual(dc.get(key), path)
+            with open(path, 'rb') as fh:
+                self.assertEqual(fh.read(), b'JPEG')
+            # no temporary files left
+            self.assertEqual(os.listdir(os.path.dirname(path)), ['default.jpg'])
+            # stale compared with source mtime
+            mtime = os.path.getmtime(path)
+            self.assertEqual(dc.get(key, mtime), path)
+            self.assertEqual(dc.get(key, mtime + 10), None)
+            # not cacheable
+            self.assertEqual(dc.put('p/id/full/full/0/default', src), None)
+            self.assertEqual(dc.get('p/id/full/full/0/default'), None)
+            # failed copy
+            self.assertEqual(dc.put('p/id/full/full/0/gray.jpg', os.path.join(tmp, 'nope')), None)
+            self.assertEqual(sorted(os.listdir(os.path.dirname(path))), ['default.jpg'])
+            # children
+            dc.put('p/id/full/90,/0/gray.jpg', src)
+            self.assertEqual(dc.children('p/id/full'), ['90,', 'full'])
+            self.assertEqual(dc.children('p/id/full/full/0'), ['default.jpg'])
+            self.assertEqual(dc.children('p/id/nope'), [])
+            self.assertEqual(dc.children('p/../id'), [])
+            open(os.path.join(tmp, 'cache/p/id/full/full/0/.tmp123'), 'w').close()
+            self.assertEqual(dc.children('p/id/full/full/0'), ['default.jpg'])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test20_single_flight(self):
+        """Test IIIFSingleFlight.do() with concurrent threads."""
+        sf = IIIFSingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def work(x):
+            calls.append(x)
+            release.wait(5)
+            return 'result-' + x
+
+        results = []
+
+        def client(x):
+            results.append(sf.do('k', work, x))
+
+        threads = [threading.Thread(target=client, args=(str(n),)) for n in range(5)]
+        threads[0].start()
+        while (not calls):
+            release.wait(0.01)
+        # watch for followers waiting on the call in flight
+        call = sf._calls['k']
+        call.done = mock.Mock(wraps=call.done)
+        for t in threads[1:]:
+            t.start()
+        while (call.done.wait.call_count < 4):
+            release.wait(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(calls, ['0'])
+        self.assertEqual(results, ['result-0'] * 5)
+        # nothing left in flight, next call runs again
+        self.assertEqual(sf.do('k', lambda: 'again'), 'again')
+
+    def test21_single_flight_error(self):
+        """Test IIIFSingleFlight.do() sharing exceptions and timeout."""
+        sf = IIIFSingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise IIIFError(code=501, text='nope')
+
+        errors = []
+
+        def client():
+            try:
+                sf.do('k', fail)
+            except IIIFError as e:
+                errors.append(e)
+
+        t1 = threading.Thread(target=client)
+        t1.start()
+        started.wait(5)
+        t2 = threading.Thread(target=client)
+        t2.start()
+        release.set()
+        t1.join()
+        t2.join()
+        self.assertEqual(len(errors), 2)
+        self.assertEqual([e.code for e in errors], [501, 501])
+        # follower gives up waiting
+        sf = IIIFSingleFlight(timeout=0.01)
+        started.clear()
+        release.clear()
+        t1 = threading.Thread(target=lambda: sf.do('k', lambda: release.wait(5)))
+        t1.start()
+        self.assertEqual(sf.do('k', lambda: 'alone'), 'alone')
+        release.set()
+        t1.join()
+
+    def test22_single_flight_lock_file(self):
+        """Test IIIFSingleFlight.do() with lock files."""
+        tmp = tempfile.mkdtemp()
+        try:
+            sf = IIIFSingleFlight(lock_dir=os.path.join(tmp, 'locks'))
+            lock_file = sf.lock_file('a/b/c')
+            self.assertEqual(os.path.dirname(lock_file), os.path.join(tmp, 'locks'))
+            self.assertTrue(lock_file.endswith('.lock'))
+            self.assertEqual(sf.do('a/b/c', lambda x: x * 2, 21), 42)
+            self.assertTrue(os.path.isfile(lock_file))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test23_single_flight_do_shared(self):
+        """Test IIIFSingleFlight.do_shared() cleaning up after the last user."""
+        sf = IIIFSingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        cleaned = []
+
+        def work():
+            started.set()
+            release.wait(5)
+            return 'shared'
+
+        results = []
+
+        def client():
+            results.append(sf.do_shared('k', cleaned.append, work))
+
+        t1 = threading.Thread(target=client)
+        t1.start()
+        started.wait(5)
+        t2 = threading.Thread(target=client)
+        t2.start()
+        while (sf._calls['k'].users < 2):
+            release.wait(0.01)
+        release.set()
+        t1.join()
+        t2.join()
+        self.assertEqual([r[0] for r in results], ['shared', 'shared'])
+        results[1][1]()
+        self.assertEqual(cleaned, [])
+        results[0][1]()
+        self.assertEqual(cleaned, ['shared'])
+        # follower that gives up waiting cleans up its own result
+        sf = IIIFSingleFlight(timeout=0.01)
+        started.clear()
+        release.clear()
+        del results[:]
+        t1 = threading.Thread(target=client)
+        t1.start()
+        started.wait(5)
+        (result, done) = sf.do_shared('k', cleaned.append, lambda: 'alone')
+        done()
+        self.assertEqual(cleaned, ['shared', 'alone'])
+        release.set()
+        t1.join()
+        results[0][1]()
+        self.assertEqual(cleaned, ['shared', 'alone', 'shared'])
+        # nothing to clean up after an error
+        self.assertRaises(ZeroDivisionError, sf.do_shared, 'k', cleaned.append, lambda: 1 / 0)
+        self.assertEqual(len(cleaned), 3)
+
+    def test30_prefetcher(self):
+        """Test IIIFPrefetcher.schedule()."""
+        pf = IIIFPrefetcher(queue_size=2)
+        done = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+        # first job blocks the worker so that others queue
+        self.assertTrue(pf.schedule('a', block))
+        started.wait(5)
+        self.assertTrue(pf.schedule('b', done.append, 'b'))
+        # duplicate key dropped
+        self.assertFalse(pf.schedule('b', done.append, 'b2'))
+        self.assertTrue(pf.schedule('c', done.append, 'c'))
+        # queue full
+        self.assertFalse(pf.schedule('d', done.append, 'd'))
+        release.set()
+        pf.join()
+        self.assertEqual(done, ['b', 'c'])
+        # errors are logged and ignored, key can be reused
+        self.assertTrue(pf.schedule('b', lambda: 1 / 0))
+        pf.join()
+        self.assertTrue(pf.schedule('b', done.append, 'b3'))
+        pf.join()
+        self.assertEqual(done[-1], 'b3')
+        self.assertEqual(len(pf._threads), 1)
+
+    def test31_prefetcher_under_load(self):
+        """Test IIIFPrefetcher skips jobs when foreground requests are active."""
+        pf = IIIFPrefetcher(max_active=1)
+        done = []
+        with pf.foreground():
+            self.assertEqual(pf.active, 1)
+            pf.schedule('a', done.append, 'a')
+            pf.join()
+            with pf.foreground():
+                self.assertEqual(pf.active, 2)
+                pf.schedule('b', done.append, 'b')
+                pf.join()
+        self.assertEqual(pf.active, 0)
+        self.assertEqual(done, ['a'])
@@ -0,0 +1,115 @@
+"""Test code for iiif_cgi.py."""
+import io
+import os.path
+import unittest
+
+import iiif_cgi
+from iiif.manipulator import IIIFManipulator
+from iiif.manipulator_pil import IIIFManipulatorPIL
+from iiif_cgi import IIIFRequestHandler, manipulator_class, read_scgi_environ
+
+TESTIMAGES = os.path.join(os.path.dirname(__file__), '../testimages')
+
+
+def netstring(headers):
+    """SCGI request headers as netstring."""
+    data = b''.join(k + b'\0' + v + b'\0' for (k, v) in headers)
+    return str(len(data)).encode('ascii') + b':' + data + b','
+
+
+class TestAll(unittest.TestCase):
+    """Tests for iiif_cgi.py."""
+
+    def setUp(self):
+        """Use the test images."""
+        self.testimage_dir = iiif_cgi.TESTIMAGE_DIR
+        iiif_cgi.TESTIMAGE_DIR = TESTIMAGES
+
+    def tearDown(self):
+        """Restore image directory."""
+        iiif_cgi.TESTIMAGE_DIR = self.testimage_dir
+
+    def respond(self, path, script_name='/iiif_pil.cgi'):
+        """Response to GET path as (status line, headers, body)."""
+        wfile = io.BytesIO()
+        rh = IIIFRequestHandler(environ={'PATH_INFO': path, 'SCRIPT_NAME': script_name},
+                                wfile=wfile)
+        rh.do_GET()
+        (head, body) = wfile.getvalue().split(b'\r\n\r\n', 1)
+        lines = head.decode('latin-1').split('\r\n')
+        headers = dict(line.split(': ', 1) for line in lines[1:])
+        return (lines[0], headers, body)
+
+    def test01_read_scgi_environ(self):
+        """Test netstring parsing of SCGI headers."""
+        rfile = io.BytesIO(netstring([(b'CONTENT_LENGTH', b'0'), (b'SCGI', b'1'),
+                                      (b'PATH_INFO', b'/a/info.json')]) + b'body')
+        self.assertEqual(read_scgi_environ(rfile),
+                         {'CONTENT_LENGTH': '0', 'SCGI': '1', 'PATH_INFO': '/a/info.json'})
+        # request body left to read
+        self.assertEqual(rfile.read(), b'body')
+
+    def test02_read_scgi_environ_bad(self):
+        """Test malformed SCGI headers."""
+        good = netstring([(b'SCGI', b'1')])
+        for data in (b'x' + good,  # bad length
+                     b':' + good[3:],  # no length
+                     b'12345678901234:',  # length too long
+                     good[:-1] + b'.',  # no comma terminator
+                     good[:5],  # truncated headers
+                     b'',  # truncated length
+                     b'12'):
+            self.assertRaises(ValueError, read_scgi_environ, io.BytesIO(data))
+        # odd number of names and values
+        with self.assertRaisesRegex(ValueError, 'odd number'):
+            read_scgi_environ(io.BytesIO(b'9:SCGI\x001\x00x\x00,'))
+
+    def test03_manipulator_class(self):
+        """Test manipulator class for script name set up once."""
+        self.assertIs(manipulator_class('/iiif_pil.cgi'), IIIFManipulatorPIL)
+        self.assertIs(manipulator_class('/other'), IIIFManipulatorPIL)
+        self.assertIs(manipulator_class('/iiif_dummy.cgi'), IIIFManipulator)
+        self.assertIs(iiif_cgi.MANIPULATOR_CLASSES['dummy'], IIIFManipulator)
+        self.assertIs(manipulator_class('/iiif_dummy.cgi'), manipulator_class('/iiif_dummy'))
+
+    def test04_info_request(self):
+        """Test info.json response."""
+        (status, headers, body) = self.respond('/starfish.jpg/info.json')
+        self.assertEqual(status, 'Status: 200 OK')
+        self.assertEqual(headers['Content-Type'], 'application/json')
+        self.assertIn(b'"width": 3000', body)
+        self.assertIn(b'"height": 4000', body)
+        # path without leading slash gets one
+        (status, headers, body) = self.respond('starfish.jpg/info.json')
+        self.assertEqual(status, 'Status: 200 OK')
+
+    def test05_image_request(self):
+        """Test image response."""
+        (status, headers, body) = self.respond('/starfish.jpg/full/30,/0/default.jpg')
+        self.assertEqual(status, 'Status: 200 OK')
+        self.assertEqual(headers['Content-Type'], 'image/jpeg')
+        self.assertIn('rel="profile"', headers['Link'])
+        self.assertTrue(body.startswith(b'\xff\xd8'))
+
+    def test06_error_request(self):
+        """Test error responses."""
+        (status, headers, body) = self.respond('/notthere.jpg/info.json')
+        self.assertEqual(status, 'Status: 404 ')
+        self.assertEqual(headers['Content-Type'], 'text/xml')
+        self.assertIn(b'notthere.jpg', body)
+        (status, headers, body) = self.respond('/starfish.jpg/full/30,/0/default.jpg',
+                                               script_name='/iiif_dummy.cgi')
+        self.assertEqual(status, 'Status: 501 ')
+        self.assertIn(b'size', body)
+        (status, headers, body) = self.respond('/starfish.jpg/full/full/0/default.jpg',
+                                               script_name='/iiif_dummy.cgi')
+        self.assertEqual(status, 'Status: 415 ')
+
+    def test07_dummy_manipulator(self):
+        """Test request with the dummy manipulator."""
+        (status, headers, body) = self.respond('/starfish.jpg/full/full/0/default',
+                                               script_name='/iiif_dummy.cgi')
+        self.assertEqual(status, 'Status: 200 OK')
+        self.assertNotIn('Content-Type', headers)
+        with open(os.path.join(TESTIMAGES, 'starfish.jpg'), 'rb') as fh:
+            self.assertEqual(body, fh.read())
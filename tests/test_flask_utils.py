@@ -1,23 +1,38 @@
 """Test code for iiif.flask_utils.py."""
 import unittest
 import argparse
+import io
 import flask
 import mock
 import os.path
 import json
+import shutil
+import tempfile
+import time
+from PIL import Image, ImageChops, ImageStat
+from testfixtures import LogCapture
 
+from iiif.admission import IIIFAdmissionController, IIIFPriorityScheduler
 from iiif.auth_basic import IIIFAuthBasic
-from iiif.error import IIIFError
+from iiif.cache import IIIFNegativeCache, IIIFDerivativeCache, IIIFSingleFlight, IIIFPrefetcher
+from iiif.error import IIIFError, IIIFDeadlineError
 from iiif.manipulator import IIIFManipulator
+from iiif.request import IIIFRequest
 from iiif.manipulator_pil import IIIFManipulatorPIL
+from iiif.manipulator_gen import IIIFManipulatorGen
+from iiif.pool import IIIFProcessPool
+from iiif.pyramid import IIIFPyramidCache
 
 from iiif.flask_utils import (Config, html_page, top_level_index_page, identifiers,
                               prefix_index_page, host_port_prefix,
                               osd_page_handler, IIIFHandler, iiif_info_handler,
                               iiif_image_handler, degraded_request, options_handler,
+                              IIIFDispatcher, DISPATCHER_METHODS,
                               parse_authorization_header, parse_accept_header,
+                              make_etag, etag_matches, parse_http_date, canonical_size,
                               make_prefix, split_comma_argument, add_shared_configs,
-                              add_handler, serve_static, ReverseProxied)
+                              cache_control_policy,
+                              add_handler, warm_app, serve_static, ReverseProxied)
 
 
 def WSGI_ENVIRON():
@@ -185,7 +200,35 @@ class TestAll(unittest.TestCase):
                         klass=IIIFManipulator, auth=None)
         self.assertRaises(IIIFError, lambda: i.file)
 
-    def test24_IIIFHandler_add_compliance_header(self):
+    def test24_IIIFHandler_file_negative_cache(self):
+        """Test IIIFHandler.file property with negative cache."""
+        c = Config()
+        c.api_version = '2.1'
+        c.klass_name = 'dummy'
+        c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+        c.negative_cache = IIIFNegativeCache()
+        i = IIIFHandler(prefix='/p', identifier='no-image', config=c,
+                        klass=IIIFManipulator, auth=None)
+        self.assertRaises(IIIFError, lambda: i.file)
+        self.assertEqual(len(c.negative_cache), 1)
+        # Second attempt must not look at the filesystem
+        with mock.patch('iiif.flask_utils.identifiers') as ids:
+            with mock.patch('os.path.isfile') as isfile:
+                try:
+                    i.file
+                    self.fail('Expected IIIFError')
+                except IIIFError as e:
+                    self.assertEqual(e.code, 404)
+                    self.assertIn("'no-image' not found", e.text)
+                self.assertFalse(isfile.called)
+                self.assertFalse(ids.called)
+        # Good identifiers are not cached
+        i = IIIFHandler(prefix='/p', identifier='starfish', config=c,
+                        klass=IIIFManipulator, auth=None)
+        self.assertEqual(os.path.basename(i.file), 'starfish.jpg')
+        self.assertEqual(len(c.negative_cache), 1)
+
+    def test25_IIIFHandler_add_compliance_header(self):
         """Test IIIFHandler.add_compliance_header property."""
         # No auth
         c = Config()
@@ -199,7 +242,7 @@ class TestAll(unittest.TestCase):
         i.add_compliance_header()
         self.assertIn('/level2', i.headers['Link'])
 
-    def test25_IIIFHandler_make_response(self):
+    def test26_IIIFHandler_make_response(self):
         """Test IIIFHandler.make_response."""
         c = Config()
         c.api_version = '2.1'
@@ -218,7 +261,7 @@ class TestAll(unittest.TestCase):
             self.assertEqual(resp.headers['Special-header'], 'ba')
             self.assertEqual(resp.headers['Access-control-allow-origin'], '*')
 
-    def test26_IIIFHandler_image_information_response(self):
+    def test27_IIIFHandler_image_information_response(self):
         """Test IIIFHandler.image_information_response()."""
         c = Config()
         c.api_version = '2.1'
@@ -261,7 +304,7 @@ class TestAll(unittest.TestCase):
             jsonb = resp.response[0]
             self.assertIn(b'starfish-deg', jsonb)
 
-    def test26_IIIFHandler_image_request_response(self):
+    def test28_IIIFHandler_image_request_response(self):
         """Test IIIFHandler.image_request_response()."""
         c = Config()
         c.api_version = '2.1'
@@ -307,7 +350,781 @@ class TestAll(unittest.TestCase):
             self.assertTrue(len(resp.data) > 1000000)
             self.assertEqual(resp.mimetype, 'image/png')
 
-    def test27_IIIFHandler_error_response(self):
+    def test29_IIIFHandler_image_request_response_negative_cache(self):
+        """Test IIIFHandler.image_request_response() with negative cache."""
+        c = Config()
+        c.api_version = '2.1'
+        c.klass_name = 'dummy'
+        c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+        c.negative_cache = IIIFNegativeCache()
+        environ = WSGI_ENVIRON()
+        with self.test_app.request_context(environ):
+            for n in range(0, 2):
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulator, auth=None)
+                with mock.patch.object(i.iiif, 'parse_url', wraps=i.iiif.parse_url) as parse_url:
+                    try:
+                        i.image_request_response('a/b')
+                        self.fail('Expected IIIFError')
+                    except IIIFError as e:
+                        self.assertEqual(e.code, 404)
+                    try:
+                        i.image_request_response('full/full/0/bad-quality')
+                        self.fail('Expected IIIFError')
+                    except IIIFError as e:
+                        self.assertEqual(e.code, 400)
+                        self.assertEqual(e.parameter, 'quality')
+                    # parsed only the first time around
+                    self.assertEqual(parse_url.call_count, 2 if n == 0 else 0)
+        self.assertEqual(len(c.negative_cache), 2)
+
+    def test30_IIIFHandler_image_request_response_derivative_cache(self):
+        """Test IIIFHandler.image_request_response() with derivative cache."""
+        tmp = tempfile.mkdtemp()
+        try:
+            c = Config()
+            c.api_version = '2.1'
+            c.klass_name = 'pil'
+            c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+            c.host = 'example.org'
+            c.port = 80
+            c.derivative_cache = IIIFDerivativeCache(tmp)
+            c.canonical_link_header = True
+            environ = WSGI_ENVIRON()
+            cached = os.path.join(tmp, 'p/starfish/full/75,/0/default.jpg')
+            with self.test_app.request_context(environ):
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                resp = i.image_request_response('full/!100,100/0/default.jpg')
+                resp.direct_passthrough = False  # avoid Flask complaint when reading .data
+                self.assertEqual(resp.mimetype, 'image/jpeg')
+                self.assertIn('<http://example.org/p/starfish/full/75,/0/default.jpg>;rel="canonical"',
+                              resp.headers['Link'])
+                self.assertIn('rel="profile"', resp.headers['Link'])
+                self.assertTrue(os.path.isfile(cached))
+                data = resp.data
+                # equivalent request served from cache without derive()
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                with mock.patch.object(i.manipulator, 'derive') as derive:
+                    resp = i.image_request_response('pct:0,0,100,100/75,/360/default.jpg')
+                    self.assertFalse(derive.called)
+                resp.direct_passthrough = False  # avoid Flask complaint when reading .data
+                self.assertEqual(resp.data, data)
+                self.assertEqual(resp.mimetype, 'image/jpeg')
+                self.assertIn('rel="canonical"', resp.headers['Link'])
+                # degraded request cached separately by quality
+                i = IIIFHandler(prefix='p', identifier='starfish-deg', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                resp = i.image_request_response('full/100,/0/default.jpg')
+                self.assertIn('<http://example.org/p/starfish-deg/full/100,/0/gray.jpg>;rel="canonical"',
+                              resp.headers['Link'])
+                self.assertTrue(os.path.isfile(os.path.join(tmp, 'p/starfish/full/100,/0/gray.jpg')))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test31_IIIFHandler_image_request_response_shared_cache(self):
+        """Test IIIFHandler.image_request_response() with shared derivative cache."""
+        tmp = tempfile.mkdtemp()
+        try:
+            c = Config()
+            c.api_version = '2.1'
+            c.klass_name = 'pil'
+            c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+            c.host = 'example.org'
+            c.port = 80
+            c.derivative_cache = IIIFDerivativeCache(tmp)
+            c.shared_cache = True
+            c.canonical_link_header = True
+            c3 = Config(c)
+            c3.api_version = '3.0'
+            environ = WSGI_ENVIRON()
+            with self.test_app.request_context(environ):
+                i = IIIFHandler(prefix='p2', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                resp = i.image_request_response('full/100,/0/default.jpg')
+                resp.direct_passthrough = False  # avoid Flask complaint when reading .data
+                data = resp.data
+                etag = resp.headers['ETag']
+                self.assertTrue(i.derivative_key.startswith('shared/IIIFManipulatorPIL_PIL_'))
+                self.assertTrue(i.derivative_key.endswith('/full/100,133/0/default.jpg'))
+                self.assertEqual(os.listdir(tmp), ['shared'])
+                # same image from 3.0 prefix, with its own headers
+                i = IIIFHandler(prefix='p3', identifier='starfish', config=c3,
+                                klass=IIIFManipulatorPIL, auth=None)
+                with mock.patch.object(i.manipulator, 'derive') as derive:
+                    resp = i.image_request_response('full/100,/0/default.jpg')
+                    self.assertFalse(derive.called)
+                resp.direct_passthrough = False  # avoid Flask complaint when reading .data
+                self.assertEqual(resp.data, data)
+                self.assertIn('<http://example.org/p3/starfish/full/100,133/0/default.jpg>;rel="canonical"',
+                              resp.headers['Link'])
+                self.assertNotEqual(resp.headers['ETag'], etag)
+                # 1.1 native quality is default
+                c1 = Config(c)
+                c1.api_version = '1.1'
+                i = IIIFHandler(prefix='p1', identifier='starfish', config=c1,
+                                klass=IIIFManipulatorPIL, auth=None)
+                with mock.patch.object(i.manipulator, 'derive') as derive:
+                    resp = i.image_request_response('full/100,133/0/native.jpg')
+                    self.assertFalse(derive.called)
+                # other manipulators and qualities not shared
+                i = IIIFHandler(prefix='p2', identifier='starfish', config=c,
+                                klass=IIIFManipulator, auth=None)
+                i.image_request_prepare('full/100,/0/default.jpg')
+                self.assertIn('/IIIFManipulator/', i.derivative_key)
+                i = IIIFHandler(prefix='p3', identifier='starfish', config=c3,
+                                klass=IIIFManipulatorPIL, auth=None)
+                i.image_request_prepare('full/100,/0/gray.jpg')
+                self.assertTrue(i.derivative_key.endswith('/full/100,133/0/gray.jpg'))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test32_IIIFHandler_image_request_response_single_flight(self):
+        """Test IIIFHandler.image_request_response() with single flight."""
+        c = Config()
+        c.api_version = '2.1'
+        c.klass_name = 'pil'
+        c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+        c.single_flight = IIIFSingleFlight()
+        environ = WSGI_ENVIRON()
+        with self.test_app.request_context(environ):
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            with mock.patch.object(c.single_flight, 'do', wraps=c.single_flight.do) as do:
+                resp = i.image_request_response('full/!100,100/0/default.jpg')
+                do.assert_called_once_with('p/starfish/full/75,/0/default.jpg',
+                                           i.derive, i.file, 'p/starfish/full/75,/0/default.jpg', None)
+            resp.direct_passthrough = False  # avoid Flask complaint when reading .data
+            self.assertEqual(resp.mimetype, 'image/jpeg')
+            self.assertTrue(len(resp.data) > 1000)
+
+    def test33_IIIFHandler_image_request_response_admission(self):
+        """Test IIIFHandler.image_request_response() with admission control."""
+        c = Config()
+        c.api_version = '2.1'
+        c.klass_name = 'pil'
+        c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+        c.admission = IIIFAdmissionController(max_pixels=1000000, wait=0.01, retry_after=5)
+        environ = WSGI_ENVIRON()
+        with self.test_app.request_context(environ):
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            with mock.patch.object(c.admission, 'acquire', wraps=c.admission.acquire) as acquire:
+                resp = i.image_request_response('0,0,1000,500/100,/0/default.jpg')
+                acquire.assert_called_once_with(500000, (500000 + 5000) * 4)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(c.admission.metrics()['in_flight'], 0)
+            self.assertEqual(c.admission.metrics()['admitted'], 1)
+            # over budget with another request in progress
+            c.admission.acquire(600000)
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            self.assertRaises(IIIFError, i.image_request_response, '0,0,1000,500/100,/0/default.jpg')
+            resp = iiif_image_handler(prefix='p', identifier='starfish', path='0,0,1000,500/100,/0/default.jpg',
+                                      config=c, klass=IIIFManipulatorPIL)
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], '5')
+            c.admission.release(600000)
+            self.assertEqual(c.admission.metrics()['rejected'], 2)
+
+    def test34_IIIFHandler_image_request_response_scheduler(self):
+        """Test IIIFHandler.image_request_response() with scheduler."""
+        c = Config()
+        c.api_version = '2.1'
+        c.klass_name = 'pil'
+        c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+        c.tile_width = 512
+        c.tile_height = 512
+        c.scheduler = IIIFPriorityScheduler(slots=1)
+        environ = WSGI_ENVIRON()
+        for (path, cost_class) in (('0,0,1024,1024/512,/0/default.jpg', 'tile'),
+                                   ('full/100,/0/default.jpg', 'thumbnail'),
+                                   ('pct:10,10,50,50/1500,/0/default.jpg', 'crop'),
+                                   ('full/max/0/default.jpg', 'full')):
+            with self.test_app.request_context(environ):
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                with mock.patch.object(c.scheduler, 'acquire', wraps=c.scheduler.acquire) as acquire:
+                    resp = i.image_request_response(path)
+                    acquire.assert_called_once_with(cost_class)
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(i.cost_class(), cost_class)
+        self.assertEqual(c.scheduler.metrics()['served'], {'tile': 1, 'thumbnail': 1, 'crop': 1, 'full': 1})
+        self.assertEqual(c.scheduler.metrics()['active'], {'tile': 0, 'thumbnail': 0, 'crop': 0, 'full': 0})
+
+    def test35_IIIFHandler_image_request_response_deadline(self):
+        """Test IIIFHandler.image_request_response() with derive timeout."""
+        c = Config()
+        c.api_version = '2.1'
+        c.klass_name = 'gen'
+        c.generator_dir = os.path.join(os.path.dirname(__file__), '../iiif/generators')
+        c.derive_timeout = 100
+        environ = WSGI_ENVIRON()
+        with self.test_app.request_context(environ):
+            i = IIIFHandler(prefix='p', identifier='check', config=c,
+                            klass=IIIFManipulatorGen, auth=None)
+            self.assertGreater(i.deadline, time.time() + 99)
+            resp = i.image_request_response('full/10,/0/default.png')
+            self.assertEqual(resp.status_code, 200)
+            i = IIIFHandler(prefix='p', identifier='check', config=c,
+                            klass=IIIFManipulatorGen, auth=None)
+            i.deadline = time.time() - 1
+            self.assertRaises(IIIFDeadlineError, i.image_request_response, 'full/10,/0/default.png')
+        del c.derive_timeout
+        i = IIIFHandler(prefix='p', identifier='check', config=c,
+                        klass=IIIFManipulatorGen, auth=None)
+        self.assertEqual(i.deadline, None)
+
+    def test36_IIIFHandler_image_request_response_prefetch(self):
+        """Test IIIFHandler.image_request_response() with prefetch."""
+        tmp = tempfile.mkdtemp()
+        try:
+            c = Config()
+            c.api_version = '2.1'
+            c.klass_name = 'pil'
+            c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+            c.tile_width = 512
+            c.tile_height = 512
+            c.scale_factors = ['auto']
+            c.derivative_cache = IIIFDerivativeCache(tmp)
+            c.prefetcher = IIIFPrefetcher()
+            environ = WSGI_ENVIRON()
+            with self.test_app.request_context(environ):
+                # starfish is 3000x4000 with scale factors 1,2,4,8
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                resp = i.image_request_response('2048,0,952,2048/238,/0/default.jpg')
+                self.assertEqual(resp.status_code, 200)
+                c.prefetcher.join()
+                for path in ('p/starfish/0,0,2048,2048/512,/0/default.jpg',
+                             'p/starfish/2048,2048,952,1952/238,/0/default.jpg'):
+                    self.assertTrue(os.path.isfile(os.path.join(tmp, path)))
+                # parent would be full image, not prefetched
+                self.assertEqual(len(os.listdir(os.path.join(tmp, 'p/starfish'))), 3)
+                # cached tile is served and prefetches its neighbours
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                with mock.patch.object(c.prefetcher, 'schedule') as schedule:
+                    resp = i.image_request_response('0,0,2048,2048/512,/0/default.jpg')
+                    self.assertEqual(schedule.call_count, 1)
+                    self.assertEqual(schedule.call_args[0][0],
+                                     'p/starfish/0,2048,2048,1952/512,/0/default.jpg')
+                    # scale factor 1 tile has canonical size full
+                    schedule.reset_mock()
+                    i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                    klass=IIIFManipulatorPIL, auth=None)
+                    i.image_request_response('0,0,512,512/512,/0/default.jpg')
+                    self.assertEqual(sorted(call[0][0] for call in schedule.call_args_list),
+                                     ['p/starfish/0,0,1024,1024/512,/0/default.jpg',
+                                      'p/starfish/0,512,512,512/full/0/default.jpg',
+                                      'p/starfish/512,0,512,512/full/0/default.jpg'])
+                    # not for full region or degraded requests
+                    schedule.reset_mock()
+                    i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                    klass=IIIFManipulatorPIL, auth=None)
+                    i.image_request_response('full/100,/0/default.jpg')
+                    i = IIIFHandler(prefix='p', identifier='starfish-deg', config=c,
+                                    klass=IIIFManipulatorPIL, auth=None)
+                    i.image_request_response('0,0,2048,2048/512,/0/default.jpg')
+                    self.assertFalse(schedule.called)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test37_IIIFHandler_image_request_response_larger_derivative(self):
+        """Test IIIFHandler.image_request_response() deriving from cached image."""
+        tmp = tempfile.mkdtemp()
+        try:
+            c = Config()
+            c.api_version = '2.1'
+            c.klass_name = 'pil'
+            c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+            c.derivative_cache = IIIFDerivativeCache(tmp)
+            c.derive_from_cache_factor = 2
+            environ = WSGI_ENVIRON()
+            src = os.path.join(c.image_dir, 'starfish.jpg')
+            with self.test_app.request_context(environ):
+                # starfish is 3000x4000
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                i.image_request_response('full/1000,/0/default.jpg')
+                cached = os.path.join(tmp, 'p/starfish/full/1000,/0/default.jpg')
+                for (path, expected_src) in (('full/200,/0/default.jpg', cached),
+                                             ('full/400,/90/gray.jpg', cached),
+                                             ('full/600,/0/default.jpg', src),
+                                             ('0,0,1000,1000/100,/0/default.jpg', src)):
+                    i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                    klass=IIIFManipulatorPIL, auth=None)
+                    with mock.patch.object(i.manipulator, 'derive', wraps=i.manipulator.derive) as derive:
+                        resp = i.image_request_response(path)
+                        self.assertEqual(derive.call_args[0][0], expected_src)
+                    resp.direct_passthrough = False  # avoid Flask complaint when reading .data
+                    self.assertEqual(resp.mimetype, 'image/jpeg')
+                    # bytes depend on the cache so validators are weak
+                    self.assertTrue(resp.headers['ETag'].startswith('W/"'))
+                etag = resp.headers['ETag']
+                # derived image has requested size
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                i.image_request_response('full/200,/90/gray.jpg')
+                im = Image.open(os.path.join(tmp, 'p/starfish/full/200,/90/gray.jpg'))
+                self.assertEqual(im.size, (267, 200))
+                self.assertEqual(im.mode, 'L')
+                # gray does not give default, lossless png can be used at same size
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                i.image_request_response('0,0,2000,2000/400,/0/gray.png')
+                png = os.path.join(tmp, 'p/starfish/0,0,2000,2000/400,/0/gray.png')
+                for (path, expected_src) in (('0,0,2000,2000/100,/0/default.jpg', src),
+                                             ('0,0,2000,2000/100,/0/gray.jpg', png),
+                                             ('0,0,2000,2000/400,/0/gray.jpg', png)):
+                    i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                    klass=IIIFManipulatorPIL, auth=None)
+                    with mock.patch.object(i.manipulator, 'derive', wraps=i.manipulator.derive) as derive:
+                        i.image_request_response(path)
+                        self.assertEqual(derive.call_args[0][0], expected_src)
+                # not configured
+                c.derive_from_cache_factor = None
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                with mock.patch.object(i.manipulator, 'derive', wraps=i.manipulator.derive) as derive:
+                    resp = i.image_request_response('full/150,/0/default.jpg')
+                    self.assertEqual(derive.call_args[0][0], src)
+                self.assertTrue(resp.headers['ETag'].startswith('"'))
+            c.derive_from_cache_factor = 2
+            environ['HTTP_IF_NONE_MATCH'] = etag
+            with self.test_app.request_context(environ):
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                resp = i.image_request_response('0,0,1000,1000/100,/0/default.jpg')
+                self.assertEqual(resp.status_code, 304)
+            # If-Range needs a strong validator so whole image is sent
+            del environ['HTTP_IF_NONE_MATCH']
+            environ['HTTP_RANGE'] = 'bytes=0-9'
+            environ['HTTP_IF_RANGE'] = etag
+            with self.test_app.request_context(environ):
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                resp = i.image_request_response('0,0,1000,1000/100,/0/default.jpg')
+                self.assertEqual(resp.status_code, 200)
+                self.assertNotIn('Content-Range', resp.headers)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test38_IIIFHandler_image_request_response_mosaic(self):
+        """Test IIIFHandler.image_request_response() assembling cached tiles."""
+        tmp = tempfile.mkdtemp()
+        try:
+            c = Config()
+            c.api_version = '2.1'
+            c.klass_name = 'pil'
+            c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+            c.tile_width = 512
+            c.tile_height = 512
+            c.scale_factors = ['auto']
+            c.derivative_cache = IIIFDerivativeCache(tmp)
+            c.mosaic = True
+            environ = WSGI_ENVIRON()
+            src = os.path.join(c.image_dir, 'starfish.jpg')
+            with self.test_app.request_context(environ):
+                # starfish is 3000x4000 with scale factors 1,2,4,8, cache two
+                # tiles at scale factor 2
+                for path in ('0,0,1024,1024/512,/0/default.jpg', '1024,0,1024,1024/512,/0/default.jpg'):
+                    i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                    klass=IIIFManipulatorPIL, auth=None)
+                    i.image_request_response(path)
+                # region across both tiles
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                with mock.patch.object(i.manipulator, 'mosaic', wraps=i.manipulator.mosaic) as mosaic:
+                    with mock.patch.object(i.manipulator, 'derive', wraps=i.manipulator.derive) as derive:
+                        resp = i.image_request_response('500,200,1000,600/400,/90/gray.jpg')
+                        self.assertTrue(derive.call_args[0][0].endswith('.png'))
+                        # temporary file removed
+                        self.assertFalse(os.path.exists(derive.call_args[0][0]))
+                    self.assertEqual(len(mosaic.call_args[0][0]), 2)
+                    self.assertEqual(mosaic.call_args[0][1], (1024, 512))
+                    self.assertEqual(mosaic.call_args[0][2], (250.0, 100.0, 750.0, 400.0))
+                    self.assertEqual(mosaic.call_args[0][3], (400, 240))
+                # bytes depend on the cache so validators are weak
+                self.assertTrue(resp.headers['ETag'].startswith('W/"'))
+                im = Image.open(os.path.join(tmp, 'p/starfish/500,200,1000,600/400,/90/gray.jpg'))
+                self.assertEqual(im.size, (240, 400))
+                self.assertEqual(im.mode, 'L')
+                # compare with image derived from source
+                m = IIIFManipulatorPIL()
+                r = IIIFRequest(identifier='starfish')
+                r.parse_url('500,200,1000,600/400,/90/gray.jpg')
+                m.derive(src, r)
+                diff = ImageStat.Stat(ImageChops.difference(im, m.image)).mean[0]
+                self.assertLess(diff, 10)
+                # tiles not all cached, or needs higher resolution
+                for path in ('500,200,1000,1000/400,/0/default.jpg', '500,200,1000,600/800,/0/default.jpg'):
+                    i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                    klass=IIIFManipulatorPIL, auth=None)
+                    with mock.patch.object(i.manipulator, 'derive', wraps=i.manipulator.derive) as derive:
+                        i.image_request_response(path)
+                        self.assertEqual(derive.call_args[0][0], src)
+                # not configured
+                c.mosaic = False
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                resp = i.image_request_response('500,200,1000,600/100,/0/default.jpg')
+                self.assertTrue(resp.headers['ETag'].startswith('"'))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test39_IIIFHandler_image_request_response_pyramid(self):
+        """Test IIIFHandler.image_request_response() building pyramid levels."""
+        tmp = tempfile.mkdtemp()
+        try:
+            c = Config()
+            c.api_version = '2.1'
+            c.klass_name = 'pil'
+            c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+            c.pyramid = IIIFPyramidCache(tmp)
+            c.pyramid_builder = IIIFPrefetcher()
+            src = os.path.join(c.image_dir, 'starfish.jpg')
+            environ = WSGI_ENVIRON()
+            with self.test_app.request_context(environ):
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                self.assertEqual(i.manipulator.pyramid, c.pyramid)
+                i.image_request_response('full/100,/0/default.jpg')
+                c.pyramid_builder.join()
+                # starfish is 3000x4000
+                self.assertEqual([f for (f, path) in c.pyramid.levels(src)], [8, 4, 2])
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                with mock.patch.object(c.pyramid_builder, 'schedule') as schedule:
+                    with LogCapture('iiif.manipulator') as lc:
+                        resp = i.image_request_response('full/101,/0/default.jpg')
+                        self.assertIn('region: reading level with factor 8', [r.msg for r in lc.records])
+                    self.assertFalse(schedule.called)
+                resp.direct_passthrough = False  # avoid Flask complaint when reading .data
+                self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (101, 135))
+                # bytes depend on the levels built so validators are weak
+                self.assertTrue(resp.headers['ETag'].startswith('W/"'))
+                # no levels for generators
+                c.klass_name = 'gen'
+                c.generator_dir = os.path.join(os.path.dirname(__file__), '../iiif/generators')
+                i = IIIFHandler(prefix='p', identifier='sierpinski_carpet', config=c,
+                                klass=IIIFManipulatorGen, auth=None)
+                with mock.patch.object(c.pyramid_builder, 'schedule') as schedule:
+                    resp = i.image_request_response('full/100,/0/default.jpg')
+                    self.assertFalse(schedule.called)
+                self.assertTrue(resp.headers['ETag'].startswith('"'))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test40_IIIFHandler_conditional_requests(self):
+        """Test ETag, Last-Modified and 304 responses from IIIFHandler."""
+        c = Config()
+        c.api_version = '2.1'
+        c.klass_name = 'pil'
+        c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+        c.tile_height = 512
+        c.tile_width = 512
+        c.scale_factors = [1, 2]
+        c.host = 'example.org'
+        c.port = 80
+        environ = WSGI_ENVIRON()
+        with self.test_app.request_context(environ):
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            resp = i.image_request_response('full/75,/0/default.jpg')
+            self.assertEqual(resp.status_code, 200)
+            etag = resp.headers['ETag']
+            last_modified = resp.headers['Last-Modified']
+            self.assertTrue(etag.startswith('"'))
+            self.assertTrue(last_modified.endswith('GMT'))
+            # same tag for equivalent request, different otherwise
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            resp = i.image_request_response('full/!100,100/0/default.jpg')
+            self.assertEqual(resp.headers['ETag'], etag)
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            resp = i.image_request_response('full/76,/0/default.jpg')
+            self.assertNotEqual(resp.headers['ETag'], etag)
+            info_resp = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                    klass=IIIFManipulatorPIL, auth=None).image_information_response()
+            self.assertEqual(info_resp.status_code, 200)
+            info_etag = info_resp.headers['ETag']
+        # If-None-Match
+        environ['HTTP_IF_NONE_MATCH'] = 'W/"other", ' + etag
+        with self.test_app.request_context(environ):
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            with mock.patch.object(i.manipulator, 'derive') as derive:
+                resp = i.image_request_response('full/75,/0/default.jpg')
+                self.assertFalse(derive.called)
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], etag)
+            self.assertEqual(resp.headers['Access-control-allow-origin'], '*')
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            resp = i.image_request_response('full/76,/0/default.jpg')
+            self.assertEqual(resp.status_code, 200)
+        environ['HTTP_IF_NONE_MATCH'] = info_etag
+        with self.test_app.request_context(environ):
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            self.assertEqual(i.image_information_response().status_code, 304)
+        # If-Modified-Since, ignored if there is also If-None-Match
+        environ['HTTP_IF_MODIFIED_SINCE'] = last_modified
+        environ['HTTP_IF_NONE_MATCH'] = '"other"'
+        with self.test_app.request_context(environ):
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            self.assertEqual(i.image_request_response('full/75,/0/default.jpg').status_code, 200)
+        del environ['HTTP_IF_NONE_MATCH']
+        with self.test_app.request_context(environ):
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            self.assertEqual(i.image_request_response('full/75,/0/default.jpg').status_code, 304)
+        environ['HTTP_IF_MODIFIED_SINCE'] = 'Thu, 01 Jan 1970 00:00:00 GMT'
+        with self.test_app.request_context(environ):
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            self.assertEqual(i.image_request_response('full/75,/0/default.jpg').status_code, 200)
+        # with source size kept, 304 without opening the image
+        c.info_cache_size = 10
+        c.info_sizes = {}
+        del environ['HTTP_IF_MODIFIED_SINCE']
+        environ['HTTP_IF_NONE_MATCH'] = etag
+        with self.test_app.request_context(environ):
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            self.assertEqual(i.image_request_response('full/75,/0/default.jpg').status_code, 304)
+            self.assertEqual(list(c.info_sizes.values())[0][1:], (3000, 4000))
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            with mock.patch.object(i.manipulator, 'do_first') as do_first:
+                resp = i.image_request_response('full/!100,100/0/default.jpg')
+                self.assertFalse(do_first.called)
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], etag)
+        del environ['HTTP_IF_NONE_MATCH']
+        environ['HTTP_IF_MODIFIED_SINCE'] = last_modified
+        with self.test_app.request_context(environ):
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            with mock.patch.object(i.manipulator, 'do_first') as do_first:
+                self.assertEqual(i.image_request_response('full/75,/0/default.jpg').status_code, 304)
+                self.assertFalse(do_first.called)
+        # image still opened to derive it
+        del environ['HTTP_IF_MODIFIED_SINCE']
+        with self.test_app.request_context(environ):
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            resp = i.image_request_response('full/75,/0/default.jpg')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['ETag'], etag)
+            resp.direct_passthrough = False  # avoid Flask complaint when reading .data
+            self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (75, 100))
+
+    def test41_IIIFHandler_range_requests(self):
+        """Test Range requests and 206 responses from IIIFHandler."""
+        c = Config()
+        c.api_version = '2.1'
+        c.klass_name = 'pil'
+        c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+        c.tile_height = 512
+        c.tile_width = 512
+        c.scale_factors = [1, 2]
+        c.host = 'example.org'
+        c.port = 80
+
+        def get(environ):
+            with self.test_app.request_context(environ):
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                resp = i.image_request_response('full/75,/0/default.png')
+                body = b''.join(resp.response)
+                resp.close()
+                return (resp, body)
+        environ = WSGI_ENVIRON()
+        (resp, full) = get(environ)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(resp.content_length, len(full))
+        etag = resp.headers['ETag']
+        environ['HTTP_RANGE'] = 'bytes=10-109'
+        (resp, body) = get(environ)
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes 10-109/%d' % len(full))
+        self.assertEqual(resp.content_length, 100)
+        self.assertEqual(body, full[10:110])
+        self.assertEqual(resp.headers['ETag'], etag)
+        # If-Range
+        environ['HTTP_IF_RANGE'] = etag
+        (resp, body) = get(environ)
+        self.assertEqual(resp.status_code, 206)
+        environ['HTTP_IF_RANGE'] = '"other"'
+        (resp, body) = get(environ)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(body, full)
+        del environ['HTTP_IF_RANGE']
+        # unsatisfiable
+        environ['HTTP_RANGE'] = 'bytes=%d-' % len(full)
+        (resp, body) = get(environ)
+        self.assertEqual(resp.status_code, 416)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes */%d' % len(full))
+
+    def test42_IIIFHandler_stream_response(self):
+        """Test streaming of large images from IIIFHandler."""
+        c = Config()
+        c.api_version = '2.1'
+        c.klass_name = 'pil'
+        c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+        c.tile_height = 512
+        c.tile_width = 512
+        c.scale_factors = [1, 2]
+        c.host = 'example.org'
+        c.port = 80
+        c.stream_min_pixels = 10000
+        environ = WSGI_ENVIRON()
+        with self.test_app.request_context(environ):
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            resp = i.image_request_response('full/300,/0/default.png')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'image/png')
+            self.assertIsNone(resp.content_length)
+            self.assertIn('ETag', resp.headers)
+            self.assertIn('Link', resp.headers)
+            body = b''.join(resp.response)
+            self.assertEqual(Image.open(io.BytesIO(body)).size, (300, 400))
+            # small image not streamed
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            resp = i.image_request_response('full/30,/0/default.png')
+            self.assertGreater(resp.content_length, 0)
+            resp.close()
+            # error before any output
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            self.assertRaises(IIIFError, i.image_request_response, 'full/300,/0/default.gif')
+        environ['HTTP_RANGE'] = 'bytes=0-9'
+        with self.test_app.request_context(environ):
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            resp = i.image_request_response('full/300,/0/default.png')
+            self.assertEqual(resp.status_code, 206)
+            resp.close()
+
+    def test43_IIIFHandler_process_pool(self):
+        """Test IIIFHandler deriving images in a process pool."""
+        pool = IIIFProcessPool(workers=1)
+        tmp = tempfile.mkdtemp()
+        try:
+            c = Config()
+            c.api_version = '2.1'
+            c.klass_name = 'pil'
+            c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+            c.host = 'example.org'
+            c.port = 80
+            c.process_pool = pool
+            environ = WSGI_ENVIRON()
+            with self.test_app.request_context(environ):
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                with mock.patch.object(i.manipulator, 'derive') as derive:
+                    resp = i.image_request_response('full/75,/0/default.png')
+                    self.assertFalse(derive.called)
+                self.assertEqual(resp.mimetype, 'image/png')
+                outfile = resp.response.file.name
+                body = b''.join(resp.response)
+                resp.close()
+                self.assertEqual(Image.open(io.BytesIO(body)).size, (75, 100))
+                self.assertFalse(os.path.exists(outfile))
+            # temporary file also removed with coalesced requests
+            c.single_flight = IIIFSingleFlight()
+            with self.test_app.request_context(environ):
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                with mock.patch.object(c.single_flight, 'do_shared', wraps=c.single_flight.do_shared) as do_shared:
+                    resp = i.image_request_response('full/75,/0/default.png')
+                    self.assertTrue(do_shared.called)
+                outfile = resp.response.file.name
+                self.assertTrue(os.path.exists(outfile))
+                resp.close()
+                self.assertFalse(os.path.exists(outfile))
+            del c.single_flight
+            # output stored in cache
+            c.derivative_cache = IIIFDerivativeCache(tmp)
+            with self.test_app.request_context(environ):
+                i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                resp = i.image_request_response('full/75,/0/default.png')
+                self.assertEqual(resp.response.file.name,
+                                 os.path.join(tmp, 'p/starfish/full/75,/0/default.png'))
+                resp.close()
+                # background derivation is not limited by request deadline
+                i.deadline = time.time() - 1
+                r = IIIFRequest(identifier='starfish')
+                r.parse_url('full/50,/0/default.png')
+                with mock.patch.object(pool, 'derive', wraps=pool.derive) as derive:
+                    (outfile, mime_type) = i.derive(i.source_file, 'p/starfish/full/50,/0/default.png', r)
+                    self.assertEqual(derive.call_args[1]['deadline'], None)
+                self.assertEqual(outfile, os.path.join(tmp, 'p/starfish/full/50,/0/default.png'))
+        finally:
+            pool.shutdown()
+            shutil.rmtree(tmp)
+
+    def test44_IIIFHandler_cache_control(self):
+        """Test Cache-Control headers from IIIFHandler."""
+        c = Config()
+        c.api_version = '2.1'
+        c.klass_name = 'pil'
+        c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+        c.tile_height = 512
+        c.tile_width = 512
+        c.scale_factors = [1, 2]
+        c.host = 'example.org'
+        c.port = 80
+        c.cache_control_policy = {'tile': 'public, max-age=10', 'size': 'public, max-age=20',
+                                  'info': 'public, max-age=30', 'degraded': 'public, max-age=40'}
+        environ = WSGI_ENVIRON()
+        with self.test_app.request_context(environ):
+            for (identifier, path, cache_control) in [
+                    ('starfish', 'full/75,/0/default.jpg', 'public, max-age=20'),
+                    ('starfish', '0,0,512,512/256,/0/default.jpg', 'public, max-age=10'),
+                    ('starfish', 'pct:0,0,100,100/256,/0/default.jpg', 'public, max-age=20'),
+                    ('starfish-deg', '0,0,512,512/256,/0/default.jpg', 'public, max-age=40')]:
+                i = IIIFHandler(prefix='p', identifier=identifier, config=c,
+                                klass=IIIFManipulatorPIL, auth=None)
+                resp = i.image_request_response(path)
+                self.assertEqual(resp.headers['Cache-Control'], cache_control)
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            resp = i.image_information_response()
+            self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=30')
+            # errors, none configured so no header even if previously set
+            i.add_cache_control_header('tile')
+            resp = i.error_response(IIIFError(404, 'nope'))
+            self.assertNotIn('Cache-Control', resp.headers)
+            c.cache_control_policy['error'] = 'public, max-age=5'
+            resp = i.error_response(IIIFError(404, 'nope'))
+            self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=5')
+            # auth always private except degraded
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=IIIFAuthBasic())
+            resp = i.image_request_response('full/75,/0/default.jpg')
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-store')
+            i = IIIFHandler(prefix='p', identifier='starfish-deg', config=c,
+                            klass=IIIFManipulatorPIL, auth=IIIFAuthBasic())
+            resp = i.image_request_response('full/75,/0/default.jpg')
+            self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=40')
+            # no policy, left to Flask
+            del c.cache_control_policy
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            resp = i.image_request_response('full/75,/0/default.jpg')
+            self.assertNotIn('max-age', resp.headers.get('Cache-Control', ''))
+
+    def test45_IIIFHandler_error_response(self):
         """Test IIIFHandler.error_response()."""
         c = Config()
         c.api_version = '2.1'
@@ -324,8 +1141,21 @@ class TestAll(unittest.TestCase):
         with self.test_app.request_context(environ):
             resp = i.error_response(IIIFError(999, 'bwaa'))
             self.assertEqual(resp.status_code, 999)
+            # validators of the image are not sent with errors
+            c.klass_name = 'pil'
+            i = IIIFHandler(prefix='p', identifier='starfish', config=c,
+                            klass=IIIFManipulatorPIL, auth=None)
+            try:
+                i.image_request_response('full/10,/0/default.tif')
+                self.fail("no IIIFError")
+            except IIIFError as e:
+                self.assertIn('ETag', i.headers)
+                resp = i.error_response(e)
+            self.assertEqual(resp.status_code, 415)
+            self.assertNotIn('ETag', resp.headers)
+            self.assertNotIn('Last-Modified', resp.headers)
 
-    def test28_iiif_info_handler(self):
+    def test46_iiif_info_handler(self):
         """Test iiif_info_handler()."""
         c = Config()
         c.api_version = '2.1'
@@ -364,7 +1194,7 @@ class TestAll(unittest.TestCase):
                                      klass=IIIFManipulator, auth=auth)
             self.assertEqual(resp.status_code, 302)
 
-    def test28_iiif_image_handler(self):
+    def test47_iiif_image_handler(self):
         """Test iiif_image_handler()."""
         c = Config()
         c.api_version = '2.1'
@@ -402,19 +1232,164 @@ class TestAll(unittest.TestCase):
             resp.direct_passthrough = False  # avoid Flask complaint when reading .data
             self.assertTrue(resp.data.startswith(b'<!DOCTYPE HTML'))
 
-    def test29_degraded_request(self):
+    def test48_iiif_image_handler_head(self):
+        """Test iiif_image_handler() for HEAD requests."""
+        tmp = tempfile.mkdtemp()
+        try:
+            c = Config()
+            c.api_version = '2.1'
+            c.klass_name = 'pil'
+            c.image_dir = os.path.join(os.path.dirname(__file__), '../testimages')
+            c.host = 'example.org'
+            c.port = 80
+            c.derivative_cache = IIIFDerivativeCache(tmp)
+            environ = WSGI_ENVIRON()
+            environ['REQUEST_METHOD'] = 'HEAD'
+            with self.test_app.request_context(environ):
+                with mock.patch.object(IIIFManipulatorPIL, 'derive') as derive:
+                    resp = iiif_image_handler(prefix='p', identifier='starfish',
+                                              path='full/75,/0/default.png',
+                                              config=c, klass=IIIFManipulatorPIL)
+                    self.assertFalse(derive.called)
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.headers['Content-Type'], 'image/png')
+                self.assertNotIn('Content-Length', resp.get_wsgi_headers(environ))
+                self.assertIn('ETag', resp.headers)
+                self.assertIn('Link', resp.headers)
+                etag = resp.headers['ETag']
+                resp = iiif_image_handler(prefix='p', identifier='starfish',
+                                          path='full/75,/0/default.gif',
+                                          config=c, klass=IIIFManipulatorPIL)
+                self.assertEqual(resp.status_code, 415)
+            # cached after GET
+            with self.test_app.request_context(WSGI_ENVIRON()):
+                resp = iiif_image_handler(prefix='p', identifier='starfish',
+                                          path='full/75,/0/default.png',
+                                          config=c, klass=IIIFManipulatorPIL)
+                resp.close()
+            with self.test_app.request_context(environ):
+                resp = iiif_image_handler(prefix='p', identifier='starfish',
+                                          path='full/75,/0/default.png',
+                                          config=c, klass=IIIFManipulatorPIL)
+                self.assertEqual(resp.headers['ETag'], etag)
+                self.assertEqual(resp.headers['Content-Type'], 'image/png')
+                self.assertEqual(int(resp.headers['Content-Length']),
+                                 os.path.getsize(os.path.join(tmp, 'p/starfish/full/75,/0/default.png')))
+            # source size kept, image not opened
+            c.info_cache_size = 10
+            c.info_sizes = {}
+            with self.test_app.request_context(environ):
+                resp = iiif_image_handler(prefix='p', identifier='starfish',
+                                          path='full/80,/0/default.jpg',
+                                          config=c, klass=IIIFManipulatorPIL)
+                self.assertEqual(len(c.info_sizes), 1)
+                with mock.patch.object(IIIFManipulatorPIL, 'do_first') as do_first:
+                    resp = iiif_image_handler(prefix='p', identifier='starfish',
+                                              path='full/90,/0/default.jpg',
+                                              config=c, klass=IIIFManipulatorPIL)
+                    self.assertFalse(do_first.called)
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.headers['Content-Type'], 'image/jpeg')
+            del c.info_sizes
+            # manipulator without declared formats derives image
+            c.klass_name = 'dummy'
+            c.derivative_cache = None
+            with self.test_app.request_context(environ):
+                resp = iiif_image_handler(prefix='p', identifier='starfish',
+                                          path='full/full/0/default',
+                                          config=c, klass=IIIFManipulator)
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.content_length, 3523302)
+                resp.close()
+        finally:
+            shutil.rmtree(tmp)
+
+    def test49_degraded_request(self):
         """Test degraded_request()."""
         self.assertFalse(degraded_request('something'))
         self.assertEqual(degraded_request('s-deg'), 's')
 
-    def test30_options_handler(self):
+    def test50_options_handler(self):
         """Test options_handler()."""
         with self.test_app.app_context():
             resp = options_handler()
             self.assertEqual(resp.status_code, 200)
             self.assertEqual(resp.headers['Access-control-allow-origin'], '*')
 
-    def test40_parse_authorization_header(self):
+    def test51_IIIFDispatcher(self):
+        """Test IIIFDispatcher route table."""
+        d = IIIFDispatcher()
+        c = Config()
+        c.include_osd = False
+        params = dict(config=c, klass=IIIFManipulator, auth=None, prefix='a/b')
+        self.assertTrue(d.add('a/b', params=params))
+        self.assertFalse(d.add('/a/b/', params=params))
+        self.assertTrue(d.add('a', params=dict(params, prefix='a')))
+        self.assertEqual(d.depths, [2, 1])
+        auth = IIIFAuthBasic()
+        routes = {'login': auth.login_handler}
+        self.assertTrue(d.add('client', routes=routes, params=params))
+        self.assertFalse(d.add('client', routes=routes, params=params))
+        self.assertEqual(d.resolve('x/id/info.json'), None)
+        self.assertEqual(d.resolve('a/b')[0], 'prefix_index_page')
+        self.assertEqual(d.resolve('a/b')[2], {'config': c})
+        self.assertEqual(d.resolve('a/b/')[2], {'location': '/a/b', 'keep_query': True})
+        self.assertEqual(d.resolve('a')[0], 'prefix_index_page')
+        (endpoint, view, values) = d.resolve('a/b/id/info.json')
+        self.assertEqual(endpoint, 'iiif_info_handler')
+        self.assertEqual(values['identifier'], 'id')
+        self.assertEqual(values['prefix'], 'a/b')
+        (endpoint, view, values) = d.resolve('a/c/full/full/0/default.jpg')
+        self.assertEqual(endpoint, 'iiif_image_handler')
+        self.assertEqual(values['identifier'], 'c')
+        self.assertEqual(values['prefix'], 'a')
+        self.assertEqual(values['path'], 'full/full/0/default.jpg')
+        self.assertEqual(d.resolve('a/b/id/osd.html')[0], 'iiif_image_handler')
+        c.include_osd = True
+        self.assertEqual(d.resolve('a/b/id/osd.html')[0], 'osd_page_handler')
+        self.assertEqual(d.resolve('a/b/id')[2], {'location': '/a/b/id/info.json'})
+        self.assertEqual(d.resolve('a/b/id/')[0], 'redirect')
+        self.assertEqual(d.resolve('a//info.json'), None)
+        (endpoint, view, values) = d.resolve('client/login')
+        self.assertEqual(endpoint, 'login_handler')
+        self.assertEqual(values['prefix'], 'a/b')
+        self.assertEqual(d.resolve('client/id/info.json'), None)
+        # as Flask view
+        app = flask.Flask('DispatchApp')
+        app.add_url_rule('/<path:iiif_path>', 'iiif_dispatcher', d,
+                         methods=DISPATCHER_METHODS, provide_automatic_options=False)
+        # responses as from the URL rules previously added for each handler
+        with app.test_client() as client:
+            for (method, path, status, location, allow) in (
+                    ('GET', '/a/b/id', 308, 'http://localhost/a/b/id/info.json', None),
+                    ('OPTIONS', '/a/b/id', 308, 'http://localhost/a/b/id/info.json', None),
+                    ('GET', '/a/b/id/?x=1', 308, 'http://localhost/a/b/id/info.json', None),
+                    ('POST', '/a/b/id', 405, None, 'GET, HEAD, OPTIONS'),
+                    ('GET', '/a/b/', 308, 'http://localhost/a/b', None),
+                    ('HEAD', '/a/b/?x=1', 308, 'http://localhost/a/b?x=1', None),
+                    ('OPTIONS', '/a/b/', 308, 'http://localhost/a/b', None),
+                    ('OPTIONS', '/a/b', 200, None, 'GET, HEAD, OPTIONS'),
+                    ('GET', '/a/b//id%20x?y=2', 308, 'http://localhost/a/b/id%20x?y=2', None),
+                    ('GET', '/a/b/id//full/full/0/default.jpg', 308,
+                     'http://localhost/a/b/id/full/full/0/default.jpg', None),
+                    ('OPTIONS', '/a/b/id//full/full/0/default.jpg', 405, None, 'GET, HEAD'),
+                    ('OPTIONS', '/a/b/id/full/full/0/default.jpg', 405, None, 'GET, HEAD'),
+                    ('POST', '/a/b/id/info.json', 405, None, 'GET, HEAD, OPTIONS'),
+                    ('GET', '/x/y', 404, None, None),
+                    ('POST', '/x/y', 404, None, None),
+                    ('GET', '/x//y', 404, None, None),
+                    ('GET', '/client/', 404, None, None)):
+                resp = client.open(path, method=method)
+                self.assertEqual(resp.status_code, status, method + ' ' + path)
+                self.assertEqual(resp.headers.get('Location'), location, method + ' ' + path)
+                if (allow is not None):
+                    self.assertEqual(sorted(resp.headers['Allow'].split(', ')),
+                                     sorted(allow.split(', ')))
+            resp = client.options('/a/b/id/info.json')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Access-Control-Allow-Methods'], 'GET,OPTIONS')
+
+    def test52_parse_authorization_header(self):
         """Test parse_authorization_header."""
         # Garbage
         self.assertEqual(parse_authorization_header(''), None)
@@ -450,7 +1425,7 @@ class TestAll(unittest.TestCase):
             'Digest username="a", realm="r", nonce="n", uri="u", '
             'response="rr", qop="no_nc"'), None)
 
-    def test41_parse_accept_header(self):
+    def test53_parse_accept_header(self):
         """Test parse_accept_header."""
         accepts = parse_accept_header("text/xml")
         self.assertEqual(len(accepts), 1)
@@ -463,26 +1438,87 @@ class TestAll(unittest.TestCase):
         self.assertEqual(accepts[0], ('text/html', (), 0.6))
         self.assertEqual(accepts[1], ('text/xml', (), 0.5))
 
-    def test42_make_prefix(self):
+    def test54_etags_and_dates(self):
+        """Test make_etag, etag_matches and parse_http_date."""
+        etag = make_etag('a', 'b')
+        self.assertEqual(len(etag), 42)
+        self.assertEqual(etag, make_etag('a', 'b'))
+        self.assertNotEqual(etag, make_etag('ab'))
+        self.assertTrue(etag_matches(etag, etag))
+        self.assertTrue(etag_matches('*', etag))
+        self.assertTrue(etag_matches('"x", W/' + etag, etag))
+        self.assertTrue(etag_matches(etag, 'W/' + etag))
+        self.assertTrue(etag_matches('W/' + etag, 'W/' + etag))
+        self.assertFalse(etag_matches('"x"', etag))
+        self.assertFalse(etag_matches('', etag))
+        self.assertEqual(parse_http_date('Thu, 01 Jan 1970 00:01:00 GMT'), 60)
+        self.assertEqual(parse_http_date('Sun, 06 Nov 1994 08:49:37 GMT'), 784111777)
+        self.assertEqual(parse_http_date('junk'), None)
+        self.assertEqual(parse_http_date(''), None)
+
+    def test55_canonical_size(self):
+        """Test canonical_size."""
+        self.assertEqual(canonical_size('full', 'full', 300, 400), (300, 400))
+        self.assertEqual(canonical_size('full', 'max', 300, 400), (300, 400))
+        self.assertEqual(canonical_size('full', '75,', 300, 400), (75, 100))
+        self.assertEqual(canonical_size('0,0,100,50', '15,', 300, 400), (15, 8))
+        self.assertEqual(canonical_size('0,0,100,50', '^150,75', 300, 400), (150, 75))
+        self.assertEqual(canonical_size('0,0,100,50', '10,10', 300, 400), (10, 10))
+        self.assertEqual(canonical_size('pct:0,0,10,10', '10,10', 300, 400), None)
+        self.assertEqual(canonical_size('full', 'pct:50', 300, 400), None)
+
+    def test56_cache_control_policy(self):
+        """Test cache_control_policy."""
+        self.assertEqual(cache_control_policy(None), {})
+        self.assertEqual(cache_control_policy([]), {})
+        options = ['tile=public,max-age=100 , immutable',
+                   'info=public, max-age=60',
+                   'info@2.1_pil=public, max-age=600',
+                   'size@/api/image/2.1/example/reference=no-cache']
+        self.assertEqual(cache_control_policy(options),
+                         {'tile': 'public, max-age=100, immutable',
+                          'info': 'public, max-age=60'})
+        self.assertEqual(cache_control_policy(options, ('2.1_pil', 'c/2.1_pil')),
+                         {'tile': 'public, max-age=100, immutable',
+                          'info': 'public, max-age=600'})
+        self.assertEqual(cache_control_policy(options, ('api/image/2.1/example/reference', None)),
+                         {'tile': 'public, max-age=100, immutable',
+                          'info': 'public, max-age=60',
+                          'size': 'no-cache'})
+        self.assertRaises(ValueError, cache_control_policy, ['tile'])
+        self.assertRaises(ValueError, cache_control_policy, ['thumbnail=no-cache'])
+
+    def test57_make_prefix(self):
         """Test make_prefix."""
         self.assertEqual(make_prefix('vv', 'mm', None), 'vv_mm')
         self.assertEqual(make_prefix('v2', 'm2', 'none'), 'v2_m2')
         self.assertEqual(make_prefix('v3', 'm3', 'a'), 'v3_m3_a')
 
-    def test43_split_comma_argument(self):
+    def test58_split_comma_argument(self):
         """Test split_comma_argument()."""
         self.assertEqual(split_comma_argument(''), [])
         self.assertEqual(split_comma_argument('a,b'), ['a', 'b'])
         self.assertEqual(split_comma_argument('a,b,cccccccccc,,,'),
                          ['a', 'b', 'cccccccccc'])
 
-    def test50_add_shared_configs(self):
+    def test59_add_shared_configs(self):
         """Test add_shared_configs() - just check it runs."""
         p = argparse.ArgumentParser()
         add_shared_configs(p)
         self.assertIn('--include-osd', p.format_help())
+        self.assertIn('--negative-cache-size', p.format_help())
+        self.assertIn('--cache-dir', p.format_help())
+        self.assertIn('--prefetch-queue-size', p.format_help())
+        self.assertIn('--derive-from-cache-factor', p.format_help())
+        self.assertIn('--mosaic', p.format_help())
+        self.assertIn('--pyramid-dir', p.format_help())
+        self.assertIn('--asgi-executor', p.format_help())
+        self.assertIn('--max-requests', p.format_help())
+        self.assertIn('--max-decode-pixels', p.format_help())
+        self.assertIn('--derive-slots', p.format_help())
+        self.assertIn('--derive-timeout', p.format_help())
 
-    def test51_add_handler(self):
+    def test60_add_handler(self):
         """Test add_handler."""
         c = Config()
         c.klass_name = 'pil'
@@ -497,6 +1533,7 @@ class TestAll(unittest.TestCase):
             c.prefix = 'pfx1_' + auth
             c.client_prefix = c.prefix
             self.assertTrue(add_handler(self.test_app, Config(c)))
+        self.assertIn('pfx1_basic', self.test_app.extensions['iiif_dispatcher'].handlers)
         # Manipulator types
         c.auth_type = 'none'
         for klass in ('pil', 'netpbm', 'gen', 'dummy'):
@@ -507,6 +1544,99 @@ class TestAll(unittest.TestCase):
         # Include OSD
         c.include_osd = True
         self.assertTrue(add_handler(self.test_app, Config(c)))
+        # Negative cache
+        c.negative_cache_size = 10
+        c.negative_cache_ttl = 5
+        c2 = Config(c)
+        self.assertTrue(add_handler(self.test_app, c2))
+        self.assertEqual(c2.negative_cache.size, 10)
+        self.assertEqual(c2.negative_cache.ttl, 5)
+        del c.negative_cache_size
+        # Derivative cache
+        c.cache_dir = '/tmp/cache'
+        c2 = Config(c)
+        self.assertTrue(add_handler(self.test_app, c2))
+        self.assertEqual(c2.derivative_cache.cache_dir, '/tmp/cache')
+        del c.cache_dir
+        # Coalescing requests
+        c.coalesce_requests = True
+        c.coalesce_lock_dir = '/tmp/locks'
+        c2 = Config(c)
+        self.assertTrue(add_handler(self.test_app, c2))
+        self.assertEqual(c2.single_flight.lock_dir, '/tmp/locks')
+        del c.coalesce_requests
+        # Pyramid levels
+        c.pyramid_dir = '/tmp/pyramids'
+        c2 = Config(c)
+        self.assertTrue(add_handler(self.test_app, c2))
+        self.assertEqual(c2.pyramid.cache_dir, '/tmp/pyramids')
+        self.assertTrue(c2.pyramid_builder)
+        del c.pyramid_dir
+        # Prefetching
+        c.prefetch = True
+        c.prefetch_queue_size = 7
+        c2 = Config(c)
+        self.assertTrue(add_handler(self.test_app, c2))
+        self.assertEqual(c2.prefetcher.queue.maxsize, 7)
+        del c.prefetch
+        # Admission control shared by all handlers
+        c.max_decode_pixels = 1000
+        c.max_decode_mb = 2
+        app = flask.Flask('AdmissionApp')
+        c2 = Config(c)
+        c3 = Config(c)
+        c3.prefix = 'pfx3'
+        c3.client_prefix = c3.prefix
+        self.assertTrue(add_handler(app, c2))
+        self.assertTrue(add_handler(app, c3))
+        self.assertIs(c2.admission, c3.admission)
+        self.assertEqual(c2.admission.max_pixels, 1000)
+        self.assertEqual(c2.admission.max_bytes, 2097152)
+        with app.test_client() as client:
+            resp = client.get('/admission.json')
+            self.assertEqual(json.loads(resp.data.decode('utf-8'))['max_pixels'], 1000)
+        del c.max_decode_pixels
+        del c.max_decode_mb
+        # Scheduler shared by all handlers
+        c.derive_slots = 3
+        c.derive_max_wait = 5
+        app = flask.Flask('SchedulerApp')
+        c2 = Config(c)
+        c3 = Config(c)
+        c3.prefix = 'pfx3'
+        c3.client_prefix = c3.prefix
+        self.assertTrue(add_handler(app, c2))
+        self.assertTrue(add_handler(app, c3))
+        self.assertIs(c2.scheduler, c3.scheduler)
+        self.assertEqual(c2.scheduler.bulk_slots, 2)
+        self.assertEqual(c2.scheduler.max_wait, 5)
+        with app.test_client() as client:
+            resp = client.get('/scheduler.json')
+            self.assertEqual(json.loads(resp.data.decode('utf-8'))['slots'], 3)
+        del c.derive_slots
+        # Process pool shared by selected handlers
+        c.derive_processes = 1
+        c.derive_process_prefixes = 'pfx3,gen'
+        app = flask.Flask('PoolApp')
+        c2 = Config(c)
+        c3 = Config(c)
+        c3.prefix = 'pfx3'
+        c3.client_prefix = c3.prefix
+        self.assertTrue(add_handler(app, c2))
+        self.assertTrue(add_handler(app, c3))
+        self.assertFalse(hasattr(c2, 'process_pool'))
+        self.assertEqual(c3.process_pool.workers, 1)
+        c3.process_pool.shutdown()
+        del c.derive_processes
+        del c.derive_process_prefixes
+        # Cache-Control policy
+        c.cache_control = ['tile=max-age=1', 'tile@' + c.prefix + '=max-age=2']
+        c2 = Config(c)
+        self.assertTrue(add_handler(self.test_app, c2))
+        self.assertEqual(c2.cache_control_policy, {'tile': 'max-age=2'})
+        c.cache_control = ['bad']
+        self.assertFalse(add_handler(self.test_app, Config(c)))
+        del c.cache_control
         # Bad cases
         c.auth_type = 'bogus'
         self.assertFalse(add_handler(self.test_app, Config(c)))
@@ -514,6 +1644,70 @@ class TestAll(unittest.TestCase):
         c.klass_name = 'no-klass'
         self.assertFalse(add_handler(self.test_app, Config(c)))
 
+    def test61_warm_app(self):
+        """Test warm_app and the info cache it fills."""
+        tmp = tempfile.mkdtemp()
+        try:
+            for name in ('a', 'b', 'c'):
+                Image.new('RGB', (30, 20)).save(os.path.join(tmp, name + '.png'))
+            c = Config()
+            c.klass_name = 'pil'
+            c.api_version = '2.1'
+            c.auth_type = 'none'
+            c.include_osd = False
+            c.image_dir = tmp
+            c.tile_height = 512
+            c.tile_width = 512
+            c.scale_factors = ['auto']
+            c.host = 'example.org'
+            c.port = 80
+            c.prefix = 'warm'
+            c.client_prefix = c.prefix
+            c.info_cache_size = 2
+            app = flask.Flask('WarmApp')
+            self.assertTrue(add_handler(app, c))
+            self.assertEqual(app.extensions['iiif_configs'], [c])
+            # top level, prefix index, 2 info.json
+            self.assertEqual(warm_app(app), 4)
+            self.assertEqual(sorted(c.identifier_index['ids']), ['a', 'b', 'c'])
+            self.assertIn('/warm/c/info.json', c.identifier_index['page'][1])
+            self.assertEqual(sorted(c.info_bodies.keys()),
+                             [('a', 'application/json'), ('b', 'application/json')])
+            self.assertEqual(sorted(c.info_sizes.keys()),
+                             [os.path.join(tmp, 'a.png'), os.path.join(tmp, 'b.png')])
+            # kept info.json used while the image is unchanged
+            mtime = os.path.getmtime(os.path.join(tmp, 'a.png'))
+            c.info_bodies[('a', 'application/json')] = (mtime, '{"kept": 1}')
+            with app.test_client() as client:
+                resp = client.get('/warm/a/info.json')
+                self.assertEqual(resp.data, b'{"kept": 1}')
+                # cache full, c not kept
+                resp = client.get('/warm/c/info.json')
+                self.assertEqual(json.loads(resp.data.decode('utf-8'))['width'], 30)
+                self.assertEqual(len(c.info_bodies), 2)
+                # changed image
+                os.utime(os.path.join(tmp, 'a.png'), (mtime + 10, mtime + 10))
+                resp = client.get('/warm/a/info.json')
+                self.assertEqual(json.loads(resp.data.decode('utf-8'))['height'], 20)
+            # new image seen once directory changes
+            Image.new('RGB', (30, 20)).save(os.path.join(tmp, 'd.png'))
+            dir_mtime = c.identifier_index['mtime']
+            os.utime(tmp, (dir_mtime + 10, dir_mtime + 10))
+            self.assertIn('/warm/d/info.json', prefix_index_page(c))
+            # no info cache
+            c2 = Config(c)
+            c2.info_cache_size = 0
+            c2.prefix = 'nowarm'
+            c2.client_prefix = c2.prefix
+            for k in ('identifier_index', 'info_sizes', 'info_bodies'):
+                delattr(c2, k)
+            app = flask.Flask('NoWarmApp')
+            self.assertTrue(add_handler(app, c2))
+            self.assertFalse(hasattr(c2, 'info_bodies'))
+            self.assertEqual(warm_app(app), 2)
+        finally:
+            shutil.rmtree(tmp)
+
     def test62_serve_static(self):
         """Test serve_static()."""
         environ = WSGI_ENVIRON()
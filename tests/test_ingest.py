@@ -0,0 +1,124 @@
+"""Test code for iiif/ingest.py."""
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from PIL import Image
+
+from iiif.ingest import IIIFIngest, IIIFIngestError, ingest_scale_factors, tifffile
+
+
+class TestAll(unittest.TestCase):
+    """Tests for IIIFIngest."""
+
+    def setUp(self):
+        """Make temporary directories."""
+        self.tmp = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp, 'masters')
+        self.dst = os.path.join(self.tmp, 'tiff')
+        os.makedirs(os.path.join(self.src_dir, 'sub'))
+
+    def tearDown(self):
+        """Remove temporary directories."""
+        shutil.rmtree(self.tmp)
+
+    def test01_scale_factors(self):
+        """Test ingest_scale_factors."""
+        self.assertEqual(ingest_scale_factors(3000, 4000, 512), [1, 2, 4])
+        self.assertEqual(ingest_scale_factors(100, 100, 512), [1])
+        self.assertEqual(ingest_scale_factors(1000, 100, 256, 64), [1, 2])
+
+    def test02_paths(self):
+        """Test output_path, up_to_date and sources."""
+        ing = IIIFIngest(dst=self.dst)
+        for name in ('a.jpg', 'sub/b.PNG', 'c.txt', '.tmp1.jpg'):
+            open(os.path.join(self.src_dir, name), 'w').close()
+        self.assertEqual(list(ing.sources(self.src_dir)),
+                         [os.path.join(self.src_dir, 'a.jpg'),
+                          os.path.join(self.src_dir, 'sub/b.PNG')])
+        src = os.path.join(self.src_dir, 'sub/b.PNG')
+        dst = ing.output_path(src, self.src_dir)
+        self.assertEqual(dst, os.path.join(self.dst, 'sub/b.tif'))
+        self.assertEqual(ing.output_path(src), os.path.join(self.dst, 'b.tif'))
+        self.assertFalse(ing.up_to_date(src, dst))
+        os.makedirs(os.path.dirname(dst))
+        open(dst, 'w').close()
+        self.assertTrue(ing.up_to_date(src, dst))
+        os.utime(src, (time.time() + 10, time.time() + 10))
+        self.assertFalse(ing.up_to_date(src, dst))
+
+    @unittest.skipIf(tifffile is None, "tifffile not installed")
+    def test03_convert(self):
+        """Test convert."""
+        src = os.path.join(self.src_dir, 'a.png')
+        Image.new('RGBA', (1100, 600), (10, 20, 30, 255)).save(src)
+        ing = IIIFIngest(dst=self.dst, tile_width=256)
+        dst = ing.output_path(src, self.src_dir)
+        self.assertEqual(ing.convert(src, dst), [1, 2, 4])
+        im = Image.open(dst)
+        self.assertEqual(im.n_frames, 3)
+        self.assertEqual(im.size, (1100, 600))
+        self.assertEqual(im.mode, 'RGB')
+        self.assertEqual(im.getpixel((1000, 500)), (10, 20, 30))
+        im.seek(2)
+        self.assertEqual(im.size, (275, 150))
+        self.assertEqual(os.listdir(self.dst), ['a.tif'])
+        # grayscale, dryrun
+        src = os.path.join(self.src_dir, 'b.jpg')
+        Image.new('L', (100, 100), 99).save(src)
+        ing.convert(src, os.path.join(self.dst, 'b.tif'))
+        self.assertEqual(Image.open(os.path.join(self.dst, 'b.tif')).mode, 'L')
+        ing.dryrun = True
+        self.assertEqual(ing.convert(src, os.path.join(self.dst, 'c.tif')), [1])
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'c.tif')))
+        # failure leaves no file
+        ing.dryrun = False
+        ing.compression = 'no-such-compression'
+        self.assertRaises(Exception, ing.convert, src, os.path.join(self.dst, 'd.tif'))
+        self.assertEqual(sorted(os.listdir(self.dst)), ['a.tif', 'b.tif'])
+
+    @unittest.skipIf(tifffile is None, "tifffile not installed")
+    def test04_ingest(self):
+        """Test ingest of directory."""
+        Image.new('RGB', (600, 300)).save(os.path.join(self.src_dir, 'a.jpg'))
+        Image.new('RGB', (300, 600)).save(os.path.join(self.src_dir, 'sub/b.png'))
+        with open(os.path.join(self.src_dir, 'bad.jpg'), 'w') as fh:
+            fh.write('not a jpeg')
+        ing = IIIFIngest(dst=self.dst, tile_width=256, workers=2)
+        self.assertEqual(ing.ingest(self.src_dir), (2, 0, 1))
+        self.assertTrue(os.path.isfile(os.path.join(self.dst, 'a.tif')))
+        self.assertTrue(os.path.isfile(os.path.join(self.dst, 'sub/b.tif')))
+        self.assertEqual(ing.ingest(self.src_dir), (0, 2, 1))
+
+    def test05_no_tifffile(self):
+        """Test error without tifffile."""
+        import iiif.ingest
+        saved = iiif.ingest.tifffile
+        try:
+            iiif.ingest.tifffile = None
+            ing = IIIFIngest(dst=self.dst)
+            self.assertRaises(IIIFIngestError, ing.convert, 'a.jpg', 'a.tif')
+            self.assertRaises(IIIFIngestError, ing.ingest, self.src_dir)
+        finally:
+            iiif.ingest.tifffile = saved
+
+    @unittest.skipIf(tifffile is None, "tifffile not installed")
+    def test06_main(self):
+        """Test iiif_ingest.py goes on after a file that fails."""
+        bad = os.path.join(self.src_dir, 'bad.jpg')
+        with open(bad, 'w') as fh:
+            fh.write('not a jpeg')
+        good = os.path.join(self.src_dir, 'good.jpg')
+        Image.new('RGB', (600, 300)).save(good)
+        script = os.path.join(os.path.dirname(__file__), '..', 'iiif_ingest.py')
+        proc = subprocess.Popen([sys.executable, script, '-q', '-d', self.dst, bad, good],
+                                stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn(b'bad.jpg', err)
+        self.assertEqual(os.listdir(self.dst), ['good.tif'])
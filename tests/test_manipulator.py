@@ -2,11 +2,14 @@
 import os
 import shutil
 import tempfile
+import time
 import unittest
 
+import mock
+
 from iiif.manipulator import IIIFManipulator, IIIFZeroSizeError
 from iiif.request import IIIFRequest
-from iiif.error import IIIFError
+from iiif.error import IIIFError, IIIFDeadlineError
 
 
 class TestAll(unittest.TestCase):
@@ -396,3 +399,104 @@ class TestAll(unittest.TestCase):
         self.assertEqual(m.compliance_uri, None)
         m.compliance_level = 2
         self.assertEqual(m.compliance_uri, None)
+
+    def test17_canonical_request(self):
+        """Test canonical_request for different versions."""
+        def canonical(api_version, path, width=1000, height=500):
+            m = IIIFManipulator(api_version=api_version)
+            m.request = IIIFRequest(api_version=api_version)
+            m.request.parse_url(path)
+            return m.canonical_request(width, height).url()
+        # 2.1, equivalents of full image
+        for path in ('id/full/full/0/default.jpg',
+                     'id/pct:0,0,100,100/pct:100/360/default.jpg',
+                     'id/0,0,1000,500/1000,/0/default.jpg',
+                     'id/0,0,2000,600/1000,500/0/default.jpg',
+                     'id/full/max/0/default.jpg'):
+            self.assertEqual(canonical('2.1', path), 'id/full/full/0/default.jpg')
+        # 2.1, scaled
+        self.assertEqual(canonical('2.1', 'id/full/!500,500/0/default.png'),
+                         'id/full/500,/0/default.png')
+        self.assertEqual(canonical('2.1', 'id/full/pct:10/0/default.png'),
+                         'id/full/100,/0/default.png')
+        self.assertEqual(canonical('2.1', 'id/full/100,100/0/default.png'),
+                         'id/full/100,100/0/default.png')
+        self.assertEqual(canonical('2.1', 'id/pct:50,0,50,100/,250/0/gray.jpg'),
+                         'id/500,0,500,500/250,/0/gray.jpg')
+        # rotation
+        self.assertEqual(canonical('2.1', 'id/full/full/!360/default.jpg'),
+                         'id/full/full/!0/default.jpg')
+        self.assertEqual(canonical('2.1', 'id/full/full/22.50/default.jpg'),
+                         'id/full/full/22.5/default.jpg')
+        # quality and format
+        self.assertEqual(canonical('2.1', 'id/full/full/0/default'),
+                         'id/full/full/0/default')
+        self.assertEqual(canonical('1.1', 'id/full/full/0/native.jpg'),
+                         'id/full/full/0/native.jpg')
+        self.assertEqual(canonical('1.1', 'id/full/100,50/0/native.jpg'),
+                         'id/full/100,/0/native.jpg')
+        # 3.0
+        self.assertEqual(canonical('3.0', 'id/full/max/0/default.jpg'),
+                         'id/full/max/0/default.jpg')
+        self.assertEqual(canonical('3.0', 'id/full/100,/0/default.jpg'),
+                         'id/full/100,50/0/default.jpg')
+        self.assertEqual(canonical('3.0', 'id/0,0,100,100/^200,/0/default.jpg'),
+                         'id/0,0,100,100/%5E200,200/0/default.jpg')
+        self.assertEqual(canonical('3.0', 'id/square/max/0/default.jpg'),
+                         'id/250,0,500,500/max/0/default.jpg')
+        # square with odd offset cannot be expressed in whole pixels
+        self.assertEqual(canonical('3.0', 'id/square/max/0/default.jpg', 501, 500),
+                         'id/square/max/0/default.jpg')
+        # errors as for derive
+        self.assertRaises(IIIFZeroSizeError, canonical,
+                          '2.1', 'id/1000,0,10,10/full/0/default.jpg')
+        # width and height of manipulator unchanged
+        m = IIIFManipulator()
+        m.request = IIIFRequest()
+        m.request.parse_url('id/10,10,100,100/50,/0/default.jpg')
+        m.width = 1000
+        m.height = 500
+        self.assertEqual(m.canonical_request().url(), 'id/10,10,100,100/50,/0/default.jpg')
+        self.assertEqual((m.width, m.height), (1000, 500))
+
+    def test18_deadline(self):
+        """Test derive with deadline."""
+        m = IIIFManipulator()
+        r = IIIFRequest()
+        r.parse_url('id1/full/full/0/default')
+        tmp = tempfile.mkdtemp()
+        outfile = os.path.join(tmp, 'testout.png')
+        try:
+            m.derive(srcfile='testimages/test1.png', request=r,
+                     outfile=outfile, deadline=time.time() + 100)
+            self.assertTrue(os.path.isfile(outfile))
+            # passed deadline abandons derivation before first stage
+            m = IIIFManipulator()
+            with mock.patch.object(m, 'do_first') as do_first:
+                try:
+                    m.derive(srcfile='testimages/test1.png', request=r,
+                             outfile=outfile, deadline=time.time() - 1)
+                    self.fail("no exception")
+                except IIIFDeadlineError as e:
+                    self.assertEqual(e.code, 503)
+                    self.assertIn('before first', e.text)
+                self.assertFalse(do_first.called)
+            # deadline passed during size stage
+            m = IIIFManipulator()
+            m.width = 10
+            m.height = 10
+
+            def slow_size(w, h):
+                m.deadline = time.time() - 1
+            with mock.patch.object(m, 'do_first'):
+                with mock.patch.object(m, 'do_size', side_effect=slow_size):
+                    with mock.patch.object(m, 'do_rotation') as do_rotation:
+                        try:
+                            m.derive(srcfile='testimages/test1.png', request=r,
+                                     outfile=outfile, deadline=time.time() + 100)
+                            self.fail("no exception")
+                        except IIIFDeadlineError as e:
+                            self.assertIn('before rotation', e.text)
+                        self.assertFalse(do_rotation.called)
+        finally:
+            shutil.rmtree(tmp)
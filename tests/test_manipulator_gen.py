@@ -1,12 +1,13 @@
 """Test code for generators of IIIF Images."""
 import unittest
 import tempfile
+import time
 import os
 import os.path
 
 from PIL import Image
 
-from iiif.error import IIIFError
+from iiif.error import IIIFError, IIIFDeadlineError
 from iiif.manipulator_gen import IIIFManipulatorGen
 from iiif.request import IIIFRequest
 
@@ -85,3 +86,6 @@ class TestAll(unittest.TestCase):
         m.do_size(101, 102)
         self.assertEqual(m.sw, 101)
         self.assertEqual(m.sh, 102)
+        # abandoned in generation loop
+        m.deadline = time.time() - 1
+        self.assertRaises(IIIFDeadlineError, m.do_size, 101, 102)
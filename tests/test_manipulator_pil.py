@@ -4,6 +4,7 @@ import tempfile
 import os
 import os.path
 import re
+import shutil
 import sys
 from testfixtures import LogCapture
 
@@ -201,3 +202,73 @@ class TestAll(unittest.TestCase):
             self.assertEqual(m.cleanup(), None)
             self.assertEqual(lc.records[-1].msg,
                              'Failed to cleanup tmp output file /this_will_not_exist_really_I_hope')
+
+    def test10_mosaic(self):
+        """Test mosaic."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            a = os.path.join(tmpdir, 'a.png')
+            Image.new('L', (10, 10), 50).save(a)
+            b = os.path.join(tmpdir, 'b.png')
+            Image.new('RGB', (5, 10), (200, 200, 200)).save(b)
+            m = IIIFManipulatorPIL()
+            tmp = m.mosaic([(a, (0, 0)), (b, (10, 0))], (15, 10), (5, 0, 15, 10), (5, 5))
+            try:
+                im = Image.open(tmp)
+                self.assertEqual(im.size, (5, 5))
+                self.assertEqual(im.mode, 'RGB')
+                self.assertEqual(im.getpixel((0, 2)), (50, 50, 50))
+                self.assertEqual(im.getpixel((4, 2)), (200, 200, 200))
+            finally:
+                os.remove(tmp)
+            tmp = m.mosaic([(a, (0, 0))], (10, 10), (0, 0, 10, 10), (10, 10))
+            self.assertEqual(Image.open(tmp).mode, 'L')
+            os.remove(tmp)
+            self.assertRaises(IIIFError, m.mosaic, [(b + 'x', (0, 0))], (1, 1), (0, 0, 1, 1), (1, 1))
+        finally:
+            for f in os.listdir(tmpdir):
+                os.remove(os.path.join(tmpdir, f))
+            os.rmdir(tmpdir)
+
+    def test11_pyramid_level(self):
+        """Test derive using pyramid levels."""
+        from iiif.pyramid import IIIFPyramidCache
+        tmpdir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmpdir, 'src.png')
+            im = Image.new('RGB', (800, 400), (255, 0, 0))
+            im.paste((0, 0, 255), (400, 0, 800, 400))
+            im.save(src)
+            p = IIIFPyramidCache(os.path.join(tmpdir, 'pyramid'), min_size=50)
+            p.build(src)
+            m = IIIFManipulatorPIL()
+            m.pyramid = p
+            m.srcfile = src
+            m.do_first()
+            m.request = IIIFRequest(identifier='a')
+            m.request.parse_url('400,0,400,400/50,/0/default.png')
+            self.assertEqual(m.pyramid_level(400, 400), (8, p.levels(src)[1][1]))
+            m.request.parse_url('400,0,400,400/51,/0/default.png')
+            self.assertEqual(m.pyramid_level(400, 400)[0], 4)
+            m.request.parse_url('400,0,400,400/full/0/default.png')
+            self.assertEqual(m.pyramid_level(400, 400), None)
+            # region from level
+            with LogCapture('iiif.manipulator') as lc:
+                m = IIIFManipulatorPIL()
+                m.pyramid = p
+                r = IIIFRequest(identifier='a')
+                r.parse_url('300,0,200,100/20,/0/default.png')
+                m.derive(src, r)
+                self.assertIn('region: reading level with factor 8', [rec.msg for rec in lc.records])
+            self.assertEqual(m.image.size, (20, 10))
+            self.assertEqual(m.image.getpixel((2, 5)), (255, 0, 0))
+            self.assertEqual(m.image.getpixel((17, 5)), (0, 0, 255))
+            # full region from level
+            m = IIIFManipulatorPIL()
+            m.pyramid = p
+            r.parse_url('full/200,/0/default.png')
+            m.derive(src, r)
+            self.assertEqual(m.image.size, (200, 100))
+            m.cleanup()
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,103 @@
+"""Test code for iiif/pool.py."""
+import os
+import unittest
+
+from PIL import Image
+
+from iiif.error import IIIFError
+from iiif.manipulator import IIIFManipulator
+from iiif.manipulator_gen import IIIFManipulatorGen
+from iiif.manipulator_pil import IIIFManipulatorPIL
+from iiif.pool import IIIFProcessPool, pool_derive
+from iiif.request import IIIFRequest
+
+
+def make_request(identifier, path):
+    """IIIFRequest for path."""
+    r = IIIFRequest(api_version='2.1', identifier=identifier)
+    r.parse_url(path)
+    return r
+
+
+class TestAll(unittest.TestCase):
+    """Tests for IIIFProcessPool."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Start pool shared by tests."""
+        cls.pool = IIIFProcessPool(workers=1, shm_threshold=10000)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Stop pool."""
+        cls.pool.shutdown()
+
+    def test01_pool_derive(self):
+        """Test pool_derive in this process."""
+        r = make_request('starfish', 'full/10,/0/default.png')
+        (kind, data, size, mime_type, rss) = pool_derive(IIIFManipulatorPIL, '2.1',
+                                                         'testimages/starfish.jpg', r)
+        self.assertEqual(kind, 'bytes')
+        self.assertEqual(size, len(data))
+        self.assertEqual(mime_type, 'image/png')
+        self.assertTrue(data.startswith(b'\x89PNG'))
+        self.assertGreater(rss, 0)
+        # not streamable, via temporary file
+        r = make_request('starfish', 'full/full/0/default')
+        (kind, data, size, mime_type, rss) = pool_derive(IIIFManipulator, '2.1', 'testimages/starfish.jpg', r,
+                                                         shm_threshold=10 ** 9)
+        self.assertEqual(len(data), os.path.getsize('testimages/starfish.jpg'))
+
+    def test02_derive(self):
+        """Test derive in worker process, large output via shared memory."""
+        for (size, shape) in (('20,', (20, 27)), ('500,', (500, 667))):
+            r = make_request('starfish', 'full/%s/0/default.png' % (size))
+            (outfile, mime_type) = self.pool.derive(IIIFManipulatorPIL, '2.1',
+                                                    'testimages/starfish.jpg', r)
+            try:
+                self.assertEqual(mime_type, 'image/png')
+                self.assertEqual(Image.open(outfile).size, shape)
+            finally:
+                os.remove(outfile)
+        r = make_request('sierpinski_carpet', 'full/81,/0/default.png')
+        (outfile, mime_type) = self.pool.derive(IIIFManipulatorGen, '2.1',
+                                                'iiif/generators/sierpinski_carpet.py', r)
+        try:
+            self.assertEqual(Image.open(outfile).size, (81, 81))
+        finally:
+            os.remove(outfile)
+
+    def test03_errors(self):
+        """Test errors raised in caller."""
+        r = make_request('starfish', 'full/10,/0/default.gif')
+        try:
+            self.pool.derive(IIIFManipulatorPIL, '2.1', 'testimages/starfish.jpg', r)
+            self.fail("no error")
+        except IIIFError as e:
+            self.assertEqual(e.code, 415)
+        self.assertRaises(IIIFError, self.pool.derive, IIIFManipulatorPIL, '2.1',
+                          'testimages/starfish.jpg', r, deadline=1.0)
+
+    def test04_recycle(self):
+        """Test workers replaced after max_tasks derivations."""
+        pool = IIIFProcessPool(workers=1, max_tasks=2)
+        try:
+            r = make_request('starfish', 'full/10,/0/default.png')
+            executors = []
+            for n in range(5):
+                executors.append(pool.executor)
+                (outfile, mime_type) = pool.derive(IIIFManipulatorPIL, '2.1', 'testimages/starfish.jpg', r)
+                os.remove(outfile)
+            self.assertEqual(pool.num_recycled, 2)
+            self.assertIs(executors[0], executors[1])
+            self.assertIsNot(executors[1], executors[2])
+            self.assertIsNot(executors[3], executors[4])
+        finally:
+            pool.shutdown()
+        pool = IIIFProcessPool(workers=1, max_rss=1)
+        try:
+            (outfile, mime_type) = pool.derive(IIIFManipulatorPIL, '2.1', 'testimages/starfish.jpg', r)
+            os.remove(outfile)
+            self.assertEqual(pool.num_recycled, 1)
+        finally:
+            pool.shutdown()
@@ -0,0 +1,141 @@
+"""Test code for iiif/prefork.py."""
+import mock
+import os
+import signal
+import socket
+import threading
+import time
+import unittest
+try:  # python3
+    from urllib.request import urlopen
+except ImportError:  # pragma: no cover # python2
+    from urllib2 import urlopen
+
+from iiif.prefork import IIIFPreforkServer, IIIFRecyclingServer, RECYCLE_FD_ENV, rss
+
+
+def pid_app(environ, start_response):
+    """WSGI application returning the process id."""
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid()).encode('ascii')]
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), "requires os.fork()")
+class TestAll(unittest.TestCase):
+    """Tests for IIIFPreforkServer."""
+
+    def start(self, **kwargs):
+        """Start server in a forked master process."""
+        self.server = IIIFPreforkServer(pid_app, host='127.0.0.1', port=0,
+                                        timeout=0.1, **kwargs)
+        self.server.bind()
+        self.master = os.fork()
+        if (self.master == 0):
+            try:
+                self.server.serve_forever()
+            finally:
+                os._exit(0)
+        self.server.socket.close()
+
+    def stop(self):
+        """Stop master process and wait for it."""
+        os.kill(self.master, signal.SIGTERM)
+        (pid, status) = os.waitpid(self.master, 0)
+        return status
+
+    def get(self):
+        """Get worker pid from server."""
+        for n in range(50):
+            try:
+                return int(urlopen('http://127.0.0.1:%d/' % (self.server.port), timeout=5).read())
+            except IOError:
+                time.sleep(0.1)
+        raise Exception("Server not responding")
+
+    def test01_rss(self):
+        """Test rss."""
+        self.assertGreater(rss(), 1000000)
+
+    def test02_max_requests(self):
+        """Test worker recycling after max_requests."""
+        self.start(workers=1, max_requests=2)
+        try:
+            pids = [self.get() for n in range(5)]
+        finally:
+            self.assertEqual(self.stop(), 0)
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+        self.assertEqual(pids[2], pids[3])
+        self.assertNotEqual(pids[3], pids[4])
+        self.assertNotIn(self.master, pids)
+
+    def test03_max_rss_and_reload(self):
+        """Test worker recycling after max_rss and on SIGHUP."""
+        self.start(workers=1, max_rss=1)
+        try:
+            pids = [self.get() for n in range(2)]
+        finally:
+            self.assertEqual(self.stop(), 0)
+        self.assertNotEqual(pids[0], pids[1])
+        self.start(workers=2)
+        try:
+            pids = set([self.get() for n in range(6)])
+            os.kill(self.master, signal.SIGHUP)
+            time.sleep(0.5)
+            new_pids = set([self.get() for n in range(6)])
+        finally:
+            self.assertEqual(self.stop(), 0)
+        self.assertFalse(pids & new_pids)
+
+
+class TestRecycling(unittest.TestCase):
+    """Tests for IIIFRecyclingServer."""
+
+    def test01_max_requests(self):
+        """Test recycling after max_requests once requests finish."""
+        server = IIIFRecyclingServer(pid_app, host='127.0.0.1', port=0,
+                                     max_requests=2, timeout=0.1)
+        server.bind()
+        with mock.patch.object(server, 'restart') as restart:
+            t = threading.Thread(target=server.serve_forever)
+            t.daemon = True
+            t.start()
+            url = 'http://127.0.0.1:%d/' % (server.port)
+            resp = urlopen(url, timeout=5)
+            self.assertEqual(int(resp.read()), os.getpid())
+            self.assertFalse(server.recycling)
+            resp = urlopen(url, timeout=5)
+            resp.read()
+            self.assertTrue(server.recycling)
+            t.join(5)
+            self.assertFalse(t.is_alive())
+            self.assertTrue(restart.called)
+        self.assertEqual(server.connections, 0)
+        headers = []
+        server.count_requests({}, lambda status, h, exc_info=None: headers.extend(h))
+        self.assertIn(('Connection', 'close'), headers)
+        # restart executes argv with the socket passed on
+        with mock.patch('os.execve') as execve:
+            server.argv = ['/bin/prog', 'arg']
+            server.restart()
+            (prog, argv, env) = execve.call_args[0]
+            self.assertEqual(argv, ['/bin/prog', 'arg'])
+            self.assertEqual(env[RECYCLE_FD_ENV], str(server.server.fileno()))
+        server.server.server_close()
+
+    def test02_inherited_socket(self):
+        """Test server created on inherited socket."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        port = sock.getsockname()[1]
+        os.environ[RECYCLE_FD_ENV] = str(os.dup(sock.fileno()))
+        try:
+            server = IIIFRecyclingServer(pid_app, host='127.0.0.1', port=0)
+            server.bind()
+            self.assertEqual(server.port, port)
+            self.assertNotIn(RECYCLE_FD_ENV, os.environ)
+            server.server.server_close()
+        finally:
+            os.environ.pop(RECYCLE_FD_ENV, None)
+            sock.close()
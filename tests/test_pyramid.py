@@ -0,0 +1,71 @@
+"""Test code for iiif/pyramid.py."""
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from iiif.pyramid import IIIFPyramidCache
+
+
+class TestAll(unittest.TestCase):
+    """Tests for IIIFPyramidCache."""
+
+    def setUp(self):
+        """Make temporary directory."""
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove temporary directory."""
+        shutil.rmtree(self.tmp)
+
+    def test01_build_and_levels(self):
+        """Test build() and levels()."""
+        src = os.path.join(self.tmp, 'src.png')
+        Image.new('RGB', (1001, 300), (10, 20, 30)).save(src)
+        p = IIIFPyramidCache(os.path.join(self.tmp, 'pyramids'), min_size=100)
+        self.assertEqual(p.levels(src), [])
+        self.assertEqual(p.build(src), 3)
+        levels = p.levels(src)
+        self.assertEqual([f for (f, path) in levels], [8, 4, 2])
+        self.assertEqual(Image.open(levels[0][1]).size, (126, 38))
+        self.assertEqual(Image.open(levels[2][1]).size, (501, 150))
+        self.assertEqual(Image.open(levels[2][1]).getpixel((0, 0)), (10, 20, 30))
+        # already built
+        self.assertEqual(p.build(src), 0)
+        # modified source gets new levels, old ones removed
+        Image.new('L', (300, 200), 99).save(src)
+        os.utime(src, (0, 1000))
+        self.assertEqual(p.levels(src), [])
+        self.assertEqual(p.build(src), 1)
+        levels = p.levels(src)
+        self.assertEqual(len(levels), 1)
+        self.assertTrue(levels[0][1].endswith('2.pgm'))
+        self.assertEqual(len(os.listdir(p.source_dir(src))), 1)
+
+    def test02_not_built(self):
+        """Test build() for images without levels."""
+        p = IIIFPyramidCache(os.path.join(self.tmp, 'pyramids'))
+        # small
+        src = os.path.join(self.tmp, 'small.jpg')
+        Image.new('RGB', (100, 100)).save(src)
+        self.assertEqual(p.build(src), 0)
+        # other modes and formats
+        src = os.path.join(self.tmp, 'rgba.png')
+        Image.new('RGBA', (1000, 1000)).save(src)
+        self.assertEqual(p.build(src), 0)
+        src = os.path.join(self.tmp, 'big.tif')
+        Image.new('RGB', (1000, 1000)).save(src)
+        self.assertEqual(p.build(src), 0)
+        # bad file
+        src = os.path.join(self.tmp, 'bad.jpg')
+        with open(src, 'w') as fh:
+            fh.write('not a jpeg')
+        self.assertEqual(p.build(src), 0)
+        # no temporary directories left
+        for name in os.listdir(p.cache_dir):
+            self.assertEqual(os.listdir(os.path.join(p.cache_dir, name)), [])
+        # missing source
+        self.assertEqual(p.levels(os.path.join(self.tmp, 'none.jpg')), [])
@@ -16,7 +16,7 @@ except ImportError:  # python3
     import io
 
 from iiif.request import IIIFRequestError
-from iiif.static import IIIFStatic, IIIFStaticError, static_partial_tile_sizes, static_full_sizes
+from iiif.static import IIIFStatic, IIIFStaticError, static_partial_tile_sizes, static_full_sizes, static_tile_neighbours
 from iiif.manipulator_gen import IIIFManipulatorGen
 
 
@@ -423,3 +423,24 @@ class TestAll(unittest.TestCase):
         open(tmp2, 'w').close()
         s.identifier = 'abc4'
         self.assertRaises(Exception, s.write_html, tmp2)
+
+    def test10_static_tile_neighbours(self):
+        """Test neighbouring and parent tiles."""
+        # Interior tile has four neighbours and a parent
+        tiles = static_tile_neighbours([512, 512, 512, 512], 512, 2000, 2000, 512, [1, 2, 4])
+        self.assertEqual(tiles, [([0, 512, 512, 512], [512, 512]),
+                                 ([1024, 512, 512, 512], [512, 512]),
+                                 ([512, 0, 512, 512], [512, 512]),
+                                 ([512, 1024, 512, 512], [512, 512]),
+                                 ([0, 0, 1024, 1024], [512, 512])])
+        # Edge tile at scale factor 2, parent would be full image
+        tiles = static_tile_neighbours([1024, 1024, 976, 976], 488, 2000, 2000, 512, [1, 2, 4])
+        self.assertEqual(tiles, [([0, 1024, 1024, 976], [512, 488]),
+                                 ([1024, 0, 976, 1024], [488, 512])])
+        # Every tile from static_partial_tile_sizes is recognized
+        for (region, size) in static_partial_tile_sizes(1000, 1333, 256, [1, 2, 4]):
+            self.assertNotEqual(static_tile_neighbours(region, size[0], 1000, 1333, 256, [1, 2, 4]), [])
+        # Not tiles
+        self.assertEqual(static_tile_neighbours([0, 0, 512, 512], 256, 2000, 2000, 512, [1, 2, 4]), [])
+        self.assertEqual(static_tile_neighbours([1, 0, 512, 512], 512, 2000, 2000, 512, [1, 2, 4]), [])
+        self.assertEqual(static_tile_neighbours([0, 0, 100, 100], 100, 2000, 2000, 512, [1, 2, 4]), [])
@@ -0,0 +1,63 @@
+"""Test code for iiif/stream.py."""
+import unittest
+
+from iiif.error import IIIFError
+from iiif.stream import IIIFStream
+
+
+class TestAll(unittest.TestCase):
+    """Tests for IIIFStream."""
+
+    def test01_chunks(self):
+        """Test writes collected into chunks."""
+        s = IIIFStream(chunk_size=10)
+
+        def writer():
+            for n in range(25):
+                s.write(b'x')
+            s.write(bytearray(b'yz'))
+            s.finish()
+        s.start(writer)
+        s.wait()
+        self.assertEqual(list(s), [b'x' * 10, b'x' * 10, b'xxxxxyz'])
+        # nothing written
+        s = IIIFStream()
+        s.start(s.finish)
+        s.wait()
+        self.assertEqual(list(s), [])
+
+    def test02_errors(self):
+        """Test errors passed to reader."""
+        s = IIIFStream()
+        s.start(s.finish, IIIFError(code=415))
+        self.assertRaises(IIIFError, s.wait)
+        s = IIIFStream(chunk_size=2)
+
+        def writer():
+            s.write(b'abc')
+            s.finish(ValueError('bang'))
+        s.start(writer)
+        s.wait()
+        it = iter(s)
+        self.assertEqual(next(it), b'abc')
+        self.assertRaises(ValueError, next, it)
+        self.assertTrue(s.closed)
+
+    def test03_reader_closed(self):
+        """Test writer stopped when reader closes."""
+        s = IIIFStream(chunk_size=1, queue_size=1, poll=0.01)
+        errors = []
+
+        def writer():
+            try:
+                for n in range(100):
+                    s.write(b'a')
+            except IOError as e:
+                errors.append(e)
+            s.finish()
+        s.start(writer)
+        s.wait()
+        self.assertEqual(next(iter(s)), b'a')
+        s.close()
+        s.thread.join(5)
+        self.assertEqual(len(errors), 1)
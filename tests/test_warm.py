@@ -0,0 +1,83 @@
+"""Test code for iiif/warm.py."""
+import json
+import mock
+import unittest
+
+from iiif.warm import warm_requests, IIIFCacheWarmer, info_api_version
+
+
+class TestAll(unittest.TestCase):
+    """Tests for cache warming."""
+
+    def test01_warm_requests(self):
+        """Test warm_requests."""
+        paths = list(warm_requests(1000, 1333, 512))
+        # Full sizes first, smallest first, then tiles large scale factor first
+        self.assertEqual(paths[0], 'full/1,/0/default.jpg')
+        self.assertEqual(paths[8], 'full/250,/0/default.jpg')
+        self.assertEqual(paths[9], '0,0,1000,1024/500,/0/default.jpg')
+        self.assertEqual(paths[-1], '512,1024,488,309/488,/0/default.jpg')
+        self.assertEqual(len(paths), 17)
+        for path in paths:
+            self.assertEqual(len(path.split('/')), 4)
+        # Limit levels
+        paths = list(warm_requests(1000, 1333, 512, levels=1))
+        self.assertEqual(len(paths), 11)
+        self.assertEqual(paths[-1], '0,1024,1000,309/500,/0/default.jpg')
+        # Explicit scale factors
+        paths = list(warm_requests(1000, 1333, 512, scale_factors=[1]))
+        self.assertEqual(len(paths), 15)
+        # Other versions and formats
+        paths = list(warm_requests(1000, 1333, 512, api_version='3.0', levels=1))
+        self.assertEqual(paths[8], 'full/250,333/0/default.jpg')
+        self.assertEqual(paths[9], '0,0,1000,1024/500,512/0/default.jpg')
+        paths = list(warm_requests(100, 100, 512, api_version='1.1', format='png'))
+        self.assertEqual(paths[0], 'full/1,/0/native.png')
+        self.assertEqual(paths[-1], 'full/100,/0/native.png')
+
+    def test02_info_api_version(self):
+        """Test info_api_version."""
+        self.assertEqual(info_api_version({}), '2.1')
+        self.assertEqual(info_api_version(
+            {'@context': 'http://iiif.io/api/image/3/context.json'}), '3.0')
+        self.assertEqual(info_api_version(
+            {'@context': ['http://example.org/ext', 'http://iiif.io/api/image/2/context.json']}), '2.1')
+        self.assertEqual(info_api_version(
+            {'@context': 'http://library.stanford.edu/iiif/image-api/1.1/context.json'}), '1.1')
+
+    def test03_warm(self):
+        """Test IIIFCacheWarmer.warm with mocked requests."""
+        info = {'@context': 'http://iiif.io/api/image/2/context.json',
+                'width': 1000, 'height': 1333,
+                'tiles': [{'width': 512, 'scaleFactors': [1, 2]}]}
+        got = []
+
+        def get(url):
+            got.append(url)
+            if (url.endswith('info.json')):
+                return json.dumps(info).encode('utf-8')
+            if (url.endswith('full/125,/0/default.jpg')):
+                raise Exception('failed')
+            return b'image'
+
+        w = IIIFCacheWarmer('http://example.org/prefix/', workers=2, levels=1)
+        with mock.patch.object(w, 'get', side_effect=get):
+            (ok, failed) = w.warm('an id')
+        self.assertEqual(ok, 10)
+        self.assertEqual(failed, 1)
+        self.assertEqual(got[0], 'http://example.org/prefix/an%20id/info.json')
+        self.assertIn('http://example.org/prefix/an%20id/0,0,1000,1024/500,/0/default.jpg', got)
+        self.assertEqual(len(got), 12)
+        # Dry run gets info.json only
+        got = []
+        w.dryrun = True
+        with mock.patch.object(w, 'get', side_effect=get):
+            (ok, failed) = w.warm('an id')
+        self.assertEqual((ok, failed), (11, 0))
+        self.assertEqual(len(got), 1)
+        # No tiles in info.json, default tile size and auto scale factors
+        info = {'width': 100, 'height': 100}
+        w = IIIFCacheWarmer('http://example.org/prefix')
+        with mock.patch.object(w, 'get', side_effect=get):
+            urls = w.urls('a')
+        self.assertEqual(urls[-1], 'http://example.org/prefix/a/full/100,/0/default.jpg')